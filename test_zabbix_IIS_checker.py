@@ -0,0 +1,558 @@
+import asyncio
+import concurrent.futures
+import configparser
+import http.server
+import itertools
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import pycurl
+
+import zabbix_trapper
+
+from zabbix_IIS_checker import AsyncPSHostPool, Checker, CheckerService, IIS_site_info_json, PSHost, PSHostError, \
+    PSHostPool, Result, Sender, Spool, WrappedList, cidict
+
+
+# Talks PowerShell host's protocol. "pid" command outputs the host's PID, "sleep <seconds>" does the same after
+# a delay, "fail" fails and "exit" kills the host. Any other command outputs the host's first argument
+FAKE_PS_HOST = """
+import base64, os, sys, time
+for line in sys.stdin:
+    cmd_id, cmd = line.split()
+    cmd = base64.b64decode(cmd).decode("utf-8")
+    status, body = "OK", sys.argv[1] if len(sys.argv) > 1 else ""
+    if cmd.startswith("sleep "):
+        time.sleep(float(cmd.split()[1]))
+        body = str(os.getpid())
+    elif cmd == "pid":
+        body = str(os.getpid())
+    elif cmd == "fail":
+        status, body = "ERR", "failed"
+    elif cmd == "exit":
+        sys.exit(1)
+    body = body.encode("utf-8")
+    sys.stdout.buffer.write("{} {} {}\\n".format(cmd_id, status, len(body)).encode("ascii") + body)
+    sys.stdout.flush()
+"""
+
+
+def make_ps_host(output="", **kwargs):
+    """
+    :param output: the output of the commands other than the fake host's own ones
+    :param kwargs: PSHost's parameters
+    :return: a PSHost's instance running the fake host
+    """
+    return PSHost(cmd=[sys.executable, "-c", FAKE_PS_HOST, output], **kwargs)
+
+
+def make_checker(**kwargs):
+    """
+    :param kwargs: Checker's parameters
+    :return: a Checker's instance with the default config unless iniobj is given
+    """
+    kwargs.setdefault("iniobj", configparser.ConfigParser())
+    return Checker(q=queue.Queue(), sq=queue.Queue(), dq=queue.Queue(), evt_discovery_done=threading.Event(),
+                   IIS_sites=WrappedList(), circs={"argv_0": "test"}, **kwargs)
+
+
+def make_probe(path, max_body=1048576, content_type="text/html; charset=utf-8"):
+    """
+    :param path: "path" setting (JSON) with a single path component
+    :return: a Checker._Probe instance set up for the path as if the response headers have been received
+    """
+    settings = Checker._Config(configparser.ConfigParser(), {"argv_0": "test"}).get(frozenset())
+    settings = settings._replace(max_body=max_body)
+    spec = Checker._Config.compile_path(path)[0]
+    plan = Checker._Plan(zbx_key="iis.site.probe", urls=(spec._replace(path="http://localhost" + spec.path),),
+                         timing_keys=((),), curl_key=None, curl_options=(), settings=settings, version=0)
+    probe = Checker._Probe("site", plan, pycurl.Curl())
+    probe.next_url()
+    probe._headers = {"_STATUS_CODE": 200, "content-type": content_type}
+    return probe
+
+
+def probe_body(path, chunks, **kwargs):
+    """
+    Feeds the chunks of the body to a probe the way Curl does it
+    :return: the probe's error message or None if the body has passed the checks
+    """
+    probe = make_probe(path, **kwargs)
+    for chunk in chunks:
+        if probe._curl_writefunction(chunk) == 0:
+            break
+    result = probe.check_response()
+    return result.value if result is not None else None
+
+
+class PSHostTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ps_host = make_ps_host("Ünïcödé\nlines", timeout=5)
+        self.addCleanup(self.ps_host.close)
+
+    def test_host_is_kept_running(self):
+        self.assertEqual(self.ps_host.run("pid"), self.ps_host.run("pid"))
+
+    def test_output(self):
+        self.assertEqual(self.ps_host.run("Get-Website"), "Ünïcödé\nlines")
+
+    def test_command_error(self):
+        with self.assertRaisesRegex(PSHostError, "failed"):
+            self.ps_host.run("fail")
+        self.assertEqual(self.ps_host.run("Get-Website"), "Ünïcödé\nlines")
+
+    def test_died_host_is_respawned(self):
+        pid = self.ps_host.run("pid")
+        with self.assertRaisesRegex(PSHostError, "died"):
+            self.ps_host.run("exit")
+        self.assertNotEqual(self.ps_host.run("pid"), pid)
+
+    def test_timed_out_host_is_respawned(self):
+        pid = self.ps_host.run("pid")
+        with self.assertRaisesRegex(PSHostError, "did not complete"):
+            self.ps_host.run("sleep 5", timeout=0.5)
+        self.assertNotEqual(self.ps_host.run("pid"), pid)
+
+
+class PSHostPoolTest(unittest.TestCase):
+
+    DELAY = 0.5
+
+    def test_commands_run_concurrently(self):
+        pool = PSHostPool(size=3, cmd=[sys.executable, "-c", FAKE_PS_HOST])
+        self.addCleanup(pool.close)
+        pool.run("pid")  # Python's startup isn't counted
+        with concurrent.futures.ThreadPoolExecutor(max_workers=6) as executor:
+            started = time.monotonic()
+            pids = list(executor.map(pool.run, ["sleep {}".format(self.DELAY)] * 6))
+            elapsed = time.monotonic() - started
+        self.assertEqual(len(set(pids)), 3)
+        self.assertLess(elapsed, self.DELAY * 3)
+
+    def test_idle_host_is_reused(self):
+        pool = PSHostPool(size=3, cmd=[sys.executable, "-c", FAKE_PS_HOST])
+        self.addCleanup(pool.close)
+        self.assertEqual(len(set(pool.run("pid") for _ in range(3))), 1)
+
+    def test_async_commands_run_concurrently(self):
+        async def run():
+            pool = AsyncPSHostPool(size=3, cmd=[sys.executable, "-c", FAKE_PS_HOST])
+            try:
+                await pool.run("pid")
+                started = time.monotonic()
+                pids = await asyncio.gather(*[pool.run("sleep {}".format(self.DELAY)) for _ in range(6)])
+                return pids, time.monotonic() - started
+            finally:
+                await pool.close()
+
+        pids, elapsed = asyncio.run(run())
+        self.assertEqual(len(set(pids)), 3)
+        self.assertLess(elapsed, self.DELAY * 3)
+
+class PSBatchTest(unittest.TestCase):
+
+    SITES = [("Default Web Site", None), ("shop", None), ("gone", None)]
+
+    def fetch_states(self, ps_host):
+        """
+        Fetches the states of SITES with the PowerShell host
+        :return: a list of tuples: (IIS site name, Zabbix key, IIS site state or an exception's type)
+        """
+        self.addCleanup(ps_host.close)
+        checker = make_checker(method="psbatch", ps_host=ps_host)
+        with mock.patch.object(ps_host, "run", wraps=ps_host.run) as run:
+            rv = [(x.name, x.key, x.value if x.error is None else type(x.error))
+                  for x in checker.get_sites_states(self.SITES)]
+        self.assertEqual(run.call_count, 1)
+        return rv
+
+    def test_states_are_fetched_with_single_call(self):
+        stdout = '[{"Name": "Default Web Site", "State": "Started"}, {"name": "SHOP", "state": "Stopped"}, ' \
+                 '{"Name": "other", "State": "Started"}]'
+        self.assertEqual(self.fetch_states(make_ps_host(stdout)), [
+            ("Default Web Site", "iis.site.state[Default Web Site]", "started"),
+            ("shop", "iis.site.state[shop]", "stopped"),
+            ("gone", "iis.site.state[gone]", "notfound")])
+
+    def test_single_site_object(self):
+        self.assertEqual(self.fetch_states(make_ps_host('{"Name": "shop", "State": "Started"}'))[1:], [
+            ("shop", "iis.site.state[shop]", "started"),
+            ("gone", "iis.site.state[gone]", "notfound")])
+
+    def test_null_state(self):
+        self.assertEqual(self.fetch_states(make_ps_host('[{"Name": "shop", "State": null}]'))[1],
+                         ("shop", "iis.site.state[shop]", RuntimeError))
+
+    def test_corrupted_json(self):
+        self.assertEqual([x[2] for x in self.fetch_states(make_ps_host('[{"Name": "shop"'))],
+                         [RuntimeError] * len(self.SITES))
+
+    def test_powershell_failure(self):
+        states = self.fetch_states(PSHost(cmd=[sys.executable, "-c", "import sys; sys.exit(1)"]))
+        self.assertEqual(states, [(x[0], "iis.site.state[{}]".format(x[0]), PSHostError) for x in self.SITES])
+
+
+class SpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.filename = os.path.join(tmp_dir.name, "spool")
+
+    @staticmethod
+    def values(spool):
+        return [[x[2] for x in record[1]] for record in spool.peek()]
+
+    def test_journal_survives_restart(self):
+        spool = Spool(self.filename)
+        spool.append([("host", "key", "1", 100), ("host", "key", "2", 101)])
+        spool.append([("host", "key", "3", 102)])
+        self.assertEqual(Spool(self.filename).peek()[0][1], [["host", "key", "1", 100], ["host", "key", "2", 101]])
+        spool.remove(spool.peek()[:1])
+        self.assertEqual(self.values(Spool(self.filename)), [["3"]])
+
+    def test_truncated_record_is_dropped(self):
+        spool = Spool(self.filename)
+        spool.append([("host", "key", "1", 100)])
+        spool.append([("host", "key", "2", 100)])
+        with open(self.filename, "r+b") as f:
+            f.truncate(os.path.getsize(self.filename) - 1)
+        self.assertEqual(self.values(Spool(self.filename)), [["1"]])
+        self.assertEqual(self.values(Spool(self.filename)), [["1"]])
+
+    def test_oldest_records_are_dropped_to_fit_max_size(self):
+        spool = Spool(self.filename)
+        for i in range(5):
+            spool.append([("host", "key", str(i), 100)])
+        spool = Spool(self.filename, max_size=os.path.getsize(self.filename) * 2 // 5)
+        self.assertEqual(self.values(spool), [["3"], ["4"]])
+        self.assertEqual(self.values(Spool(self.filename)), [["3"], ["4"]])
+
+    def test_old_records_are_dropped(self):
+        spool = Spool(self.filename, max_age=60)
+        spool.append([("host", "key", "1", 100)])
+        with mock.patch("time.time", return_value=time.time() + 61):
+            spool.append([("host", "key", "2", 100)])
+        self.assertEqual(self.values(Spool(self.filename)), [["2"]])
+
+
+class SenderSpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.spool = Spool(os.path.join(tmp_dir.name, "spool"))
+        self.sender = Sender(queue.Queue(), "send", zbx_host="host", spool=self.spool)
+
+    def send(self, value, sent):
+        """
+        Sends a batch of one item
+        :param sent: whether Zabbix server accepts the data
+        :return: a mock of the sending method
+        """
+        with mock.patch.object(self.sender, "_zbx_send", side_effect=lambda items: [] if sent else items) as zbx_send:
+            self.sender._send([Result("site", "key", value, None, None, 100000000123)])
+        return zbx_send
+
+    def replay(self, results):
+        """
+        Runs a single replay pass
+        :param results: results of the sending attempts
+        :return: a mock of the sending method
+        """
+        self.sender._replay_stop.wait = mock.Mock(side_effect=[False, True])
+        results = iter(results)
+        with mock.patch.object(self.sender, "_zbx_send", side_effect=lambda items: [] if next(results) else items) as zbx_send:
+            self.sender._replay_spool()
+        return zbx_send
+
+    def test_unsent_data_is_spooled(self):
+        self.assertEqual(self.send("1", sent=False).call_count, 1)
+        self.assertEqual(self.send("2", sent=True).call_count, 0)  # Spooled right away while the server is down
+        self.assertEqual([x[1] for x in self.spool.peek()], [[["host", "key", "1", 100, 123]], [["host", "key", "2", 100, 123]]])
+
+    def test_replayed_records_are_removed(self):
+        self.send("1", sent=False)
+        self.send("2", sent=False)
+        self.assertEqual(self.replay([True, True]).call_count, 2)
+        self.assertEqual(len(self.spool), 0)
+        self.assertEqual(self.send("3", sent=True).call_count, 1)
+
+    def test_failed_replay_keeps_unsent_records(self):
+        for i in range(3):
+            self.send(str(i), sent=False)
+        self.assertEqual(self.replay([True, False]).call_count, 2)
+        self.assertEqual([x[1][0][2] for x in self.spool.peek()], ["1", "2"])
+        self.assertEqual(self.send("3", sent=True).call_count, 0)
+
+    def test_replayed_records_are_removed_at_once(self):
+        for i in range(10):
+            self.send(str(i), sent=False)
+        with mock.patch.object(self.spool, "_rewrite", wraps=self.spool._rewrite) as rewrite:
+            self.replay([True] * 4 + [False])
+            self.assertEqual(rewrite.call_count, 1)
+            self.replay([True] * 6)
+            self.assertEqual(rewrite.call_count, 2)
+        self.assertEqual(len(Spool(self.spool._filename)), 0)
+
+    def test_accepted_chunks_are_not_resent(self):
+        trapper = zabbix_trapper.FakeTrapper(max_requests=1)
+        self.addCleanup(trapper.close)
+        self.sender.configure(*trapper.address, zbx_host="host", batch_size=2)
+        self.sender._send([Result("site", "key", str(i), None, None, 100000000123) for i in range(5)])
+        self.assertEqual(trapper.items, 2)
+        self.assertEqual([[x[2] for x in record[1]] for record in self.spool.peek()], [["2", "3", "4"]])
+        trapper.max_requests = 2
+        self.sender._replay_stop.wait = mock.Mock(side_effect=[False, True])
+        self.sender._replay_spool()
+        self.assertEqual(trapper.items, 4)
+        self.assertEqual([[x[2] for x in record[1]] for record in Spool(self.spool._filename).peek()], [["4"]])
+        self.assertTrue(self.sender._zbx_down.is_set())
+        trapper.max_requests = None
+        self.sender._replay_stop.wait = mock.Mock(side_effect=[False, True])
+        self.sender._replay_spool()
+        self.assertEqual(trapper.items, 5)
+        self.assertEqual(len(Spool(self.spool._filename)), 0)
+        self.assertFalse(self.sender._zbx_down.is_set())
+
+
+class ChunkedBodyMatchTest(unittest.TestCase):
+
+    CHUNKS = [b"<html>all good\n", b"Error: none</html>"]
+
+    def test_anchored_nobody_does_not_match_chunk_start(self):
+        self.assertIsNone(probe_body('[{"path": "/", "nobody": "^Error"}]', self.CHUNKS))
+
+    def test_anchored_body_does_not_match_chunk_end(self):
+        self.assertIsNotNone(probe_body('[{"path": "/", "body": "good$"}]', self.CHUNKS))
+
+    def test_anchored_body_matches_whole_body(self):
+        self.assertIsNone(probe_body('[{"path": "/", "body": "^<html>"}]', self.CHUNKS))
+        self.assertIsNone(probe_body('[{"path": "/", "body": "</html>$"}]', self.CHUNKS))
+
+    def test_lookaround_matches_across_chunks(self):
+        self.assertIsNone(probe_body('[{"path": "/", "body": "(?<=good\\\\n)Error"}]', self.CHUNKS))
+        self.assertIsNone(probe_body('[{"path": "/", "nobody": "(?<!good\\\\n)Error"}]', self.CHUNKS))
+
+    def test_whole_body_is_capped_by_max_body(self):
+        self.assertIsNotNone(probe_body('[{"path": "/", "body": "none</html>$"}]', self.CHUNKS, max_body=20))
+
+    def test_match_spanning_chunks(self):
+        self.assertIsNone(probe_body('[{"path": "/", "body": "good\\\\sError"}]', self.CHUNKS))
+        self.assertIsNotNone(probe_body('[{"path": "/", "nobody": "good\\\\sError"}]', self.CHUNKS))
+
+    def test_transfer_stops_once_nobody_is_found(self):
+        chunks = [b"<html>all good\n", b"Error: disk full\n", b"." * 65536, b"</html>"]
+        for path in ['[{"path": "/", "body": "all good", "nobody": "Error"}]',
+                     '[{"path": "/", "body": "all good|ü", "nobody": "Error|ü"}]']:  # The raw and the decoded body
+            probe = make_probe(path)
+            self.assertEqual([probe._curl_writefunction(x) for x in chunks[:2]], [None, 0], path)
+            self.assertIn("response body contains text Error", probe.check_response().value, path)
+            probe = make_probe(path.replace("all good", "</html>"))  # "body" takes precedence
+            self.assertEqual([probe._curl_writefunction(x) for x in chunks[:2]], [None, 0], path)
+            self.assertIn("response body doesn't contain text </html>", probe.check_response().value, path)
+            probe = make_probe(path.replace("Error", "Warning"))
+            self.assertEqual([probe._curl_writefunction(x) for x in chunks], [None] * len(chunks), path)
+            self.assertIsNone(probe.check_response(), path)
+
+    def test_raw_body_match(self):
+        for charset in ["utf-8", "iso-8859-1", "windows-1252"]:
+            content_type = "text/html; charset={}".format(charset)
+            self.assertIsNone(probe_body('[{"path": "/", "body": "good"}]', self.CHUNKS, content_type=content_type))
+            self.assertIsNotNone(probe_body('[{"path": "/", "nobody": "od\\nErr"}]', self.CHUNKS,
+                                            content_type=content_type))
+            self.assertIsNone(probe_body('[{"path": "/", "nobody": "\\\\AError"}]', self.CHUNKS,
+                                         content_type=content_type))
+            self.assertIsNotNone(probe_body('[{"path": "/", "body": "good\\\\Z"}]', self.CHUNKS,
+                                            content_type=content_type))
+
+    def test_context_dependent_patterns_are_not_matched_raw(self):
+        for pattern in ["^Error", "good$", "\\AError", "good\\Z", "(?<=good)x", "x(?=Error)"]:
+            self.assertIsNone(Checker._Config.compile_bytes(pattern), pattern)
+        self.assertIsNotNone(Checker._Config.compile_bytes("Error: none"))
+
+    def test_context_dependent_patterns(self):
+        for pattern in ["^a", "a$", "\\Aa", "a\\Z", "\\ba", "a(?=b)", "a(?!b)", "(?<=a)b", "(?<!a)b"]:
+            self.assertTrue(Checker._Config.is_context_dependent(pattern), pattern)
+        for pattern in ["a", "[^a]b", "a\\$", "\\^a", "[$^]", "(?:ab)", "(?P<name>a)", "(?i)a"]:
+            self.assertFalse(Checker._Config.is_context_dependent(pattern), pattern)
+
+
+class ProbeHandler(http.server.BaseHTTPRequestHandler):
+    """
+    "/slow" responds after a delay, "/redirect/<n>" redirects to "/redirect/<n-1>" and "/redirect/0" to "/missing"
+    which isn't found. Any other path responds with "hello" page
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            if self.path == "/slow":
+                time.sleep(0.2)
+            if self.path.startswith("/redirect/"):
+                n = int(self.path.rsplit("/", 1)[1])
+                self.send_response(302)
+                self.send_header("Location", "/redirect/{}".format(n - 1) if n > 0 else "/missing")
+                body = b"moved"
+            elif self.path == "/missing":
+                self.send_response(404)
+                body = b"hello"
+            else:
+                self.send_response(200)
+                body = b"hello"
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+class SitesProbesTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ProbeHandler)
+        cls.server.daemon_threads = True
+        cls.server.lock = threading.Lock()
+        cls.server.active = cls.server.max_active = 0
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.max_active = 0
+
+    def make_site(self, name):
+        """
+        :param name: IIS site name, it's also the site's host name
+        :return: an IIS_site_info's instance bound to the test server
+        """
+        binding = "{}:{}:{}".format(*self.server.server_address, name)
+        return IIS_site_info_json(cidict({"name": name, "serverAutoStart": True,
+                                          "bindings": {"Collection": [{"protocol": "http", "bindingInformation": binding}]}}))
+
+    def probe(self, paths, max_probes=100):
+        """
+        :param paths: a dict: site name -> "path" setting (JSON)
+        :param max_probes: max number of probes running concurrently
+        :return: a dict: site name -> probe's Result instance (the results come as the probes complete)
+        """
+        iniobj = configparser.ConfigParser()
+        iniobj.read_dict({"_defaulthost": {"timeout": "5", "timing": "no"}})
+        iniobj.read_dict({name: {"allhosts": name, "path": path} for name, path in paths.items()})
+        checker = make_checker(iniobj=iniobj, max_probes=max_probes)
+        sites = [self.make_site(name) for name in paths]
+        results = checker.get_sites_probes(sites)
+        self.assertEqual(len(results), len(sites))
+        self.assertCountEqual([x.key for x in results], [checker.get_probe_key(x) for x in sites])
+        return {x.name: x for x in results}
+
+    def test_concurrency_is_capped(self):
+        paths = {"site{}.test".format(i): '[{"path": "/slow"}]' for i in range(6)}
+        results = self.probe(paths, max_probes=2)
+        self.assertEqual({x.value for x in results.values()}, {"STATUS_OK"})
+        self.assertEqual(self.server.max_active, 2)
+        self.probe(paths)
+        self.assertEqual(self.server.max_active, 6)
+
+    def test_result_tuple(self):
+        result = self.probe({"ok.test": '[{"path": "/", "body": "hello"}]'})["ok.test"]
+        self.assertIsInstance(result, Result)
+        self.assertEqual(result[:5], ("ok.test", result.key, "STATUS_OK", None, None))
+        self.assertIsInstance(result.clock_ns, int)
+        result = self.probe({"failed.test": '[{"path": "/missing"}]'})["failed.test"]
+        self.assertEqual(result[:5], ("failed.test", result.key, "STATUS_ERR_WEBAPP_PROBLEM: Not Found", None, None))
+
+    def test_redirects_are_not_followed(self):
+        results = self.probe({"redirect.test": '[{"path": "/redirect/0", "body": "moved"}]',
+                              "chain.test": '[{"path": "/redirect/2"}, {"path": "/redirect/1"}, {"path": "/redirect/0"}]',
+                              "broken.test": '[{"path": "/redirect/1"}, {"path": "/missing"}, {"path": "/"}]'})
+        self.assertEqual(results["redirect.test"].value, "STATUS_OK")
+        self.assertEqual(results["chain.test"].value, "STATUS_OK")
+        self.assertEqual(results["broken.test"].value, "STATUS_ERR_WEBAPP_PROBLEM: Not Found")
+
+
+class ConfigTest(unittest.TestCase):
+
+    def test_first_overlapping_section_wins(self):
+        ini = configparser.ConfigParser()
+        ini.read_string("""
+[first]
+allhosts=b.example.com, c.example.com
+timeout=10
+[second]
+allhosts=a.example.com, b.example.com, d.example.com
+timeout=20
+""")
+        config = Checker._Config(ini, {"argv_0": "test"})
+        hosts = ["a.example.com", "b.example.com", "c.example.com", "d.example.com", "e.example.com"]
+        for allhosts in itertools.chain.from_iterable(itertools.permutations(hosts, n) for n in (2, 3)):
+            expected = 10 if {"b.example.com", "c.example.com"} & set(allhosts) else \
+                20 if {"a.example.com", "d.example.com"} & set(allhosts) else 300
+            self.assertEqual(config.get(frozenset(allhosts)).timeout, expected, allhosts)
+
+
+class ConfigReloadTest(unittest.TestCase):
+
+    CONFIG = "[_appglobal]\nsender_type=send\nsender_batch_size={}\nsender_linger={}\n"
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.service = CheckerService.__new__(CheckerService)  # Neither registry nor threads are needed
+        self.service.argv_0 = os.path.join(tmp_dir.name, "zabbix_IIS_checker.py")
+        self.service.configfile = os.path.join(tmp_dir.name, "zabbix_IIS_checker.ini")
+        self.write_config(self.CONFIG.format(100, 2))
+        self.service.cfg, self.service._config_hash = self.service._read_config()
+        for name, value in vars(self.service._parse_config(self.service.cfg)).items():
+            setattr(self.service, name, value)
+        self.service._config_fingerprint = self.service._config_new_fingerprint = self.service._get_config_fingerprint()
+
+    def write_config(self, config):
+        with open(self.service.configfile, "w") as f:
+            f.write(config)
+        os.utime(self.service.configfile, ns=(time.time_ns(), time.time_ns() + 1000000000))
+
+    def reload(self, config):
+        """
+        :return: the result of reloading the config once it has stopped changing
+        """
+        self.write_config(config)
+        self.assertIsNone(self.service._reload_config())
+        return self.service._reload_config()
+
+    def test_valid_sender_config_is_applied(self):
+        messages = self.reload(self.CONFIG.format(10, 0))
+        self.assertEqual((messages["sender"].data["batch_size"], messages["sender"].data["linger"]), (10, 0))
+        self.assertEqual(self.service.sender_params["batch_size"], 10)
+
+    def test_invalid_sender_config_is_rejected(self):
+        for batch_size, linger in [(0, 2), (-1, 2), (100, -1)]:
+            self.assertIsNone(self.reload(self.CONFIG.format(batch_size, linger)), (batch_size, linger))
+            self.assertEqual((self.service.sender_params["batch_size"], self.service.sender_params["linger"]), (100, 2))
+            with self.assertRaises(ValueError):
+                self.service._parse_config(self.service._read_config()[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
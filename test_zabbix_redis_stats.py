@@ -0,0 +1,107 @@
+import argparse
+import logging
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import zabbix_trapper
+import zabbix_redis_stats
+from zabbix_redis_stats import FakeRedis, load_instances
+
+
+def make_cmdargs(**kwargs):
+    """
+    :param kwargs: the command line args overriding the defaults
+    :return: parsed command line args
+    """
+    cmdargs = argparse.Namespace(config=None, rhost=None, rport=None, rtimeout=10, ewma=(900, 3600), sections=None,
+                                 props=None, latency=False, ping_interval=1, profile=False, profile_budget=100,
+                                 profile_sample=0.1, profile_depth=1, profile_delimiter=":", profile_top=20, zsrv=None,
+                                 zport=None, zcompress=None, zhost=None, interval=300, workers=16, action="send",
+                                 l="/dev/log", ll="WARNING", oneshot=True)
+    for name, value in kwargs.items():
+        setattr(cmdargs, name, value)
+    return cmdargs
+
+
+class MultiInstanceTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.servers = [FakeRedis(), FakeRedis()]
+        for server in self.servers:
+            self.addCleanup(server.close)
+        self.config = os.path.join(tmp_dir.name, "zabbix_redis_stats.ini")
+        with open(self.config, "w") as f:
+            f.write("[DEFAULT]\nhost={}\ntimeout=5\n"
+                    "[cache]\nzhost=cache.example.com\nport={}\n"
+                    "[sessions]\nport={}\nlatency=yes\nprops=used_memory,redis_version\n".format(
+                        self.servers[0].address[0], self.servers[0].address[1], self.servers[1].address[1]))
+
+    def load_instances(self, **kwargs):
+        instances = load_instances(make_cmdargs(config=self.config, **kwargs))
+        for instance in instances:
+            self.addCleanup(instance.close)
+        return instances
+
+    def run_main(self, **kwargs):
+        """
+        Runs the poller with the config file logging to nowhere
+        """
+        log = logging.getLogger()
+        level, handlers = log.level, list(log.handlers)
+        try:
+            with mock.patch("logging.handlers.SysLogHandler", return_value=logging.NullHandler()):
+                zabbix_redis_stats.do_main_program(make_cmdargs(config=self.config, **kwargs))
+        finally:
+            log.setLevel(level)
+            log.handlers[:] = handlers
+
+    def test_instances_are_loaded_from_config(self):
+        instances = self.load_instances(rtimeout=1)
+        self.assertEqual([(x.name, x.zhost, x.latency) for x in instances],
+                         [("cache", "cache.example.com", False), ("sessions", "sessions", True)])
+        self.assertEqual([x.pool.connection_kwargs["port"] for x in instances], [x.address[1] for x in self.servers])
+        self.assertEqual(instances[0].pool.connection_kwargs["socket_timeout"], 5)
+        self.assertEqual(instances[1].wanted_props, {"used_memory", "redis_version"})
+
+    def test_misconfigured_instance(self):
+        with open(self.config, "a") as f:
+            f.write("[broken]\nsections=clients\n")
+        with self.assertRaisesRegex(RuntimeError, "broken"):
+            load_instances(make_cmdargs(config=self.config))
+
+    def test_poll_cycle_sends_single_batch(self):
+        trapper = zabbix_trapper.FakeTrapper(keep_data=True)
+        self.addCleanup(trapper.close)
+        self.run_main(zsrv=trapper.address[0], zport=trapper.address[1])
+        self.assertEqual(trapper.requests, 1)
+        keys = dict()
+        for item in trapper.data[0]:
+            keys.setdefault(item["host"], set()).add(item["key"])
+        self.assertEqual(set(keys), {"cache.example.com", "sessions"})
+        for host in keys:
+            self.assertIn("redis.info._getting_stats_done", keys[host])
+            self.assertIn("redis.info.used_memory", keys[host])
+        self.assertIn("redis.info.connected_clients", keys["cache.example.com"])
+        self.assertNotIn("redis.info.connected_clients", keys["sessions"])
+        self.assertFalse(any(x.startswith("redis.latency.") for x in keys["cache.example.com"]))
+        self.assertTrue(any(x.startswith("redis.latency.") for x in keys["sessions"]))
+
+    def test_missed_deadline_does_not_stop_polling(self):
+        class Stop(Exception):
+            pass
+
+        with mock.patch("zabbix_redis_stats.time") as time_mock, \
+                mock.patch("zabbix_redis_stats.poll_instances", return_value=[]):
+            time_mock.monotonic.side_effect = [0.0, 9.999, 10.001]  # The deadline passes right after it's checked
+            time_mock.sleep.side_effect = Stop
+            with self.assertRaises(Stop):
+                self.run_main(oneshot=False, interval=10)
+        time_mock.sleep.assert_called_once_with(0.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
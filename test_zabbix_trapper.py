@@ -0,0 +1,53 @@
+import asyncio
+import unittest
+
+from zabbix_trapper import FakeTrapper, TrapperClient, TrapperError, TrapperPartialError
+
+
+class TrapperClientTest(unittest.TestCase):
+
+    ITEMS = [("host", "key[{}]".format(i), i, 100, 123) for i in range(5)]
+
+    def setUp(self):
+        self.trapper = FakeTrapper()
+        self.addCleanup(self.trapper.close)
+        self.client = TrapperClient(*self.trapper.address, timeout=5, chunk_size=2)
+
+    def test_items_are_sent_in_chunks(self):
+        result = self.client.send(self.ITEMS)
+        self.assertEqual((result.processed, result.total, result.chunks), (5, 5, 3))
+        self.assertEqual((self.trapper.requests, self.trapper.items), (3, 5))
+
+    def test_compressed(self):
+        self.client.compress_threshold = 0
+        self.assertEqual(self.client.send(self.ITEMS).total, 5)
+        self.assertEqual(self.trapper.items, 5)
+
+    def test_first_chunk_failure(self):
+        self.trapper.max_requests = 0
+        with self.assertRaises(TrapperError) as ctx:
+            self.client.send(self.ITEMS)
+        self.assertNotIsInstance(ctx.exception, TrapperPartialError)
+        self.assertEqual(self.trapper.items, 0)
+
+    def test_partial_failure_reports_items_sent(self):
+        self.trapper.max_requests = 2
+        with self.assertRaises(TrapperPartialError) as ctx:
+            self.client.send(self.ITEMS)
+        self.assertEqual(ctx.exception.sent, 4)
+        self.assertEqual((ctx.exception.result.total, ctx.exception.result.chunks), (4, 2))
+        self.trapper.max_requests = None
+        self.assertEqual(self.client.send(self.ITEMS[ctx.exception.sent:]).total, 1)
+        self.assertEqual(self.trapper.items, 5)
+
+    def test_partial_failure_reports_items_sent_async(self):
+        self.trapper.max_requests = 1
+        with self.assertRaises(TrapperPartialError) as ctx:
+            asyncio.run(self.client.send_async(self.ITEMS))
+        self.assertEqual(ctx.exception.sent, 2)
+        self.assertEqual(ctx.exception.result.total, 2)
+        self.assertEqual(self.trapper.items, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
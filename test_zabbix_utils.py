@@ -0,0 +1,20 @@
+import unittest
+
+from zabbix_utils import quote_key_param
+
+
+class QuoteKeyParamTest(unittest.TestCase):
+
+    def test_plain(self):
+        self.assertEqual(quote_key_param("user:session"), "user:session")
+        self.assertEqual(quote_key_param("a \"b\""), "a \"b\"")
+
+    def test_quoted(self):
+        self.assertEqual(quote_key_param("a,b"), "\"a,b\"")
+        self.assertEqual(quote_key_param("a]"), "\"a]\"")
+        self.assertEqual(quote_key_param(" a"), "\" a\"")
+        self.assertEqual(quote_key_param("\"a\",b"), "\"\\\"a\\\",b\"")
+
+
+if __name__ == "__main__":
+    unittest.main()
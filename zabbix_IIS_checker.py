@@ -1,11 +1,11 @@
 
 import queue
-import pyzabbix
+import zabbix_trapper
+import zabbix_utils
 import types
 import itertools
 import re
 import time
-import random
 import wmi
 import pythoncom
 import sys
@@ -16,11 +16,21 @@ import urllib.parse
 import configparser
 import pycurl
 import io
-import cgi
+import codecs
+import base64
+import hashlib
+import struct
 import threading
+import functools
 import concurrent.futures
+import asyncio
+import heapq
+import zlib
+import collections
+import enum
 import logging
 import math
+import random
 import argparse
 import win32api
 import win32con
@@ -32,10 +42,13 @@ from sys import exit
 _FILE_VER = "to_be_filled_by_CI"
 
 _IIS_PREF_PROTO = "https"
+_PS_EXE = "powershell"
 _WMI_IIS_MONIKER = "root/WebAdministration"
+_IIS_CONFIG = os.path.join(os.environ.get("windir", "C:\\Windows"), "System32", "inetsrv", "config", "applicationHost.config")
 _RETRY_TIMERS = [math.exp(x/10) for x in range(0, 25, 5)] + [0]
 
 
+
 class Utils:
 
     _U_HOSTLIST_SEPARATOR = ","
@@ -63,152 +76,631 @@ class Utils:
         return type(self)._U_HOSTLIST_SEPARATOR
 
 
-class Message:
+class MessageKind(enum.Enum):
+    PROCESS_DATA = 1
+    STOP_EXECUTION = 2
+    REGISTER_CLIENT = 3
+    DEREGISTER_CLIENT = 4
+    FORCE_STOP_EXECUTION = 5
+    RECONFIGURE = 6
 
-    _MSG_PROCESS_DATA = 0x1
-    _MSG_STOP_EXECUTION = 0x2
-    _MSG_REGISTER_CLIENT = 0x4
-    _MSG_DEREGISTER_CLIENT = 0x8
-    _MSG_FORCE_STOP_EXECUTION = 0x10
 
-    def __init__(self):
-        self._msg_type = 0x0
-        self._msg_data = None
+class Message(collections.namedtuple("Message", ["kind", "data"])):
+    """
+    A message put into a thread's command queue. Messages are immutable,
+    so the ones without data are created once and shared
+    """
 
-    def send_process_data(self, data):
-        self._msg_type = type(self)._MSG_PROCESS_DATA
-        if isinstance(data, list):
-            self._msg_data = data
-        else:
-            self._msg_data = [data]
-        return self
+    __slots__ = ()
 
-    @property
-    def process_data(self):
-        if self._msg_type & type(self)._MSG_PROCESS_DATA:
-            return [True, self._msg_data]
-        else:
-            return [False, None]
+    @classmethod
+    def process_data(cls, data=None):
+        """
+        :param data: a list of Result's instances for Sender, None for the others
+        """
+        return cls(MessageKind.PROCESS_DATA, data)
 
-    def send_stop_execution(self, data=None):
-        self._msg_type = type(self)._MSG_STOP_EXECUTION
-        self._msg_data = data
-        return self
+    @classmethod
+    def register_client(cls, name):
+        return cls(MessageKind.REGISTER_CLIENT, name)
 
-    @property
-    def stop_execution(self):
-        if self._msg_type & type(self)._MSG_STOP_EXECUTION:
-            return [True, None]
-        else:
-            return [False, None]
+    @classmethod
+    def deregister_client(cls, name):
+        return cls(MessageKind.DEREGISTER_CLIENT, name)
 
-    def send_register_client(self, data):
-        self._msg_type = type(self)._MSG_REGISTER_CLIENT
-        self._msg_data = data
-        return self
+    @classmethod
+    def reconfigure(cls, params):
+        """
+        :param params: a dict of keyword arguments of the receiver's configure method
+        """
+        return cls(MessageKind.RECONFIGURE, params)
 
-    @property
-    def register_client(self):
-        if self._msg_type & type(self)._MSG_REGISTER_CLIENT:
-            return [True, self._msg_data]
-        else:
-            return [False, None]
 
-    def send_deregister_client(self, data):
-        self._msg_type = type(self)._MSG_DEREGISTER_CLIENT
-        self._msg_data = data
-        return self
+Message.REQUEST = Message.process_data()
+Message.STOP_EXECUTION = Message(MessageKind.STOP_EXECUTION, None)
+Message.FORCE_STOP_EXECUTION = Message(MessageKind.FORCE_STOP_EXECUTION, None)
 
-    @property
-    def deregister_client(self):
-        if self._msg_type & type(self)._MSG_DEREGISTER_CLIENT:
-            return [True, self._msg_data]
-        else:
-            return [False, None]
 
-    def send_force_stop_execution(self, data=None):
-        self._msg_type = type(self)._MSG_FORCE_STOP_EXECUTION
-        self._msg_data = data
-        return self
+class Result(collections.namedtuple("Result", ["name", "key", "value", "info", "error", "clock_ns"])):
+    """
+    A piece of data collected to be sent to Zabbix:
+    data name (e.g. IIS site name), Zabbix key, Zabbix value, optional info (e.g. verbose Curl output),
+    optional exception the value could not be collected (or has been collected) due to and the time it was collected at
+    """
 
-    @property
-    def force_stop_execution(self):
-        if self._msg_type & type(self)._MSG_FORCE_STOP_EXECUTION:
-            return [True, None]
-        else:
-            return [False, None]
+    __slots__ = ()
+
+    @classmethod
+    def make(cls, name, key, value, info=None, error=None):
+        """
+        :return: a Result's instance stamped with the current time
+        """
+        return cls(name, key, value, info, error, time.time_ns())
+
+
+class Metrics:
+    """
+    Self-instrumentation of the checker: counters, gauges and histograms updated by Discoverer, Checker and Sender
+    and published as Zabbix items along with the pulse. Counters and gauges are published as <prefix>.<name>,
+    histograms as <prefix>.<name>[count|avg|max|p95] summarizing the observations made since the previous publication.
+    The instance is shared by the threads, so the updates are serialized with a lock
+    """
+
+    HISTOGRAM_SAMPLES = 1024  # max number of the observations kept for the percentile (reservoir sampling)
+
+    def __init__(self, prefix="iis.checker"):
+        """
+        :param prefix: Zabbix key prefix of the items
+        """
+        self._prefix = prefix
+        self._lock = threading.Lock()
+        self._values = dict()  # counters and gauges: name -> value
+        self._histograms = dict()  # name -> [count, sum, max, samples]
+
+    def declare(self, counters=(), histograms=()):
+        """
+        Makes the metrics published even if they have not been updated yet
+        :param counters: names of the counters
+        :param histograms: names of the histograms
+        """
+        with self._lock:
+            for name in counters:
+                self._values.setdefault(name, 0)
+            for name in histograms:
+                self._histograms.setdefault(name, [0, 0, 0, []])
+
+    def inc(self, name, value=1):
+        """
+        :return: the new value of the counter
+        """
+        with self._lock:
+            value = self._values[name] = self._values.get(name, 0) + value
+        return value
+
+    def set(self, name, value):
+        with self._lock:
+            self._values[name] = value
+
+    def observe(self, name, value):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = [0, 0, 0, []]
+            histogram[0] += 1
+            histogram[1] += value
+            histogram[2] = max(histogram[2], value)
+            if len(histogram[3]) < type(self).HISTOGRAM_SAMPLES:
+                histogram[3].append(value)
+            else:
+                i = random.randrange(histogram[0])
+                if i < type(self).HISTOGRAM_SAMPLES:
+                    histogram[3][i] = value
+
+    def collect(self, name):
+        """
+        Takes a snapshot of the metrics. The histograms are reset
+        :param name: data name of the Result's instances
+        :return: a list of Result's instances
+        """
+        with self._lock:
+            values = dict(self._values)
+            histograms = self._histograms
+            self._histograms = {x: [0, 0, 0, []] for x in histograms}
+        rv = [Result.make(name, "{}.{}".format(self._prefix, x), value) for x, value in sorted(values.items())]
+        for x, (count, total, maximum, samples) in sorted(histograms.items()):
+            samples.sort()
+            for stat, value in (("count", count),
+                                ("avg", total / count if count else 0),
+                                ("max", maximum),
+                                ("p95", samples[math.ceil(len(samples) * 0.95) - 1] if samples else 0)):
+                rv.append(Result.make(name, "{}.{}[{}]".format(self._prefix, x, stat), value))
+        return rv
+
+
+class Spool:
+    """
+    On-disk journal of the data which could not be sent to Zabbix server.
+    Every record is a batch of items appended to the file as <payload length><time written><payload>,
+    where payload is JSON list of [Zabbix host, Zabbix key, Zabbix value, clock, ns] items.
+    Records are kept in memory as well, the file is re-written when records are removed.
+    """
+
+    _HEADER = struct.Struct("<IQ")
+
+    def __init__(self, filename, max_size=10485760, max_age=86400):
+        """
+        :param filename: journal file name
+        :param max_size: max size of the journal (bytes). The oldest records are dropped to fit it
+        :param max_age: max age of a record (seconds). Older records are dropped
+        """
+        self._filename = filename
+        self._max_size = max_size
+        self._max_age = max_age
+        self._lock = threading.Lock()
+        self._records = list()  # list of [time written, payload]
+        self._size = 0
+        try:
+            with open(self._filename, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b""
+        offset = 0
+        while offset + self._HEADER.size <= len(data):
+            length, written = self._HEADER.unpack_from(data, offset)
+            payload = data[offset + self._HEADER.size:offset + self._HEADER.size + length]
+            if len(payload) < length:
+                logging.warning("Spool {} has a truncated record at offset {}. Dropping it".format(self._filename, offset))
+                break
+            self._records.append([written, payload])
+            self._size += self._HEADER.size + length
+            offset += self._HEADER.size + length
+        if self._records:
+            logging.warning("Spool {} has {} unsent record(s)".format(self._filename, len(self._records)))
+        if offset != len(data):
+            self._rewrite()
+
+    def _rewrite(self):
+        tmp_filename = "{}.tmp".format(self._filename)
+        with open(tmp_filename, "wb") as f:
+            for written, payload in self._records:
+                f.write(self._HEADER.pack(len(payload), written))
+                f.write(payload)
+        os.replace(tmp_filename, self._filename)
+
+    def _expire(self):
+        """
+        Drops the records which are too old or don't fit the max size. Returns True if any has been dropped
+        """
+        dropped = 0
+        min_written = int(time.time()) - self._max_age
+        while self._records and (self._records[0][0] < min_written or self._size > self._max_size):
+            written, payload = self._records.pop(0)
+            self._size -= self._HEADER.size + len(payload)
+            dropped += 1
+        if dropped:
+            logging.warning("Dropped {} spooled record(s) exceeding the spool's age or size limits".format(dropped))
+        return dropped > 0
+
+    def __len__(self):
+        return len(self._records)
+
+    @staticmethod
+    def _encode(items):
+        return json.dumps([[x[0], x[1], str(x[2])] + list(x[3:]) for x in items], separators=(",", ":")).encode("utf-8")
+
+    def append(self, items):
+        """
+        :param items: a list of tuples: (Zabbix host, Zabbix key, Zabbix value, clock, ns)
+        """
+        payload = self._encode(items)
+        record = [int(time.time()), payload]
+        with self._lock:
+            self._records.append(record)
+            self._size += self._HEADER.size + len(payload)
+            if self._expire():
+                self._rewrite()
+            else:
+                with open(self._filename, "ab") as f:
+                    f.write(self._HEADER.pack(len(payload), record[0]))
+                    f.write(payload)
+
+    def peek(self):
+        """
+        :return: a list of records, the oldest first. A record is a list of items as passed to append()
+        """
+        with self._lock:
+            if self._expire():
+                self._rewrite()
+            return [(record, json.loads(record[1].decode("utf-8"))) for record in self._records]
+
+    def remove(self, records, partial=None):
+        """
+        :param records: records (as returned by peek) to be removed
+        :param partial: a tuple: (record as returned by peek, number of items) to remove the first items of the record
+        """
+        with self._lock:
+            records = set(id(x[0]) for x in records)
+            kept = [x for x in self._records if id(x) not in records]
+            changed = len(kept) != len(self._records)
+            if partial is not None and partial[1] > 0 and any(x is partial[0][0] for x in kept):
+                partial[0][0][1] = self._encode(partial[0][1][partial[1]:])
+                changed = True
+            if changed:
+                self._records = kept
+                self._size = sum(self._HEADER.size + len(x[1]) for x in kept)
+                self._rewrite()
 
 
 class Sender(Utils):
 
     _allowed_types = {"print", "send"}
+    _SPOOL_RETRY_MIN = 5  # the first delay (seconds) of re-sending the spooled data, it's doubled on every failure
+    _SPOOL_RETRY_MAX = 300
 
-    def __init__(self, q, sender_type="print", zbx_srv="127.0.0.1", zbx_port=10051, zbx_host=None):
+    def __init__(self, q, sender_type="print", zbx_srv="127.0.0.1", zbx_port=10051, zbx_host=None,
+                 batch_size=1000, linger=2, spool=None, compress_threshold=None, metrics=None):
+        """
+        :param q: command queue
+        :param sender_type: "print" or "send"
+        :param zbx_srv: Zabbix server name or address
+        :param zbx_port: Zabbix server port
+        :param zbx_host: Zabbix host the data belongs to
+        :param batch_size: max number of items sent at once
+        :param linger: max time (seconds) an item waits in a batch before the batch is sent
+        :param spool: a Spool's instance to keep the data which could not be sent. If None, sending is re-tried in place
+        :param compress_threshold: data size (bytes) starting from which the data is compressed. None means never
+        :param metrics: a Metrics' instance to be updated with Sender's metrics
+        """
         self.validate_value(sender_type, type(self)._allowed_types, "sender type")
         self.sender_type = sender_type
         self.q = q
+        self.spool = spool
+        self._metrics = metrics if metrics is not None else Metrics()
+        self._metrics.declare(counters=("sender.sent", "sender.rejected", "sender.failures", "sender.retries", "sender.spooled"),
+                              histograms=("sender.queue", "sender.send_time"))
+        self._zbx_down = threading.Event()  # set if sending has failed, cleared when the spooled data has been sent
+        self._replay_stop = threading.Event()
+        self.configure(zbx_srv, zbx_port, zbx_host, batch_size, linger, compress_threshold)
+
+    def configure(self, zbx_srv="127.0.0.1", zbx_port=10051, zbx_host=None, batch_size=1000, linger=2, compress_threshold=None):
+        """
+        Sets the parameters which may be changed while running (see __init__ for their description)
+        """
         self.zbx_srv = zbx_srv
         self.zbx_port = zbx_port
         self.zbx_host = zbx_host
+        self.batch_size = batch_size
+        self.linger = linger
+        self._trapper = zabbix_trapper.TrapperClient(zbx_srv, zbx_port, chunk_size=batch_size,
+                                                     compress_threshold=compress_threshold)
 
-    def run(self):
-        clients = set()
-        stop = False
+    def _zbx_send(self, items):
+        """
+        :param items: a list of tuples: (Zabbix host, Zabbix key, Zabbix value, clock, ns)
+        :return: the items which have not been sent, an empty list if all the data has been sent
+        """
+        started = time.monotonic()
         try:
-            while True:
-                if not stop or clients:
-                    msg = self.q.get()
+            result = self._trapper.send(items)
+        except Exception as exc:
+            return self._log_failed(items, exc, time.monotonic() - started)
+        self._log_sent(result, time.monotonic() - started)
+        return []
+
+    async def _zbx_send_async(self, items):
+        """
+        Coroutine counterpart of _zbx_send
+        """
+        started = time.monotonic()
+        try:
+            result = await self._trapper.send_async(items)
+        except (OSError, asyncio.TimeoutError, zabbix_trapper.TrapperError, ValueError) as exc:
+            return self._log_failed(items, exc, time.monotonic() - started)
+        self._log_sent(result, time.monotonic() - started)
+        return []
+
+    def _log_failed(self, items, exc, send_time):
+        """
+        :param items: the items passed to TrapperClient.send
+        :param exc: the exception sending has failed due to
+        :param send_time: how long the sending took (seconds)
+        :return: the items which have not been sent
+        """
+        logging.error("Couldn't send data: {}".format(str(exc) or "timeout"))
+        self._metrics.inc("sender.failures")
+        if isinstance(exc, zabbix_trapper.TrapperPartialError):  # The chunks accepted by the server are not re-sent
+            self._log_sent(exc.result, send_time)
+            return items[exc.sent:]
+        return items
+
+    def _log_sent(self, result, send_time):
+        """
+        :param result: a result of TrapperClient.send
+        :param send_time: how long the sending took (seconds)
+        """
+        logging.debug("Sent data: {}".format(result))
+        if result.failed:
+            logging.warning("Zabbix server has failed to process {} of {} item(s)".format(result.failed, result.total))
+        self._metrics.inc("sender.sent", result.total)
+        self._metrics.inc("sender.rejected", result.failed)
+        self._metrics.observe("sender.send_time", send_time)
+
+    def _replay_spool(self):
+        failures = 0
+        while not self._replay_stop.wait(min(type(self)._SPOOL_RETRY_MIN * 2 ** failures, type(self)._SPOOL_RETRY_MAX)):
+            records = self.spool.peek()
+            sent = list()  # removed from the spool at once when the pass is over
+            partial = None  # the record which has been sent partially and the number of its items sent
+            for record in records:
+                if self._replay_stop.is_set():
+                    break
+                unsent = self._zbx_send(record[1])
+                if not unsent:
+                    sent.append(record)
+                    failures = 0
                 else:
-                    try:
-                        msg = self.q.get_nowait()
-                    except queue.Empty:
+                    partial = (record, len(record[1]) - len(unsent))
+                    failures = min(failures + 1, 10)
+                    break
+            self.spool.remove(sent, partial)
+            if len(sent) < len(records):
+                logging.info("Spooled data was not sent. {} record(s) left".format(len(self.spool)))
+            else:
+                if records:
+                    logging.info("Spooled data has been sent")
+                self._zbx_down.clear()
+
+    async def _replay_spool_async(self):
+        """
+        Coroutine counterpart of _replay_spool. It's cancelled to stop
+        """
+        failures = 0
+        while True:
+            await asyncio.sleep(min(type(self)._SPOOL_RETRY_MIN * 2 ** failures, type(self)._SPOOL_RETRY_MAX))
+            records = self.spool.peek()
+            sent = list()  # removed from the spool at once when the pass is over
+            partial = None  # the record which has been sent partially and the number of its items sent
+            try:
+                for record in records:
+                    unsent = await self._zbx_send_async(record[1])
+                    if not unsent:
+                        sent.append(record)
+                        failures = 0
+                    else:
+                        partial = (record, len(record[1]) - len(unsent))
+                        failures = min(failures + 1, 10)
                         break
-                if msg.process_data[0]:
-                    if self.sender_type == "print":
-                        for data in msg.process_data[1]:
-                            logging.debug("Got message: {}".format(data))
-                            if len(data) >= 4 and isinstance(data[3], io.BytesIO):
-                                logging.debug("Got buffer: {}".format(data[3].getvalue().decode("ASCII", errors="ignore")))
-                                print(data[0:3])
-                                print(data[3].getvalue().decode("ASCII", errors="ignore"))  # "ignore" might not be the best handler
-                            else:
-                                print(data)
-                    elif self.sender_type == "send":
-                        zbx_packet = list()
-                        for data in msg.process_data[1]:
-                            logging.debug("Got message: {}".format(data))
-                            if len(data) >= 4 and isinstance(data[3], io.BytesIO):
-                                logging.debug("Got buffer: {}".format(data[3].getvalue().decode("ASCII", errors="ignore")))
-                            zbx_packet.append(pyzabbix.ZabbixMetric(self.zbx_host, data[1], data[2]))  # data[1] is Zabbis key and data[2] is Zabbix value,
-                                                                                                       # data[0] is data name (e.g. IIS site name) and data[3] is optional info (e.g. verbose Curl output)
-                        sent = False
-                        retry_counter = 0
-                        for retry_timer in _RETRY_TIMERS:
-                            try:
-                                retry_counter += 1
-                                pyzabbix.ZabbixSender(self.zbx_srv, self.zbx_port).send(zbx_packet)
-                            except Exception:
-                                logging.exception("Couldn't send data")
-                                logging.info("Re-trying in {} secs".format(retry_timer))
-                                time.sleep(retry_timer)
-                            else:
-                                sent = True
-                                break
-                        if not sent:
-                            logging.warning("The data was not sent after {} tries".format(retry_counter))
-                elif msg.register_client[0]:
-                    clients.add(msg.register_client[1])
-                elif msg.deregister_client[0]:
-                    try:
-                        clients.remove(msg.deregister_client[1])
-                    except KeyError:
-                        pass
-                elif msg.stop_execution[0]:
-                    stop = True
-                elif msg.force_stop_execution[0]:
+            finally:  # Cancelled when stopping
+                self.spool.remove(sent, partial)
+            if len(sent) < len(records):
+                logging.info("Spooled data was not sent. {} record(s) left".format(len(self.spool)))
+            else:
+                if records:
+                    logging.info("Spooled data has been sent")
+                self._zbx_down.clear()
+
+    def _make_items(self, batch):
+        """
+        :param batch: a list of Result's instances
+        :return: a list of items to be sent to Zabbix. None if the batch is printed instead
+        """
+        if self.sender_type == "print":
+            for data in batch:
+                logging.debug("Got message: {}".format(data))
+                if data.info is not None:
+                    logging.debug("Got buffer: {}".format(data.info.getvalue().decode("ASCII", errors="ignore")))
+                    print(data[0:3])
+                    print(data.info.getvalue().decode("ASCII", errors="ignore"))  # "ignore" might not be the best handler
+                else:
+                    print(data[0:3])
+        elif self.sender_type == "send":
+            items = list()
+            for data in batch:
+                logging.debug("Got message: {}".format(data))
+                if data.info is not None:
+                    logging.debug("Got buffer: {}".format(data.info.getvalue().decode("ASCII", errors="ignore")))
+                items.append((self.zbx_host, data.key, data.value) + divmod(data.clock_ns, 1000000000))
+            logging.debug("Sending {} item(s)".format(len(items)))
+            return items
+        return None
+
+    def _send(self, batch):
+        """
+        :param batch: a list of Result's instances
+        """
+        self._metrics.observe("sender.queue", self.q.qsize())
+        items = self._make_items(batch)
+        if items is not None:
+            if self.spool is not None:
+                if self._zbx_down.is_set():
+                    logging.info("Zabbix server is unavailable. Spooling {} item(s)".format(len(items)))
+                    self.spool.append(items)
+                    self._metrics.inc("sender.spooled", len(items))
+                else:
+                    unsent = self._zbx_send(items)
+                    if unsent:
+                        logging.warning("Spooling {} item(s)".format(len(unsent)))
+                        self._zbx_down.set()
+                        self.spool.append(unsent)
+                        self._metrics.inc("sender.spooled", len(unsent))
+            else:
+                sent = False
+                retry_counter = 0
+                for retry_timer in _RETRY_TIMERS:
+                    retry_counter += 1
+                    items = self._zbx_send(items)
+                    if not items:
+                        sent = True
+                        break
+                    logging.info("Re-trying in {} secs".format(retry_timer))
+                    self._metrics.inc("sender.retries")
+                    time.sleep(retry_timer)
+                if not sent:
+                    logging.warning("The data was not sent after {} tries".format(retry_counter))
+
+    async def _send_async(self, batch):
+        """
+        Coroutine counterpart of _send
+        """
+        self._metrics.observe("sender.queue", self.q.qsize())
+        items = self._make_items(batch)
+        if items is not None:
+            if self.spool is not None:
+                if self._zbx_down.is_set():
+                    logging.info("Zabbix server is unavailable. Spooling {} item(s)".format(len(items)))
+                    self.spool.append(items)
+                    self._metrics.inc("sender.spooled", len(items))
+                else:
+                    unsent = await self._zbx_send_async(items)
+                    if unsent:
+                        logging.warning("Spooling {} item(s)".format(len(unsent)))
+                        self._zbx_down.set()
+                        self.spool.append(unsent)
+                        self._metrics.inc("sender.spooled", len(unsent))
+            else:
+                retry_counter = 0
+                for retry_timer in _RETRY_TIMERS:
+                    retry_counter += 1
+                    items = await self._zbx_send_async(items)
+                    if not items:
+                        break
+                    logging.info("Re-trying in {} secs".format(retry_timer))
+                    self._metrics.inc("sender.retries")
+                    await asyncio.sleep(retry_timer)
+                else:
+                    logging.warning("The data was not sent after {} tries".format(retry_counter))
+
+    def _on_process_data(self, data):
+        if not self._batch:
+            self._batch_deadline = time.monotonic() + self.linger
+        self._batch.extend(data)
+        while len(self._batch) >= self.batch_size:
+            self._send(self._batch[:self.batch_size])
+            self._batch = self._batch[self.batch_size:]
+            self._batch_deadline = time.monotonic() + self.linger
+
+    def _on_register_client(self, name):
+        self._clients.add(name)
+
+    def _on_deregister_client(self, name):
+        self._clients.discard(name)
+
+    def _on_stop_execution(self, data):
+        self._stop = True
+
+    def _on_force_stop_execution(self, data):
+        return True
+
+    def _on_reconfigure(self, params):
+        self.configure(**params)
+        logging.info("New configuration has been applied")
+
+    def run(self):
+        """
+        Messages are dispatched to the _on_<message kind> handlers. A handler returns True to end the run loop
+        """
+        self._clients = set()
+        self._stop = False
+        self._batch = list()
+        self._batch_deadline = None  # when the batch has to be sent regardless of its size
+        handlers = {kind: getattr(self, "_on_" + kind.name.lower()) for kind in MessageKind}
+        if self.spool is not None and self.sender_type == "send":
+            treplayer = threading.Thread(target=self._replay_spool, name="SpoolReplayer", daemon=True)
+            treplayer.start()
+        else:
+            treplayer = None
+        try:
+            while True:
+                try:
+                    if not self._stop or self._clients:
+                        if self._batch:
+                            msg = self.q.get(timeout=max(0, self._batch_deadline - time.monotonic()))
+                        else:
+                            msg = self.q.get()
+                    else:
+                        try:
+                            msg = self.q.get_nowait()
+                        except queue.Empty:
+                            break
+                except queue.Empty:  # the batch has lingered long enough
+                    self._send(self._batch)
+                    self._batch = list()
+                    continue
+                if handlers[msg.kind](msg.data):
                     break
         except:
             logging.exception("Unexpected exception in the run loop")
+        finally:
+            if self._batch:
+                try:
+                    self._send(self._batch)
+                except:
+                    logging.exception("Unexpected exception while sending the last batch")
+            if treplayer is not None:
+                self._replay_stop.set()
+                treplayer.join()
+
+    async def _get_async(self, timeout):
+        """
+        Gets a message from the command queue. Unlike asyncio.wait_for, it never swallows cancellation
+        :param timeout: how long to wait for a message (seconds), None means forever
+        :return: a message or None if the timeout has expired
+        """
+        getter = asyncio.ensure_future(self.q.get())
+        try:
+            done, pending = await asyncio.wait([getter], timeout=timeout)
+        except asyncio.CancelledError:
+            if getter.done() and not getter.cancelled():
+                self.q.put_nowait(getter.result())  # The queue is drained when cancelled
+            else:
+                getter.cancel()
+            raise
+        if not done:
+            getter.cancel()
+            return None
+        return getter.result()
+
+    async def run_async(self):
+        """
+        Coroutine counterpart of run for the asyncio runtime. The command queue is an asyncio.Queue of messages
+        with data to be sent. The coroutine is cancelled to stop, the last batch is sent anyway
+        """
+        batch = list()
+        batch_deadline = None  # when the batch has to be sent regardless of its size
+        if self.spool is not None and self.sender_type == "send":
+            replayer = asyncio.ensure_future(self._replay_spool_async())
+        else:
+            replayer = None
+        try:
+            while True:
+                msg = await self._get_async(max(0, batch_deadline - time.monotonic()) if batch else None)
+                if msg is None:  # the batch has lingered long enough
+                    await self._send_async(batch)
+                    batch = list()
+                    continue
+                if msg.kind is MessageKind.RECONFIGURE:
+                    self._on_reconfigure(msg.data)
+                if msg.kind is not MessageKind.PROCESS_DATA:
+                    continue
+                if not batch:
+                    batch_deadline = time.monotonic() + self.linger
+                batch.extend(msg.data)
+                while len(batch) >= self.batch_size:
+                    await self._send_async(batch[:self.batch_size])
+                    batch = batch[self.batch_size:]
+                    batch_deadline = time.monotonic() + self.linger
+        finally:
+            if replayer is not None:
+                replayer.cancel()
+            while not self.q.empty():  # the data put before cancellation
+                msg = self.q.get_nowait()
+                if msg.kind is MessageKind.PROCESS_DATA:
+                    batch.extend(msg.data)
+            if batch:
+                try:
+                    await self._send_async(batch)
+                except Exception:
+                    logging.exception("Unexpected exception while sending the last batch")
 
 
 class IIS_site_info:
@@ -246,6 +738,7 @@ class IIS_site_info:
             self.bindings.append(binding)
         if self.pref_binding is None:
             self.pref_binding = self.bindings[-1]
+        self.hostnames = frozenset([x["host"].lower() for x in self.bindings])
 
     def get_orig_obj(self):
         return self.orig_obj
@@ -262,6 +755,12 @@ class IIS_site_info:
     def get_normalised_hostnames(self):
         return sorted(set([x["host"] for x in self.bindings]))
 
+    def get_hostnames(self):
+        """
+        :return: a frozenset of the lower-cased host names bound to the site
+        """
+        return self.hostnames
+
     def get_pref_binding(self):
         return self.pref_binding
 
@@ -292,16 +791,416 @@ class WrappedList:  # This class is used to define IIS_sites (see below)
     def add(self, site):
         self._items.append(site)
 
+    def set(self, sites):
+        self._items = list(sites)
+
     def get(self):
         return self._items
 
 
+class Scheduler:
+    """
+    Schedule of periodic jobs kept in a heap by their next due time. A job is due at <time it was set> + <offset> + N * <interval>,
+    so the schedule doesn't drift no matter how long the jobs take. The runs missed because a job was late
+    for more than its interval are skipped and counted as overruns
+    """
+
+    def __init__(self, clock=time.monotonic):
+        """
+        :param clock: a function returning the current time (seconds)
+        """
+        self._clock = clock
+        self._heap = list()  # (due time, sequence number, key). Entries of removed or re-set jobs are dropped lazily
+        self._jobs = dict()  # key -> (interval, offset, sequence number of the valid heap entry)
+        self._seq = itertools.count()
+        self.overruns = 0  # number of runs skipped since the scheduler was created
+
+    @staticmethod
+    def jitter(name, window):
+        """
+        :param name: a job's name
+        :param window: max jitter (seconds)
+        :return: a deterministic offset between 0 and window derived from the name's hash
+        """
+        return zlib.crc32(name.encode("utf-8")) / 0xffffffff * window
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def __contains__(self, key):
+        return key in self._jobs
+
+    def set(self, key, interval, offset=0):
+        """
+        Adds a job or re-schedules it if its interval or offset has changed. Unchanged jobs keep their schedule
+        :param key: a job's key
+        :param interval: the job's interval (seconds)
+        :param offset: delay (seconds) before the job's first run
+        """
+        job = self._jobs.get(key)
+        if job is not None and job[:2] == (interval, offset):
+            return
+        seq = next(self._seq)
+        self._jobs[key] = (interval, offset, seq)
+        heapq.heappush(self._heap, (self._clock() + offset, seq, key))
+
+    def discard(self, key):
+        self._jobs.pop(key, None)
+
+    def sync(self, jobs):
+        """
+        Makes the schedule consist of the jobs given
+        :param jobs: a dict of key -> (interval, offset)
+        """
+        for key in set(self._jobs) - set(jobs):
+            self.discard(key)
+        for key, job in jobs.items():
+            self.set(key, *job)
+
+    def _drop_stale(self):
+        while self._heap and self._jobs.get(self._heap[0][2], (None, None, None))[2] != self._heap[0][1]:
+            heapq.heappop(self._heap)
+
+    def next_due(self):
+        """
+        :return: the time the next job is due at or None if there are no jobs
+        """
+        self._drop_stale()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self):
+        """
+        Picks the jobs which are due and schedules their next runs
+        :return: a list of keys of the jobs due
+        """
+        now = self._clock()
+        rv = list()
+        self._drop_stale()
+        while self._heap and self._heap[0][0] <= now:
+            due, seq, key = heapq.heappop(self._heap)
+            interval, offset = self._jobs[key][:2]
+            missed = int((now - due) // interval)
+            if missed:
+                self.overruns += missed
+                logging.warning("{} is late for {:.1f} seconds. Skipping {} run(s)".format(key, now - due, missed))
+            seq = next(self._seq)
+            self._jobs[key] = (interval, offset, seq)
+            heapq.heappush(self._heap, (due + (missed + 1) * interval, seq, key))
+            rv.append(key)
+            self._drop_stale()
+        return rv
+
+
+class PSHostError(RuntimeError):
+    pass
+
+
+class PSHost:
+    """
+    Long-lived PowerShell process which runs commands sent over its STDIN.
+    A command is sent as a line "<id> <base64 of UTF-8 command text>".
+    A result is returned as a header line "<id> <OK|ERR> <length>" followed by <length> bytes of UTF-8 output.
+    The host is started on the first command and re-spawned if it dies or a command times out.
+    """
+
+    _PS_HOST_SCRIPT = """
+$ErrorActionPreference = "Stop"
+$stdin = [Console]::In
+$stdout = [Console]::OpenStandardOutput()
+while ($null -ne ($line = $stdin.ReadLine())) {
+    $cmd_id, $cmd = $line.Split(" ", 2)
+    try {
+        $out = (Invoke-Expression ([Text.Encoding]::UTF8.GetString([Convert]::FromBase64String($cmd)))) -join "`n"
+        $status = "OK"
+    } catch {
+        $out = [string]$_
+        $status = "ERR"
+    }
+    $body = [Text.Encoding]::UTF8.GetBytes($out)
+    $header = [Text.Encoding]::ASCII.GetBytes("$cmd_id $status $($body.Length)`n")
+    $stdout.Write($header, 0, $header.Length)
+    $stdout.Write($body, 0, $body.Length)
+    $stdout.Flush()
+}
+"""
+
+    def __init__(self, ps_exe=_PS_EXE, timeout=60, cmd=None):
+        """
+        :param ps_exe: PowerShell executable
+        :param timeout: default command timeout (seconds)
+        :param cmd: the host's command line. By default, it is PowerShell running the host script.
+        Any other process talking the same protocol may be used instead (e.g. for testing purposes)
+        """
+        if cmd is None:
+            cmd = [
+                ps_exe,
+                "-NoProfile",
+                "-NonInteractive",
+                "-ExecutionPolicy", "Bypass",
+                "-EncodedCommand", base64.b64encode(type(self)._PS_HOST_SCRIPT.encode("utf-16-le")).decode("ascii")]
+        self._cmd = cmd
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._proc = None
+        self._results = None
+        self._cmd_id = 0
+
+    @staticmethod
+    def _read(stdout, results):
+        try:
+            while True:
+                header = stdout.readline()
+                if not header:
+                    break
+                cmd_id, status, length = header.decode("ascii").split()
+                results.put((int(cmd_id), status, stdout.read(int(length)).decode("utf-8")))
+        except Exception:
+            logging.exception("Could not read PowerShell host output")
+        finally:
+            results.put(None)  # EOF mark
+
+    def _spawn(self):
+        logging.debug("Starting PowerShell host")
+        self._proc = subprocess.Popen(self._cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self._results = queue.Queue()
+        threading.Thread(target=self._read, args=(self._proc.stdout, self._results), name="PSHostReader",
+                         daemon=True).start()
+
+    def _kill(self):
+        if self._proc is not None:
+            try:
+                self._proc.kill()
+            except OSError:
+                pass
+            self._proc.wait()
+            self._proc.stdin.close()
+            self._proc.stdout.close()
+            self._proc = None
+
+    def run(self, command, timeout=None):
+        """
+        :param command: PowerShell command to be run
+        :param timeout: command timeout (seconds). The host is killed if the command doesn't complete in time
+        :return: the command's output (str)
+        """
+        timeout = self._timeout if timeout is None else timeout
+        with self._lock:
+            for retry_counter in range(2):  # the host might have died since the last command, so give it a second chance
+                if self._proc is None or self._proc.poll() is not None:
+                    if self._proc is not None:
+                        logging.warning("PowerShell host has died with exit code {}. Re-spawning".format(self._proc.returncode))
+                        self._kill()
+                    self._spawn()
+                self._cmd_id += 1
+                try:
+                    self._proc.stdin.write("{} {}\n".format(
+                        self._cmd_id, base64.b64encode(command.encode("utf-8")).decode("ascii")).encode("ascii"))
+                    self._proc.stdin.flush()
+                except OSError:
+                    self._kill()
+                else:
+                    break
+            else:
+                raise PSHostError("Could not send the command to PowerShell host")
+            deadline = time.monotonic() + timeout
+            while True:
+                try:
+                    result = self._results.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    self._kill()
+                    raise PSHostError("PowerShell host did not complete the command in {} seconds".format(timeout))
+                if result is None:
+                    self._kill()
+                    raise PSHostError("PowerShell host died while running the command")
+                if result[0] == self._cmd_id:
+                    break
+            if result[1] != "OK":
+                raise PSHostError(result[2])
+            return result[2]
+
+    def close(self):
+        with self._lock:
+            if self._proc is not None:
+                try:
+                    self._proc.stdin.close()
+                    self._proc.wait(timeout=5)
+                except (OSError, subprocess.TimeoutExpired):
+                    pass
+            self._kill()
+
+
+class AsyncPSHost(PSHost):
+    """
+    Coroutine counterpart of PSHost for the asyncio runtime. The host runs as an asyncio subprocess,
+    so no reader thread is needed. Its methods are coroutines
+    """
+
+    def __init__(self, ps_exe=_PS_EXE, timeout=60, cmd=None):
+        super().__init__(ps_exe, timeout, cmd)
+        self._lock = None  # asyncio.Lock is created in the event loop it is used in
+
+    async def _spawn(self):
+        logging.debug("Starting PowerShell host")
+        self._proc = await asyncio.create_subprocess_exec(*self._cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                                          stderr=subprocess.DEVNULL)
+
+    async def _kill(self):
+        if self._proc is not None:
+            try:
+                self._proc.kill()
+            except OSError:
+                pass
+            await self._proc.wait()
+            self._proc = None
+
+    async def _read(self):
+        """
+        :return: a tuple: (command id, status, output)
+        """
+        cmd_id, status, length = (await self._proc.stdout.readline()).decode("ascii").split()
+        return int(cmd_id), status, (await self._proc.stdout.readexactly(int(length))).decode("utf-8")
+
+    async def run(self, command, timeout=None):
+        """
+        :param command: PowerShell command to be run
+        :param timeout: command timeout (seconds). The host is killed if the command doesn't complete in time
+        or the coroutine is cancelled
+        :return: the command's output (str)
+        """
+        timeout = self._timeout if timeout is None else timeout
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            for retry_counter in range(2):  # the host might have died since the last command, so give it a second chance
+                if self._proc is None or self._proc.returncode is not None:
+                    if self._proc is not None:
+                        logging.warning("PowerShell host has died with exit code {}. Re-spawning".format(self._proc.returncode))
+                        await self._kill()
+                    await self._spawn()
+                self._cmd_id += 1
+                try:
+                    self._proc.stdin.write("{} {}\n".format(
+                        self._cmd_id, base64.b64encode(command.encode("utf-8")).decode("ascii")).encode("ascii"))
+                    await self._proc.stdin.drain()
+                except OSError:
+                    await self._kill()
+                else:
+                    break
+            else:
+                raise PSHostError("Could not send the command to PowerShell host")
+            try:
+                result = await asyncio.wait_for(self._read(), timeout)
+            except asyncio.TimeoutError:
+                await self._kill()
+                raise PSHostError("PowerShell host did not complete the command in {} seconds".format(timeout))
+            except asyncio.CancelledError:
+                await asyncio.shield(self._kill())  # the output can't be read consistently any more
+                raise
+            except (ValueError, asyncio.IncompleteReadError):
+                await self._kill()
+                raise PSHostError("PowerShell host died while running the command")
+            if result[0] != self._cmd_id:
+                await self._kill()
+                raise PSHostError("PowerShell host has returned the result of another command")
+            if result[1] != "OK":
+                raise PSHostError(result[2])
+            return result[2]
+
+    async def close(self):
+        if self._proc is not None:
+            try:
+                self._proc.stdin.close()
+                await asyncio.wait_for(self._proc.wait(), 5)
+            except (OSError, asyncio.TimeoutError):
+                pass
+        await self._kill()
+
+
+class PSHostPool:
+    """
+    A pool of PowerShell hosts running up to <size> commands concurrently. It has the same interface as PSHost.
+    The hosts are started on demand and the most recently used idle host is picked first,
+    so more than one host is started only if the commands overlap
+    """
+
+    _host_class = PSHost
+
+    def __init__(self, size=1, **kwargs):
+        """
+        :param size: max number of PowerShell hosts
+        :param kwargs: the hosts' parameters (see PSHost)
+        """
+        if size < 1:
+            raise ValueError("Number of PowerShell hosts should be a positive integer")
+        self._hosts = [type(self)._host_class(**kwargs) for _ in range(size)]
+        self._idle = queue.LifoQueue()
+        for host in self._hosts:
+            self._idle.put_nowait(host)
+
+    def run(self, command, timeout=None):
+        """
+        Runs the command on an idle host. Waits for one if all the hosts are busy (see PSHost.run)
+        """
+        host = self._idle.get()
+        try:
+            return host.run(command, timeout)
+        finally:
+            self._idle.put_nowait(host)
+
+    def close(self):
+        for host in self._hosts:
+            host.close()
+
+
+class AsyncPSHostPool(PSHostPool):
+    """
+    Coroutine counterpart of PSHostPool for the asyncio runtime
+    """
+
+    _host_class = AsyncPSHost
+
+    def __init__(self, size=1, **kwargs):
+        super().__init__(size, **kwargs)
+        self._idle = None  # asyncio.LifoQueue is created in the event loop it is used in
+
+    async def run(self, command, timeout=None):
+        """
+        Runs the command on an idle host. Waits for one if all the hosts are busy (see AsyncPSHost.run)
+        """
+        if self._idle is None:
+            self._idle = asyncio.LifoQueue()
+            for host in self._hosts:
+                self._idle.put_nowait(host)
+        host = await self._idle.get()
+        try:
+            return await host.run(command, timeout)
+        finally:
+            self._idle.put_nowait(host)
+
+    async def close(self):
+        for host in self._hosts:
+            await host.close()
+
+
 class Discoverer(Utils):
 
     _allowed_methods = {"wmi", "ps"}
+    _PS_DISCOVERY_CMD = "Get-Website|Select Name,Bindings,ServerAutoStart|ConvertTo-Json -depth 3 -compress"
 
     def __init__(self, q, evt_discovery_done, IIS_sites, cache_time=900, method="ps",
-                 prefproto=_IIS_PREF_PROTO, prefhost=None):
+                 prefproto=_IIS_PREF_PROTO, prefhost=None, ps_host=None, iis_config=_IIS_CONFIG, metrics=None):
+        """
+        :param q: command queue
+        :param evt_discovery_done: the event to be set when discovery is done
+        :param IIS_sites: a WrappedList's instance to be filled with IIS sites
+        :param cache_time: how long the discovered sites are cached if IIS config file can't be watched for changes
+        :param method: discovery method, may be "wmi" or "ps"
+        :param prefproto: preferred protocol of a site's binding
+        :param prefhost: preferred host name (regexp) of a site's binding
+        :param ps_host: a PSHost's or PSHostPool's instance running PowerShell commands (might be shared with Checker)
+        :param iis_config: IIS config file. Discovery is performed only if it has changed since the last discovery
+        :param metrics: a Metrics' instance to be updated with Discoverer's metrics
+        """
         self.validate_value(method, type(self)._allowed_methods, "discovery method")
         self._q = q
         self._evt_discovery_done = evt_discovery_done
@@ -310,15 +1209,131 @@ class Discoverer(Utils):
         self._method = method
         self._prefproto = prefproto
         self._prefhost = prefhost
+        self._ps_host = ps_host if ps_host is not None else PSHost()
+        self._iis_config = iis_config
+        self._sites_fingerprints = dict()  # IIS site name -> fingerprint of its discovered data
+        self._last_discovery_time = 0
+        self._last_config_fingerprint = None
+        self._last_ps_stdout_hash = None
+        self._metrics = metrics if metrics is not None else Metrics()
+        self._metrics.declare(counters=("discovery.failures",), histograms=("discovery.time",))
+
+    def configure(self, prefproto=_IIS_PREF_PROTO, prefhost=None, iis_config=_IIS_CONFIG):
+        """
+        Sets the parameters which may be changed while running (see __init__ for their description).
+        If the preferred binding has changed, the next discovery re-creates the instances of all the sites
+        """
+        if (prefproto, prefhost) != (self._prefproto, self._prefhost):
+            self._sites_fingerprints = dict()
+            self._last_config_fingerprint = None
+            self._last_discovery_time = 0
+            self._last_ps_stdout_hash = None
+        elif iis_config != self._iis_config:
+            self._last_config_fingerprint = None
+        self._prefproto = prefproto
+        self._prefhost = prefhost
+        self._iis_config = iis_config
+
+    def _get_config_fingerprint(self):
+        """
+        :return: a fingerprint of IIS config file or None if it can't be got
+        """
+        try:
+            st = os.stat(self._iis_config)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _update_sites(self, discovered):
+        """
+        Updates the list of IIS sites with the sites which have been added or modified since the last discovery.
+        IIS_site_info instances of the unchanged sites are kept as they are.
+        :param discovered: a list of tuples: (IIS site name, fingerprint, function returning IIS_site_info instance)
+        """
+        current = {site.get_name(): site for site in self._IIS_sites.get()}
+        sites = list()
+        added, modified = 0, 0
+        for name, fingerprint, make_site in discovered:
+            if name in current and self._sites_fingerprints.get(name) == fingerprint:
+                sites.append(current[name])
+            else:
+                if name in current:
+                    modified += 1
+                else:
+                    added += 1
+                sites.append(make_site())
+        self._sites_fingerprints = {x[0]: x[1] for x in discovered}
+        removed = len(set(current) - set(self._sites_fingerprints))
+        self._IIS_sites.set(sites)
+        self._metrics.set("discovery.sites", len(sites))
+        logging.info("Discovered sites: {} added, {} modified, {} removed, {} total".format(added, modified, removed, len(sites)))
+
+    def _needs_discovery(self, config_fingerprint):
+        """
+        :param config_fingerprint: the current fingerprint of IIS config file as returned by _get_config_fingerprint
+        :return: True if the cached sites are out of date
+        """
+        if config_fingerprint is None:
+            return time.time() - self._last_discovery_time > self._cache_time
+        return config_fingerprint != self._last_config_fingerprint
+
+    def _discovered(self, config_fingerprint, started):
+        """
+        :param config_fingerprint: the fingerprint of IIS config file the discovery has been performed with
+        :param started: when the discovery has started (time.monotonic() based)
+        """
+        self._last_discovery_time = time.time()
+        self._last_config_fingerprint = config_fingerprint
+        self._metrics.observe("discovery.time", time.monotonic() - started)
+
+    def _update_sites_ps(self, ps_stdout):
+        """
+        Updates the list of IIS sites with the output of the discovery PS cmdlet unless the output is the same as the last time
+        :param ps_stdout: the output of _PS_DISCOVERY_CMD
+        :return: False if the output is corrupted, True otherwise
+        """
+        ps_stdout_hash = hashlib.sha1(ps_stdout.encode("utf-8")).digest()
+        if ps_stdout_hash == self._last_ps_stdout_hash:
+            logging.info("Discovered data has not changed")
+            return True
+        try:
+            discovered = json.loads(ps_stdout)
+        except json.JSONDecodeError:
+            logging.warning("Got corrupted JSON from the PS cmdlet. Discovery will be re-tried on the next request")
+            return False  # We consider json errors as transient
+        if isinstance(discovered, dict):  # ConvertTo-Json returns a bare object instead of an array of one element
+            discovered = [discovered]
+        self._update_sites([(cidict(site)["name"],
+                             json.dumps(site, sort_keys=True),
+                             lambda site=site: IIS_site_info_json(cidict(site), self._prefproto, self._prefhost))
+                            for site in discovered])
+        self._last_ps_stdout_hash = ps_stdout_hash
+        return True
+
+    async def discover_async(self, ps_host):
+        """
+        Coroutine counterpart of a discovery request for the asyncio runtime. Only "ps" method is supported
+        :param ps_host: an AsyncPSHost's instance
+        """
+        config_fingerprint = self._get_config_fingerprint()
+        if not self._needs_discovery(config_fingerprint):
+            logging.info("Using cached data")
+            return
+        logging.info("Performing discovery using {} method".format(self._method))
+        started = time.monotonic()
+        try:
+            ps_stdout = await ps_host.run(type(self)._PS_DISCOVERY_CMD)
+        except PSHostError as exc:
+            logging.error("Could not perform discovery due to {}".format(exc))
+            self._metrics.inc("discovery.failures")
+            return  # Discovery will be re-tried on the next request
+        if self._update_sites_ps(ps_stdout):
+            self._discovered(config_fingerprint, started)
+        else:
+            self._metrics.inc("discovery.failures")
 
     def run(self):
         wmi_iis_moniker = _WMI_IIS_MONIKER
-        ps_cmd = [
-            "powershell",
-            "-NoProfile",
-            "-ExecutionPolicy", "Bypass",
-            "-Command", "Get-Website|Select Name,Bindings,ServerAutoStart|ConvertTo-Json -depth 3 -compress"]
-        last_discovery_time = 0
         COM_initialized = False
         if self._method == "wmi":
             pythoncom.CoInitializeEx(pythoncom.COINIT_MULTITHREADED)
@@ -327,18 +1342,21 @@ class Discoverer(Utils):
         try:
             while True:
                 msg = self._q.get()
-                if msg.process_data[0]:
+                if msg.kind is MessageKind.PROCESS_DATA:
                     try:
-                        if time.time() - last_discovery_time > self._cache_time:
-                            self._IIS_sites.reset()
+                        config_fingerprint = self._get_config_fingerprint()
+                        if self._needs_discovery(config_fingerprint):
                             logging.info("Performing discovery using {} method".format(self._method))
+                            started = time.monotonic()
                             if self._method == "wmi":
                                 good = False
                                 retry_counter = 0
                                 for retry_timer in _RETRY_TIMERS:
                                     try:
-                                        for site in wmi.WMI(moniker=wmi_iis_moniker).query("SELECT Name, Bindings, ServerAutoStart FROM Site"):
-                                            self._IIS_sites.add(IIS_site_info(site, self._prefproto, self._prefhost))
+                                        discovered = [(site.Name,
+                                                       (site.ServerAutoStart, tuple((b.protocol, b.BindingInformation) for b in site.Bindings)),
+                                                       lambda site=site: IIS_site_info(site, self._prefproto, self._prefhost))
+                                                      for site in wmi.WMI(moniker=wmi_iis_moniker).query("SELECT Name, Bindings, ServerAutoStart FROM Site")]
                                     except Exception as exc:
                                         retry_counter += 1
                                         if retry_counter <= len(_RETRY_TIMERS):
@@ -352,27 +1370,26 @@ class Discoverer(Utils):
                                 if not good:
                                     logging.critical("Could not perform discovery due to errors. Shutting down")
                                     break
+                                self._update_sites(discovered)
                             elif self._method == "ps":
-                                if sys.version_info.major > 2 and sys.version_info.minor > 4:
-                                    cp = subprocess.run(ps_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
-                                else:
-                                    cp = types.SimpleNamespace()
-                                    cp.stdout = subprocess.check_output(ps_cmd, stderr=subprocess.DEVNULL)
                                 try:
-                                    for site in json.loads(cp.stdout.decode(encoding="ascii"), encoding="ascii"):
-                                        self._IIS_sites.add(IIS_site_info_json(cidict(site), self._prefproto, self._prefhost))
-                                except json.JSONDecodeError:
-                                    pass
-                                    # TODO: We consider json errors as transient,
-                                    # TODO: but it would be great to add some logging here
-                            last_discovery_time = time.time()
+                                    ps_stdout = self._ps_host.run(type(self)._PS_DISCOVERY_CMD)
+                                except PSHostError as exc:
+                                    logging.error("Could not perform discovery due to {}".format(exc))
+                                    self._metrics.inc("discovery.failures")
+                                    continue  # Discovery will be re-tried on the next request
+                                if not self._update_sites_ps(ps_stdout):
+                                    self._metrics.inc("discovery.failures")
+                                    continue
+                            self._discovered(config_fingerprint, started)
                         else:
                             logging.info("Using cached data")
                     finally:
                         self._evt_discovery_done.set()  # We must set event in any case. Infinite waiting will occur otherwise
-                elif msg.stop_execution[0]:
-                    break
-                elif msg.force_stop_execution[0]:
+                elif msg.kind is MessageKind.RECONFIGURE:
+                    self.configure(**msg.data)
+                    logging.info("New configuration has been applied")
+                elif msg.kind is MessageKind.STOP_EXECUTION or msg.kind is MessageKind.FORCE_STOP_EXECUTION:
                     break
         except:
             logging.exception("Unexpected exception in the run loop")
@@ -384,32 +1401,54 @@ class Discoverer(Utils):
 
 class Checker(Utils):
 
+    class _PathSpec(collections.namedtuple("_PathSpec", ["path", "body", "nobody", "body_bytes", "nobody_bytes",
+                                                         "whole_body"])):
+        """
+        A path component to be probed with the compiled "body" and "nobody" regexps (None if not set).
+        The regexps which match the same way against the raw body of ASCII-compatible charset
+        are compiled as bytes regexps too (None otherwise). If some of the regexps depend on the context of the match
+        (anchors, word boundaries, lookarounds), whole_body is set and the regexps are matched against the whole body
+        once it's received instead of its chunks
+        """
+        __slots__ = ()
+
+    class _Settings(collections.namedtuple("_Settings", ["scheme", "host", "port", "addr", "path", "timeout", "delay",
+                                                         "interval", "settle", "nameservers", "v4", "v6", "ca", "verbose",
+                                                         "max_body", "head", "timing"])):
+        """
+        Site specific settings merged with the defaults. "path" is a tuple of Checker._PathSpec instances
+        """
+        __slots__ = ()
+
+    class _Plan(collections.namedtuple("_Plan", ["zbx_key", "urls", "timing_keys", "curl_key", "curl_options", "settings",
+                                                 "version"])):
+        """
+        Probe plan of an IIS site: Zabbix key of the probe item, a tuple of Checker._PathSpec instances with full URLs,
+        a tuple of (Curl info, Zabbix key) tuples of the timing items of every URL (empty if timing is off),
+        a key the Curl handles are pooled by, a tuple of (Curl option, value) set on the probe's handle,
+        an instance of Checker._Settings and the version of Checker._Config the plan has been made with
+        """
+        __slots__ = ()
+
     class _Website:
 
         well_known_ports = cidict({"http": "80", "https": "443"})
 
-        def __init__(self, scheme="http", host="localhost", port="80", addr="127.0.0.1",
-                     path='[{"path": "/", "body": null}]'):
+        def __init__(self, scheme="http", host="localhost", port="80", addr="127.0.0.1", path=None):
+            """
+            :param path: a sequence of Checker._PathSpec instances. The root path with no body checks if None
+            """
             if not re.search("^(http|https)$", scheme, re.I):
                 raise RuntimeError("Unknown scheme {}".format(scheme))
             self.scheme = scheme
             self.host = "localhost" if host == "" else host
             self.addr = "127.0.0.1" if addr == "*" else addr
             self.port = port if port is not None else type(self).well_known_ports[scheme]
-            path = json.loads(path)
-            self.url = []
-            for p in path:
-                if "path" in p:
-                    p["path"] = urllib.parse.urlunparse(
-                        urllib.parse.ParseResult(self.scheme, ":".join([self.host, self.port]), p["path"], "", "", ""))
-                else:
-                    p["path"] = urllib.parse.urlunparse(
-                        urllib.parse.ParseResult(self.scheme, ":".join([self.host, self.port]), "/", "", "", ""))
-                if "body" not in p:
-                    p["body"] = None
-                if "nobody" not in p:
-                    p["nobody"] = None
-                self.url.append(p)
+            if path is None:
+                path = (Checker._PathSpec("/", None, None, None, None, False),)
+            netloc = ":".join([self.host, self.port])
+            self.url = tuple(p._replace(path=urllib.parse.urlunparse(urllib.parse.ParseResult(self.scheme, netloc, p.path, "", "", "")))
+                             for p in path)
             self.curl_resolved_host = ":".join([self.host, self.port, self.addr]) if self.addr is not None else None
 
         def get_url(self):
@@ -418,7 +1457,269 @@ class Checker(Utils):
         def get_curl_host(self):
             return self.curl_resolved_host
 
+        def get_curl_key(self):
+            return self.scheme.lower(), self.host.lower(), self.port, self.addr
+
+    class _Probe:
+        """
+        HTTP probe of an IIS site. Site's URLs are requested one after another with the same Curl handle.
+        The handle is supplied by the caller and is not closed by the probe, so it may be reused by the next probes.
+        The body is matched against the regexps as it comes. The transfer is stopped as soon as the result
+        doesn't depend on the rest of the body
+        """
+
+        OK_MESSAGE = "STATUS_OK"
+        CURL_TIMEOUT_MESSAGE = "STATUS_ERR_TIMEOUT"
+        CURL_FAILED_MESSAGE = "STATUS_ERR_FAILED"
+        WEBSITE_AUTH_REQUIRED_MESSAGE = "STATUS_ERR_AUTH_REQUIRED"
+        WEBSITE_FAILED_MESSAGE = "STATUS_ERR_WEBAPP_PROBLEM"
+        HTML_DEFAULT_CHARSET = "UTF-8"
+        HTML_FALLBACK_CHARSET = "ISO-8859-1"
+        HTML_HEADER_CHARSET = "ISO-8859-1"
+        BODY_OVERLAP = 4096  # characters of the previous chunk of the body kept for the matches spanning the chunks
+        BODY_DRAIN_MAX = 65536  # the rest of the body up to this size (bytes) is read anyway to keep the connection alive
+        CHARSET_RE = re.compile(r"""charset\s*=\s*["']?([^"';\s]+)""", re.I)
+        ASCII_COMPATIBLE_CODECS = {"encodings.utf_8", "encodings.utf_8_sig", "encodings.ascii", "encodings.latin_1"}
+
+        def __init__(self, name, plan, curl, start_time=0, configured=False):
+            """
+            :param name: IIS site name
+            :param plan: an instance of Checker._Plan
+            :param curl: a Curl handle with no options set or with the plan's ones (see configured)
+            :param start_time: when to start the probe (time.monotonic() based)
+            :param configured: whether the handle has the plan's options set already (it has been used by the same plan)
+            """
+            self.name = name
+            self.zbx_key = plan.zbx_key
+            self.plan = plan
+            self.start_time = start_time
+            self._urls = iter(plan.urls)
+            self._url = None
+            self._timing_keys = iter(plan.timing_keys)
+            self.timings = list()  # Result's instances of the timing items of the URLs probed
+            self._headers = None
+            self.curl = c = curl
+            if not configured:
+                for option, value in plan.curl_options:
+                    c.setopt(option, value)
+            c.setopt(pycurl.HEADERFUNCTION, self._curl_headerfunction)
+            c.setopt(pycurl.WRITEFUNCTION, self._curl_writefunction)
+            self.curl_debug_buf = None
+            if plan.settings.verbose:
+                self.curl_debug_buf = io.BytesIO()
+                c.setopt(pycurl.DEBUGFUNCTION, self._curl_debugfunction)
+
+        def _curl_debugfunction(self, debugtype, debugbytes):
+            if debugtype in (pycurl.INFOTYPE_TEXT, pycurl.INFOTYPE_HEADER_IN, pycurl.INFOTYPE_HEADER_OUT):
+                self.curl_debug_buf.write(debugbytes)
+
+        def _curl_headerfunction(self, line):
+            line = line.decode(type(self).HTML_HEADER_CHARSET).strip()
+            if line.startswith("HTTP"):  # Curl's getinfo can't be called while transferring, so the headers are parsed here
+                self._headers = {"_STATUS_REASON_PHRASE": line.split(maxsplit=2)[-1]}
+                try:
+                    self._headers["_STATUS_CODE"] = int(line.split(maxsplit=2)[1])
+                except (IndexError, ValueError):
+                    pass
+            elif ":" in line:
+                name, value = line.split(":", 1)
+                self._headers[name.strip().lower()] = value.strip()
+
+        def _curl_writefunction(self, chunk):
+            self._received += len(chunk)
+            if self._matched:
+                return self._stop()
+            if not self._matching:  # The first chunk of the body
+                if self._headers.get("_STATUS_CODE", 200) >= 400 or (self._url.body is None and self._url.nobody is None):
+                    return self._stop()
+                self._start_matching()
+            chunk = memoryview(chunk)
+            max_body = self.plan.settings.max_body
+            if max_body and self._received > max_body:
+                chunk = chunk[:len(chunk) - (self._received - max_body)]
+                self._truncated = True
+            if self._match(chunk) or self._truncated:
+                return self._stop()
+            return None
+
+        def _get_charset(self):
+            """
+            :return: the charset of the body declared in Content-Type header or the default one
+            """
+            content_type = self._headers.get("content-type")
+            match = type(self).CHARSET_RE.search(content_type) if content_type is not None else None
+            return match.group(1) if match is not None else type(self).HTML_DEFAULT_CHARSET
+
+        def _start_matching(self):
+            """
+            Chooses the regexps to match the body against. The bytes regexps are matched against the raw body
+            if the charset is ASCII-compatible. The body is decoded only if some of the regexps need the text
+            """
+            cls = type(self)
+            charset = self._get_charset()
+            try:
+                decoder = codecs.getincrementaldecoder(charset)()
+                ascii_compatible = decoder.__class__.__module__ in cls.ASCII_COMPATIBLE_CODECS \
+                    or codecs.lookup(charset).name.startswith(("iso8859-", "cp125", "koi8-"))
+            except LookupError:
+                decoder = codecs.getincrementaldecoder(cls.HTML_FALLBACK_CHARSET)()
+                ascii_compatible = True
+            url = self._url
+            self._body_re = url.body_bytes if ascii_compatible and url.body_bytes is not None else url.body
+            self._nobody_re = url.nobody_bytes if ascii_compatible and url.nobody_bytes is not None else url.nobody
+            regexps = [x for x in (self._body_re, self._nobody_re) if x is not None]
+            self._decoder = decoder if any(isinstance(x.pattern, str) for x in regexps) else None
+            self._bytes_tail = b"" if any(isinstance(x.pattern, bytes) for x in regexps) else None
+            self._whole_body = list() if url.whole_body else None
+            self._matching = True
+
+        def _search(self, regex, text, head, chunk):
+            """
+            :return: whether the regex is found in the text (a str regex) or in the raw chunk (a bytes regex).
+            The chunk is searched as is, the matches spanning the chunks are searched in the head
+            (the tail of the previous chunk followed by the start of the chunk)
+            """
+            if isinstance(regex.pattern, str):
+                return regex.search(text) is not None
+            return regex.search(head) is not None or regex.search(chunk) is not None
+
+        def _match(self, chunk, final=False):
+            """
+            Matches a chunk of the body against the regexps. The tail of the previous chunk is prepended to the chunk,
+            so the matches shorter than BODY_OVERLAP are found even if they span the chunks. The regexps of the paths
+            with whole_body set are matched against the whole body when the last chunk is passed
+            :param chunk: a bytes-like object
+            :param final: whether it is the last chunk
+            :return: True if the result doesn't depend on the rest of the body
+            """
+            overlap = type(self).BODY_OVERLAP
+            text, head = None, None
+            if self._decoder is not None:
+                try:
+                    text = self._decoder.decode(chunk, final)
+                except UnicodeDecodeError:  # Not the declared charset. The rest of the body is decoded with the fallback one
+                    self._decoder = codecs.getincrementaldecoder(type(self).HTML_FALLBACK_CHARSET)()
+                    text = self._decoder.decode(chunk, final)
+                if self._whole_body is not None:  # Matched once the whole body is received
+                    self._whole_body.append(text)
+                    if not final:
+                        return False
+                    text = "".join(self._whole_body)
+                    self._whole_body = None
+                else:
+                    text = self._text_tail + text
+                    self._text_tail = text[-overlap:]
+            if self._bytes_tail is not None:
+                head = self._bytes_tail + chunk[:overlap]
+                self._bytes_tail = bytes(chunk[-overlap:]) if len(chunk) >= overlap else head[-overlap:]
+            body, nobody = self._body_re, self._nobody_re
+            if body is not None and not self._body_found and self._search(body, text, head, chunk):
+                self._body_found = True
+            if nobody is not None and not self._nobody_found and self._search(nobody, text, head, chunk):
+                self._nobody_found = True
+            self._matched = self._nobody_found or (nobody is None and (body is None or self._body_found))
+            return self._matched
+
+        def _stop(self):
+            """
+            Called when the rest of the body doesn't matter. Short rest of the body is read and dropped
+            to keep the connection alive, the transfer is aborted otherwise
+            :return: the return value of Curl's WRITEFUNCTION
+            """
+            self._matched = True
+            try:
+                left = int(self._headers["content-length"]) - self._received
+            except (KeyError, ValueError):
+                left = -1
+            if 0 <= left <= type(self).BODY_DRAIN_MAX:
+                return None
+            self._stopped = True
+            return 0
+
+        def next_url(self):
+            """
+            Sets the Curl handle up for the next URL
+            :return: False if there are no URLs left, True otherwise
+            """
+            self._url = next(self._urls, None)
+            if self._url is None:
+                return False
+            self._url_timing_keys = next(self._timing_keys, ())
+            logging.debug("Probing URL {}".format(self._url.path))
+            self._headers = {}
+            self._matching = False  # whether the regexps to match the body against have been chosen
+            self._decoder = None
+            self._text_tail = ""
+            self._whole_body = None  # the decoded chunks of the body if it's matched as a whole
+            self._received = 0
+            self._body_found = False
+            self._nobody_found = False
+            self._matched = False  # the rest of the body doesn't matter
+            self._truncated = False  # max_body has been reached
+            self._stopped = False  # the transfer has been aborted on purpose
+            if self.plan.settings.head:
+                self.curl.setopt(pycurl.NOBODY, self._url.body is None and self._url.nobody is None)
+            self.curl.setopt(pycurl.URL, self._url.path)
+            return True
+
+        def result(self, status, error=None):
+            return Result.make(self.name, self.zbx_key, status, self.curl_debug_buf, error)
+
+        def record_timings(self):
+            """
+            Records the timings of the transfer of the current URL. It's called once the response has been received
+            (even if the transfer has been stopped by the probe), so the failed transfers have no timings
+            """
+            for info, zbx_key in self._url_timing_keys:
+                self.timings.append(Result.make(self.name, zbx_key, self.curl.getinfo(info)))
+
+        def check_error(self, errno, errmsg):
+            """
+            :return: a Result's instance for the failed transfer, None if the transfer has been stopped by the probe
+            """
+            if self._stopped and errno == pycurl.E_WRITE_ERROR:
+                return None
+            curl_error = pycurl.error(errno, errmsg)
+            if errno == pycurl.E_OPERATION_TIMEDOUT:
+                return self.result(type(self).CURL_TIMEOUT_MESSAGE, curl_error)
+            else:
+                return self.result(type(self).CURL_FAILED_MESSAGE, curl_error)
+
+        def check_response(self):
+            """
+            Checks the response to the current URL
+            :return: a result tuple if the probe has failed, None otherwise
+            """
+            cls = type(self)
+            code = self._headers.get("_STATUS_CODE", 0)
+            if code == 401:
+                return self.result(cls.WEBSITE_AUTH_REQUIRED_MESSAGE)
+            if code >= 400:
+                if "_STATUS_REASON_PHRASE" in self._headers and len(self._headers["_STATUS_REASON_PHRASE"]) > 0:
+                    msg = "{}: {}".format(cls.WEBSITE_FAILED_MESSAGE, self._headers["_STATUS_REASON_PHRASE"])
+                else:
+                    msg = cls.WEBSITE_FAILED_MESSAGE
+                return self.result(msg)
+            if self._matching and (not self._matched or self._whole_body is not None):  # The body may be truncated
+                self._match(b"", final=True)
+            # "body" takes precedence over "nobody". The transfer is stopped as soon as "nobody" is found,
+            # so "body" is looked for in the part of the body received by then
+            if self._url.body is not None and not self._body_found:
+                return self.result("{}: response body doesn't contain text {}".format(cls.WEBSITE_FAILED_MESSAGE, self._url.body.pattern))
+            elif self._nobody_found:
+                return self.result("{}: response body contains text {}".format(cls.WEBSITE_FAILED_MESSAGE, self._url.nobody.pattern))
+            return None
+
     class _Config(Utils):
+        """
+        Sites settings compiled into an index: host name -> (rank, Checker._Settings instance merged with the defaults).
+        The rank is the position of the host's section in the ini-file, the site's hosts found in many sections
+        get the settings of the first one. The index is built once per a parsed ini-file, so looking the settings up
+        costs a few dict lookups
+        """
+
+        _DEFAULT_PATH = '[{"path": "/", "body": null}]'
+        _versions = itertools.count()
 
         def __init__(self, iniobj, circs, skipsections=set()):
             """
@@ -426,85 +1727,139 @@ class Checker(Utils):
             :param circs: a dict of "circumstances" - vars such as the app's file name (aka argv[0]) etc.
             :param skipsections: a set of section names that are irrelevant to the Checker and have to be skipped
             """
-            self._defaults = types.SimpleNamespace()
-            self._defaults.scheme = "http"     # TODO: seems useless, try to remove
-            self._defaults.host = "localhost"  # TODO: seems useless, try to remove
-            self._defaults.port = None         # TODO: seems useless, try to remove
-            self._defaults.addr = None         # TODO: seems useless, try to remove
-            self._defaults.path = '[{"path": "/", "body": null}]'
-            self._defaults.timeout = 300
-            self._defaults.delay = 30
-            self._defaults.nameservers = None
-            self._defaults.v4 = False
-            self._defaults.v6 = False
-            self._defaults.ca = None  # CA bundle (file name)
-            self._defaults.verbose = False  # make Curl verbose and log its output
-            self._sites = dict()
+            defaults = Checker._Settings(
+                scheme="http",     # TODO: seems useless, try to remove
+                host="localhost",  # TODO: seems useless, try to remove
+                port=None,         # TODO: seems useless, try to remove
+                addr=None,         # TODO: seems useless, try to remove
+                path=self.compile_path(type(self)._DEFAULT_PATH),
+                timeout=300,
+                delay=30,  # jitter window of the checks
+                interval=None,  # interval of the checks. The global one if None
+                settle=5,  # wait after the site is found started and before probing it
+                nameservers=None,
+                v4=False,
+                v6=False,
+                ca=None,  # CA bundle (file name)
+                verbose=False,  # make Curl verbose and log its output
+                max_body=1048576,  # max number of body bytes matched against the regexps. 0 means no limit
+                head=False,  # whether the paths with no body regexps are probed with HEAD requests
+                timing=True  # whether the timings of the paths are sent
+            )
+            defaults_options = dict()
+            sites_options = dict()  # frozenset of host names -> dict of options
             for section in iniobj.sections():
                 if section in skipsections:
                     continue
                 elif section == "_defaulthost":
-                    host = self._defaults
+                    options = defaults_options
                 else:
                     try:
                         site_key = frozenset([x.strip().lower() for x in
                                               re.split("\s*,\s*", iniobj.get(section, "allhosts"))])
-                        if site_key not in self._sites:
-                            self._sites[site_key] = types.SimpleNamespace()
-                        host = self._sites[site_key]
+                        options = sites_options.setdefault(site_key, dict())
                     except configparser.NoOptionError:
                         continue
                 for option in iniobj.options(section):
                     if option == "allhosts":
                         continue
-                    elif option in {"timeout", "delay"}:
+                    elif option == "interval":
+                        o_value = iniobj.getint(section, option)
+                        if o_value <= 0:
+                            raise ValueError("{}.{} should be a positive integer".format(section, option))
+                        options[option] = o_value
+                    elif option in {"timeout", "delay", "settle", "max_body"}:
                         o_value = iniobj.getint(section, option)
                         if o_value < 0:
                             raise ValueError("{}.{} should be a non-negative integer".format(section, option))
-                        setattr(host, option, iniobj.getint(section, option))
-                    elif option in {"v4", "v6", "verbose"}:
-                        setattr(host, option, iniobj.getboolean(section, option))
+                        options[option] = o_value
+                    elif option in {"v4", "v6", "verbose", "head", "timing"}:
+                        options[option] = iniobj.getboolean(section, option)
                     elif option == "ca":
-                        setattr(host, option, self.make_filename(iniobj.get(section, option), circs["argv_0"]))
-                    else:
-                        setattr(host, option, iniobj.get(section, option))
+                        options[option] = self.make_filename(iniobj.get(section, option), circs["argv_0"])
+                    elif option == "path":
+                        try:
+                            options[option] = self.compile_path(iniobj.get(section, option))
+                        except ValueError as exc:
+                            raise ValueError("{}.{} is invalid: {}".format(section, option, exc))
+                    elif option in defaults._fields:
+                        options[option] = iniobj.get(section, option)
+            self.version = next(type(self)._versions)  # probe plans made with another version are out of date
+            self._defaults = defaults._replace(**defaults_options)
+            self._index = dict()
+            for rank, (site_key, options) in enumerate(sites_options.items()):  # Sections are in ini-file order
+                settings = self._defaults._replace(**options)
+                for host in site_key:
+                    self._index.setdefault(host, (rank, settings))
+
+        @staticmethod
+        def compile_path(value):
+            """
+            :param value: JSON with an array of path components and body regexps (see "path" setting)
+            :return: a tuple of Checker._PathSpec instances with the regexps compiled
+            """
+            try:
+                rv = list()
+                for p in json.loads(value):
+                    patterns = [p.get(x) or None for x in ("body", "nobody")]
+                    whole_body = any(Checker._Config.is_context_dependent(x) for x in patterns if x is not None)
+                    rv.append(Checker._PathSpec(p.get("path", "/"),
+                                                *[re.compile(x, re.I) if x is not None else None for x in patterns],
+                                                *[None if x is None or whole_body else Checker._Config.compile_bytes(x)
+                                                  for x in patterns],
+                                                whole_body))
+                return tuple(rv)
+            except (TypeError, AttributeError, re.error) as exc:  # JSON errors are ValueErrors already
+                raise ValueError(exc)
+
+        @staticmethod
+        def compile_bytes(pattern):
+            """
+            :param pattern: a regexp
+            :return: the regexp compiled for matching the raw body, or None if it may match differently than against
+            the decoded text. Such are the regexps with non-ASCII characters, ".", negated character classes,
+            the escapes of character classes (\\w, \\d, \\s, \\b etc.) and the context dependent ones
+            (see is_context_dependent), since the raw chunks are searched one by one
+            """
+            if not pattern.isascii() or "[^" in pattern or Checker._Config.is_context_dependent(pattern):
+                return None
+            for escaped, char in re.findall(r"\\(.)|(.)", pattern, re.S):
+                if escaped.isalnum() or char == ".":
+                    return None
+            return re.compile(pattern.encode("ascii"), re.I)
+
+        @staticmethod
+        def is_context_dependent(pattern):
+            """
+            :param pattern: a regexp
+            :return: whether the regexp may match differently against a part of the text than against the whole text.
+            Such are the regexps with anchors (^, $, \\A, \\Z), word boundaries (\\b, \\B) and lookarounds
+            """
+            for token in re.findall(r"\\.|\[\^?\]?(?:\\.|[^\]\\])*\]|\(\?<?[=!]|.", pattern, re.S):
+                if token in {"^", "$", "\\A", "\\Z", "\\b", "\\B"} or token.startswith("(?"):
+                    return True
+            return False
 
         def get(self, allhosts):
             """
-            :param allhosts: a set of host names bound to an IIS site
-            :return: a namespace with site specific or default parameters
+            :param allhosts: a set of lower-cased host names bound to an IIS site
+            :return: a Checker._Settings instance with site specific or default parameters. If the hosts are found
+            in many sections, it's the one of the first section
             """
-            site = self._defaults
-            for key in self._sites.keys():
-                if key & allhosts:
-                    site = self._sites[key]
-                    break
-            rv = types.SimpleNamespace()
-            for var in vars(self._defaults):
-                try:
-                    setattr(rv, var, getattr(site, var))
-                except (KeyError, AttributeError):
-                    setattr(rv, var, getattr(self._defaults, var))
-            return rv
+            index = self._index
+            found = [index[x] for x in allhosts if x in index]
+            return min(found, key=lambda x: x[0])[1] if found else self._defaults
 
     def get_site_state(self, site_info, method):
         """
         :param site_info: a tuple of IIS site name and an object the IIS site info instance was created from
         :param method: a method of fetching data about IIS, may be "wmi" or "ps"
-        :return: a tuple: (IIS site name, Zabbix key, IIS site state)
+        :return: a Result's instance: IIS site name, Zabbix key, IIS site state (None and the error if it could not be fetched)
         """
         name, orig_obj = site_info[:]
-        ZBX_KEY_PREFIX = "iis.site.state"
         wmi_iis_moniker = _WMI_IIS_MONIKER
-        notfound = "notfound"
-        zbx_key = "{}[{}]".format(ZBX_KEY_PREFIX, name)
-        ps_cmd = [
-            "powershell",
-            "-NoProfile",
-            "-ExecutionPolicy", "Bypass",
-            "-Command", "Get-Website -Name \"{}\"|Select State|ConvertTo-Json -compress"]
-        siteconfig = self._cfg.get({name.lower()})
-        time.sleep(random.randint(0, siteconfig.delay))
+        notfound = type(self)._STATE_NOTFOUND
+        zbx_key = "{}[{}]".format(type(self)._STATE_KEY_PREFIX, name)
         logging.debug("Getting state of {} ({} method)".format(name, method))
         if method == "wmi":
             site_states = dict(enumerate(["starting", "started", "stopping", "stopped", "unknown"]))
@@ -536,148 +1891,537 @@ class Checker(Utils):
                         break
                 if not good:
                     logging.error("Could not get {} site state due to errors. Return value has the exception object instead of site state".format(name))
-                    return name, zbx_key, rt_exc
+                    return Result.make(name, zbx_key, None, error=rt_exc)
                 try:
-                    return name, zbx_key, site_states[site[0].GetState()[0]]
+                    return Result.make(name, zbx_key, site_states[site[0].GetState()[0]])
                 except IndexError:
-                    return name, zbx_key, notfound
+                    return Result.make(name, zbx_key, notfound)
                 except Exception as exc:
                     logging.error("Could not get {} site state due to errors. Return value has the exception object instead of site state".format(name))
-                    return name, zbx_key, exc
+                    return Result.make(name, zbx_key, None, error=exc)
             finally:
                 if COM_initialized:
                     pythoncom.CoUninitialize()
                     logging.debug("COM uninitialized")
         elif method == "ps":
             try:
-                ps_cmd[-1] = ps_cmd[-1].format(name)
-                if sys.version_info.major > 2 and sys.version_info.minor > 4:
-                    cp = subprocess.run(ps_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
-                else:
-                    cp = types.SimpleNamespace()
-                    cp.stdout = subprocess.check_output(ps_cmd, stderr=subprocess.DEVNULL)
-                site_state = cidict(json.loads(cp.stdout.decode(encoding="ascii"), encoding="ascii"))["state"]
-                if site_state is not None:
-                    return name, zbx_key, site_state.lower()
-                else:
-                    logging.error("Got null-value while getting {} site state. Web server might not be running".format(name))
-                    return name, zbx_key, RuntimeError("Got null-value from the PS cmdlet. Check if the Web server is running")
-            except json.JSONDecodeError:
-                return name, zbx_key, RuntimeError("Got corrupted JSON from the PS cmdlet")
+                ps_stdout = self._ps_host.run(type(self)._PS_STATE_CMD.format(name))
+            except PSHostError as exc:
+                logging.error("Could not get {} site state due to {}".format(name, exc))
+                return Result.make(name, zbx_key, None, error=exc)
+            return self._parse_site_state(name, ps_stdout)
         else:
-            return name, zbx_key, RuntimeError("Unknown site state fetching method specified")
+            return Result.make(name, zbx_key, None, error=RuntimeError("Unknown site state fetching method specified"))
 
-    def get_site_probe(self, siteobj):
+    async def get_site_state_async(self, name, ps_host):
+        """
+        Coroutine counterpart of get_site_state for the asyncio runtime. Only "ps" method is supported
+        :param name: IIS site name
+        :param ps_host: an AsyncPSHost's instance
+        :return: a Result's instance as returned by get_site_state
+        """
+        logging.debug("Getting state of {} (asyncio ps method)".format(name))
+        try:
+            ps_stdout = await ps_host.run(type(self)._PS_STATE_CMD.format(name))
+        except PSHostError as exc:
+            logging.error("Could not get {} site state due to {}".format(name, exc))
+            return Result.make(name, "{}[{}]".format(type(self)._STATE_KEY_PREFIX, name), None, error=exc)
+        return self._parse_site_state(name, ps_stdout)
+
+    def _parse_site_state(self, name, ps_stdout):
+        """
+        :param name: IIS site name
+        :param ps_stdout: the output of _PS_STATE_CMD
+        :return: a Result's instance as returned by get_site_state
+        """
+        zbx_key = "{}[{}]".format(type(self)._STATE_KEY_PREFIX, name)
+        try:
+            site_state = cidict(json.loads(ps_stdout))["state"]
+        except json.JSONDecodeError:
+            return Result.make(name, zbx_key, None, error=RuntimeError("Got corrupted JSON from the PS cmdlet"))
+        if site_state is not None:
+            return Result.make(name, zbx_key, site_state.lower())
+        else:
+            logging.error("Got null-value while getting {} site state. Web server might not be running".format(name))
+            return Result.make(name, zbx_key, None, error=RuntimeError("Got null-value from the PS cmdlet. Check if the Web server is running"))
+
+    def get_sites_states(self, sites_info):
+        """
+        Fetches states of all the sites with a single PowerShell call and fans them out to per-site results
+        :param sites_info: a list of tuples of IIS site name and an object the IIS site info instance was created from
+        :return: a list of Result's instances as returned by get_site_state
+        """
+        names = [x[0] for x in sites_info]
+        logging.debug("Getting states of {} sites (batch ps method)".format(len(names)))
+        try:
+            ps_stdout = self._ps_host.run(type(self)._PS_STATES_CMD)
+        except Exception as exc:
+            logging.error("Could not get sites states due to {}".format(exc))
+            return [Result.make(name, "{}[{}]".format(type(self)._STATE_KEY_PREFIX, name), None, error=exc) for name in names]
+        return self._parse_sites_states(names, ps_stdout)
+
+    async def get_sites_states_async(self, names, ps_host):
+        """
+        Coroutine counterpart of get_sites_states for the asyncio runtime
+        :param names: a list of IIS site names
+        :param ps_host: an AsyncPSHost's instance
+        :return: a list of Result's instances as returned by get_site_state
+        """
+        logging.debug("Getting states of {} sites (asyncio batch ps method)".format(len(names)))
+        try:
+            ps_stdout = await ps_host.run(type(self)._PS_STATES_CMD)
+        except PSHostError as exc:
+            logging.error("Could not get sites states due to {}".format(exc))
+            return [Result.make(name, "{}[{}]".format(type(self)._STATE_KEY_PREFIX, name), None, error=exc) for name in names]
+        return self._parse_sites_states(names, ps_stdout)
+
+    def _parse_sites_states(self, names, ps_stdout):
+        """
+        :param names: a list of IIS site names
+        :param ps_stdout: the output of _PS_STATES_CMD
+        :return: a list of Result's instances as returned by get_site_state
+        """
+        ZBX_KEY_PREFIX = type(self)._STATE_KEY_PREFIX
+        notfound = type(self)._STATE_NOTFOUND
+        try:
+            site_states = json.loads(ps_stdout)
+        except json.JSONDecodeError:
+            return [Result.make(name, "{}[{}]".format(ZBX_KEY_PREFIX, name), None, error=RuntimeError("Got corrupted JSON from the PS cmdlet"))
+                    for name in names]
+        if isinstance(site_states, dict):  # ConvertTo-Json returns a bare object instead of an array of one element
+            site_states = [site_states]
+        site_states = cidict({cidict(x)["name"]: cidict(x)["state"] for x in site_states})
+        rv = list()
+        for name in names:
+            zbx_key = "{}[{}]".format(ZBX_KEY_PREFIX, name)
+            if name not in site_states:
+                rv.append(Result.make(name, zbx_key, notfound))
+            elif site_states[name] is None:
+                logging.error("Got null-value while getting {} site state. Web server might not be running".format(name))
+                rv.append(Result.make(name, zbx_key, None, error=RuntimeError("Got null-value from the PS cmdlet. Check if the Web server is running")))
+            else:
+                rv.append(Result.make(name, zbx_key, site_states[name].lower()))
+        return rv
+
+    def get_probe_key(self, siteobj):
         """
         :param siteobj: an instance of IIS_site_info
-        :return: a tuple: (IIS site name, Zabbix key, IIS site probe status, Buffer with verbose output (might be None if verbosity is not requested))
+        :return: Zabbix key of the site's probe item
+        """
+        return "{}[{}]".format(type(self)._PROBE_KEY_PREFIX, ",".join(self._get_probe_key_params(siteobj)))
+
+    def get_timing_key(self, siteobj, path, timing):
+        """
+        :param siteobj: an instance of IIS_site_info
+        :param path: a path component as it's set in "path" setting
+        :param timing: a name of the timing (see _TIMINGS)
+        :return: Zabbix key of the timing item of the site's path
+        """
+        return "{}[{}]".format(type(self)._TIMING_KEY_PREFIX,
+                               ",".join(self._get_probe_key_params(siteobj) + [zabbix_utils.quote_key_param(path), timing]))
+
+    def _get_probe_key_params(self, siteobj):
+        """
+        :param siteobj: an instance of IIS_site_info
+        :return: a list of the parameters of the site's probe item key
         """
-        ZBX_KEY_PREFIX = "iis.site.probe"
-        OK_MESSAGE = "STATUS_OK"
-        CURL_TIMEOUT_MESSAGE = "STATUS_ERR_TIMEOUT"
-        CURL_FAILED_MESSAGE = "STATUS_ERR_FAILED"
-        WEBSITE_AUTH_REQUIRED_MESSAGE = "STATUS_ERR_AUTH_REQUIRED"
-        WEBSITE_FAILED_MESSAGE = "STATUS_ERR_WEBAPP_PROBLEM"
-        HTML_DEFAULT_CHARSET = "UTF-8"
-        HTML_FALLBACK_CHARSET = "ISO-8859-1"
-        HTML_HEADER_CHARSET = "ISO-8859-1"
         sitebindings = self._hostlist_separator.join(siteobj.get_normalised_hostnames())
         if self._hostlist_separator in sitebindings:
-            zbx_key_pattern = "{}[{},{},{},{},\"{}\"]"
-        else:
-            zbx_key_pattern = "{}[{},{},{},{},{}]"
-        zbx_key = zbx_key_pattern.format(ZBX_KEY_PREFIX,
-                                         siteobj.get_pref_binding()["proto"],
-                                         siteobj.get_pref_binding()["host"],
-                                         siteobj.get_pref_binding()["port"],
-                                         siteobj.get_pref_binding()["addr"],
-                                         sitebindings)
-        siteconfig = self._cfg.get(set([x["host"].lower() for x in siteobj.get_bindings()]))
-        time.sleep(random.randint(0, siteconfig.delay))
-        w = self._Website(
+            sitebindings = "\"{}\"".format(sitebindings)
+        return [siteobj.get_pref_binding()["proto"],
+                siteobj.get_pref_binding()["host"],
+                siteobj.get_pref_binding()["port"],
+                siteobj.get_pref_binding()["addr"],
+                sitebindings]
+
+    def _get_website(self, siteobj, siteconfig=None):
+        """
+        :param siteobj: an instance of IIS_site_info
+        :param siteconfig: an instance of Checker._Settings. If not set, the URLs are the default ones
+        :return: an instance of Checker._Website for the site's preferred binding
+        """
+        kwargs = {"path": siteconfig.path} if siteconfig is not None else {}
+        return self._Website(
             scheme=siteobj.get_pref_binding()["proto"],
             host=siteobj.get_pref_binding()["host"],
             port=siteobj.get_pref_binding()["port"],
             addr=siteobj.get_pref_binding()["addr"],
-            path=siteconfig.path
+            **kwargs
         )
-        c = pycurl.Curl()
-        if siteconfig.v4 ^ siteconfig.v6:
-            if siteconfig.v4:
-                c.setopt(pycurl.IPRESOLVE, pycurl.IPRESOLVE_V4)
-            elif siteconfig.v6:
-                c.setopt(pycurl.IPRESOLVE, pycurl.IPRESOLVE_V6)
+
+    def get_site_probe(self, siteobj):
+        """
+        :param siteobj: an instance of IIS_site_info
+        :return: a Result's instance: IIS site name, Zabbix key, IIS site probe status, Buffer with verbose output (might be None if verbosity is not requested)
+        """
+        return self.get_sites_probes([siteobj])[0]
+
+    def _make_probe(self, siteobj, used_keys, settle=False):
+        """
+        :param siteobj: an instance of IIS_site_info
+        :param used_keys: keys of the Curl handles taken from the pool during the current probe cycle
+        :param settle: whether to wait for the site's settle time before probing
+        :return: an instance of Checker._Probe scheduled with the site's settle time
+        """
+        plan = self._get_plan(siteobj)
+        start_time = time.monotonic() + (plan.settings.settle if settle else 0)
+        curl, configured = self._get_curl(plan, used_keys)
+        probe = self._Probe(siteobj.get_name(), plan, curl, start_time, configured)
+        used_keys.add(plan.curl_key)
+        return probe
+
+    def _get_plan(self, siteobj):
+        """
+        Probe plans are cached by the IIS_site_info instances (they are re-created by discovery when the sites' bindings
+        change) and the config version. The plans of the sites which are gone are dropped by _schedule_sites
+        :param siteobj: an instance of IIS_site_info
+        :return: an instance of Checker._Plan
+        """
+        plan = self._plans.get(siteobj)
+        if plan is None or plan.version != self._cfg.version:
+            plan = self._plans[siteobj] = self._make_plan(siteobj)
+        return plan
+
+    def _make_plan(self, siteobj):
+        """
+        :param siteobj: an instance of IIS_site_info
+        :return: an instance of Checker._Plan
+        """
+        settings = self._cfg.get(siteobj.get_hostnames())
+        w = self._get_website(siteobj, settings)
+        curl_options = list()
+        if settings.v4 ^ settings.v6:
+            curl_options.append((pycurl.IPRESOLVE, pycurl.IPRESOLVE_V4 if settings.v4 else pycurl.IPRESOLVE_V6))
         else:
-            c.setopt(pycurl.IPRESOLVE, pycurl.IPRESOLVE_WHATEVER)
-        if siteconfig.nameservers:
-            c.setopt(pycurl.DNS_SERVERS, siteconfig.nameservers)
+            curl_options.append((pycurl.IPRESOLVE, pycurl.IPRESOLVE_WHATEVER))
+        if settings.nameservers:
+            curl_options.append((pycurl.DNS_SERVERS, settings.nameservers))
         if w.get_curl_host() is not None:
-            c.setopt(pycurl.RESOLVE, [w.get_curl_host()])
-        if siteconfig.ca is not None:
-            c.setopt(pycurl.CAINFO, siteconfig.ca)
-        c.setopt(pycurl.TIMEOUT, siteconfig.timeout)
-        curl_debug_buf = None
-        if siteconfig.verbose:
-            curl_debug_buf = io.BytesIO()
-
-            def curl_debugfunction(debugtype, debugbytes, buf=curl_debug_buf):
-                if debugtype in (pycurl.INFOTYPE_TEXT, pycurl.INFOTYPE_HEADER_IN, pycurl.INFOTYPE_HEADER_OUT):
-                    buf.write(debugbytes)
-
-            c.setopt(pycurl.VERBOSE, siteconfig.verbose)
-            c.setopt(pycurl.DEBUGFUNCTION, curl_debugfunction)
+            curl_options.append((pycurl.RESOLVE, [w.get_curl_host()]))
+        if settings.ca is not None:
+            curl_options.append((pycurl.CAINFO, settings.ca))
+        curl_options.append((pycurl.TIMEOUT, settings.timeout))
+        if settings.verbose:
+            curl_options.append((pycurl.VERBOSE, True))
+        if settings.timing:
+            timing_keys = tuple(tuple((getattr(pycurl, timing.upper()), self.get_timing_key(siteobj, p.path, timing))
+                                      for timing in type(self)._TIMINGS) for p in settings.path)
+        else:
+            timing_keys = ()
+        return self._Plan(self.get_probe_key(siteobj), w.get_url(), timing_keys, w.get_curl_key(), tuple(curl_options),
+                          settings, self._cfg.version)
+
+    def get_sites_probes(self, sites, feed=None, on_results=None, abort=None):
+        """
+        Probes the sites concurrently from a single thread using Curl's multi interface
+        :param sites: a list of IIS_site_info instances
+        :param feed: an optional function supplying more sites while probing. It's called with a timeout (seconds)
+        it may wait for and returns a tuple: (list of IIS_site_info instances, whether more sites may come).
+        The sites supplied are probed after their settle time
+        :param on_results: an optional function which is called with a list of results as soon as they are available.
+        The results are not returned if it is set
+        :param abort: an optional threading.Event. Probing stops as soon as it is set, unfinished probes are dropped
+        :return: a list of Result's instances as returned by get_site_probe
+        """
+        rv = list()
+        pending = list()  # heap of (start time, sequence number, probe)
+        used_keys = set()
+        seq = itertools.count()
+        for siteobj in sites:
+            probe = self._make_probe(siteobj, used_keys)
+            heapq.heappush(pending, (probe.start_time, next(seq), probe))
+        active = dict()  # Curl handle -> probe
+        multi = self._curl_multi
+        more = feed is not None
         try:
-            for url in w.get_url():
-                logging.debug("Probing URL {}".format(url["path"]))
-                buffer = io.BytesIO()
-                headers = {}
-
-                def curl_headerfunction(line, h=headers):
-                    line = line.decode(HTML_HEADER_CHARSET).strip()
-                    if line.startswith("HTTP"):
-                        h["_STATUS_REASON_PHRASE"] = line.split(maxsplit=2)[-1]
-
-                c.setopt(pycurl.WRITEDATA, buffer)
-                c.setopt(pycurl.HEADERFUNCTION, curl_headerfunction)
-                c.setopt(pycurl.URL, url["path"])
-                try:
-                    c.perform()
-                except pycurl.error as curl_error:
-                    if curl_error.args[0] == pycurl.E_OPERATION_TIMEDOUT:
-                        return siteobj.get_name(), zbx_key, CURL_TIMEOUT_MESSAGE, curl_debug_buf, curl_error
+            while (pending or active or more) and not (abort is not None and abort.is_set()):
+                results = list()
+                while pending and len(active) < self._max_probes and pending[0][0] <= time.monotonic():
+                    probe = heapq.heappop(pending)[2]
+                    if probe.next_url():
+                        multi.add_handle(probe.curl)
+                        active[probe.curl] = probe
                     else:
-                        return siteobj.get_name(), zbx_key, CURL_FAILED_MESSAGE, curl_debug_buf, curl_error
-                else:
-                    response_info = {"code": c.getinfo(pycurl.RESPONSE_CODE),
-                                     "type": c.getinfo(pycurl.CONTENT_TYPE)}
-                    ct_params = cidict(cgi.parse_header(response_info["type"])[1]) if response_info["type"] is not None else cidict()
-                    response_info["charset"] = ct_params["charset"] if "charset" in ct_params else HTML_DEFAULT_CHARSET
-                if response_info["code"] == 401:
-                    return siteobj.get_name(), zbx_key, WEBSITE_AUTH_REQUIRED_MESSAGE, curl_debug_buf
-                if response_info["code"] >= 400:
-                    if "_STATUS_REASON_PHRASE" in headers and len(headers["_STATUS_REASON_PHRASE"]) > 0:
-                        msg = "{}: {}".format(WEBSITE_FAILED_MESSAGE, headers["_STATUS_REASON_PHRASE"])
+                        results.append(probe.result(probe.OK_MESSAGE))
+                        self._put_curl(probe, used_keys)
+                while True:
+                    ret, num_handles = multi.perform()
+                    if ret != pycurl.E_CALL_MULTI_PERFORM:
+                        break
+                while True:
+                    num_q, ok_list, err_list = multi.info_read()
+                    for c, errno, errmsg in [(c, None, None) for c in ok_list] + err_list:
+                        multi.remove_handle(c)
+                        probe = active.pop(c)
+                        probe_info = probe.check_error(errno, errmsg) if errno is not None else None
+                        if probe_info is None:  # The transfer has completed or has been stopped by the probe
+                            probe.record_timings()
+                            probe_info = probe.check_response()
+                        if probe_info is None and probe.next_url():
+                            multi.add_handle(c)
+                            active[c] = probe
+                        else:
+                            results.append(probe_info if probe_info is not None else probe.result(probe.OK_MESSAGE))
+                            results.extend(probe.timings)
+                            self._put_curl(probe, used_keys)
+                    if num_q == 0:
+                        break
+                if results:
+                    if on_results is not None:
+                        on_results(results)
                     else:
-                        msg = WEBSITE_FAILED_MESSAGE
-                    return siteobj.get_name(), zbx_key, msg, curl_debug_buf
-                try:
-                    body = buffer.getvalue().decode(response_info["charset"])
-                except UnicodeDecodeError:
-                    try:
-                        body = buffer.getvalue().decode(HTML_FALLBACK_CHARSET)
-                    except ValueError:
-                        return siteobj.get_name(), zbx_key, "{}: could not decode response body".format(WEBSITE_FAILED_MESSAGE), curl_debug_buf
-                if url["body"] and not re.search(url["body"], body, re.I):
-                    return siteobj.get_name(), zbx_key, "{}: response body doesn't contain text {}".format(WEBSITE_FAILED_MESSAGE, url["body"]), curl_debug_buf
-                elif url["nobody"] and re.search(url["nobody"], body, re.I):
-                    return siteobj.get_name(), zbx_key, "{}: response body contains text {}".format(WEBSITE_FAILED_MESSAGE, url["nobody"]), curl_debug_buf
+                        rv.extend(results)
+                timeout = multi.timeout() / 1000 if multi.timeout() >= 0 else 1.0
+                if pending and len(active) < self._max_probes:
+                    timeout = min(timeout, max(0, pending[0][0] - time.monotonic()))
+                if more:
+                    if active:
+                        feed_timeout, timeout = 0, min(timeout, type(self)._FEED_POLL_INTERVAL)
+                    else:
+                        feed_timeout, timeout = timeout, 0
+                    new_sites, more = feed(feed_timeout)
+                    for siteobj in new_sites:
+                        probe = self._make_probe(siteobj, used_keys, settle=True)
+                        heapq.heappush(pending, (probe.start_time, next(seq), probe))
+                if active:
+                    multi.select(timeout)
+                elif pending and timeout > 0:
+                    time.sleep(timeout)
         finally:
-            c.close()
-        return siteobj.get_name(), zbx_key, OK_MESSAGE, curl_debug_buf
+            for c in active:  # Only if interrupted by an exception or aborted. The handles' state is unknown, so they are not reused
+                multi.remove_handle(c)
+                c.close()
+            for x in pending:
+                x[2].curl.close()
+        return rv
+
+    def _fetch_states(self, sites):
+        """
+        Starts fetching the sites states in background. Every state is put into the command queue as soon as it is known
+        :param sites: a list of IIS_site_info instances
+        """
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self._fetch_states_async([site.get_name() for site in sites]), self._loop)
+        elif self._method == "psbatch":
+            self._executor.submit(self.get_sites_states, [(site.get_name(), site.get_orig_obj()) for site in sites]) \
+                .add_done_callback(self._on_states_fetched)
+        else:
+            for site in sites:
+                if self._metrics.inc("workers.pending") > self._max_workers:
+                    self._metrics.inc("workers.saturated")
+                future = self._executor.submit(self.get_site_state, (site.get_name(), site.get_orig_obj()), self._method)
+                future.add_done_callback(self._on_worker_done)
+                future.add_done_callback(self._on_states_fetched)
 
-    _allowed_methods = {"wmi", "ps"}
+    def _on_worker_done(self, future):
+        self._metrics.inc("workers.pending", -1)
+
+    def _on_states_fetched(self, future):
+        """
+        :param future: a future of get_site_state or get_sites_states
+        """
+        try:
+            states_info = future.result()
+        except Exception:
+            logging.exception("Unexpected exception while fetching sites states")
+            return
+        self._q.put_nowait(Message.process_data(states_info if isinstance(states_info, list) else [states_info]))
 
-    def __init__(self, q, sq, dq, evt_discovery_done, IIS_sites, iniobj, circs, method="ps", max_workers=10):
+    async def _fetch_states_async(self, names):
+        """
+        Coroutine counterpart of _fetch_states. No more than max_workers states are fetched concurrently
+        :param names: a list of IIS site names
+        """
+        try:
+            if self._method == "psbatch":
+                self._q.put_nowait(Message.process_data(await self.get_sites_states_async(names, self._async_ps_host)))
+            else:
+                semaphore = asyncio.Semaphore(self._max_workers)
+
+                async def fetch(name):
+                    if semaphore.locked():
+                        self._metrics.inc("workers.saturated")
+                    async with semaphore:
+                        self._q.put_nowait(Message.process_data([await self.get_site_state_async(name, self._async_ps_host)]))
+
+                await asyncio.gather(*[fetch(name) for name in names])
+        except Exception:
+            logging.exception("Unexpected exception while fetching sites states")
+
+    def _request_discovery(self):
+        self._evt_discovery_done.clear()
+        if self._loop is None:
+            self._dq.put_nowait(Message.REQUEST)
+        else:
+            asyncio.run_coroutine_threadsafe(self._discover_async(), self._loop)
+
+    async def _discover_async(self):
+        try:
+            await self._discoverer.discover_async(self._async_ps_host)
+        except Exception:
+            logging.exception("Unexpected exception while performing discovery")
+        finally:
+            self._evt_discovery_done.set()
+
+    def _feed(self, timeout):
+        """
+        Feeds the probing loop (see get_sites_probes). Handles the messages from the command queue:
+        discovery is requested and the schedule is updated on every request. The states of the sites due are fetched
+        in background and come back over the command queue, so the started sites are probed as soon as their state is known.
+        A site which is due while it is still being checked is skipped and counted as an overrun.
+        Once asked to stop, no more checks are started, the loop goes on until the checks in progress are finished
+        :param timeout: how long to wait for a message (seconds)
+        :return: a tuple: (list of IIS_site_info instances of the started sites, whether the probing loop should go on)
+        """
+        next_due = self._scheduler.next_due()
+        if next_due is not None:
+            timeout = min(timeout, max(0, next_due - time.monotonic()))
+        if self._discovery_pending:
+            timeout = min(timeout, type(self)._FEED_POLL_INTERVAL)
+        states_info = list()
+        try:
+            msg = self._q.get(timeout=timeout)
+            while True:
+                if msg.kind is MessageKind.PROCESS_DATA:
+                    if msg.data is not None:
+                        states_info.extend(msg.data)
+                    elif not self._discovery_pending:
+                        self._discovery_pending = True
+                        self._request_discovery()
+                elif msg.kind is MessageKind.RECONFIGURE:
+                    self.configure(**msg.data)
+                    logging.info("New configuration has been applied")
+                elif msg.kind is MessageKind.STOP_EXECUTION:
+                    self._stopping = True
+                elif msg.kind is MessageKind.FORCE_STOP_EXECUTION:
+                    self._stopping = True
+                    self._abort.set()
+                msg = self._q.get_nowait()
+        except queue.Empty:
+            pass
+        if self._discovery_pending and self._evt_discovery_done.is_set():
+            self._discovery_pending = False
+            self._schedule_sites()
+            self._send_pulse()
+        data_to_send = list()
+        sites_started = list()
+        for state_info in states_info:
+            site = self._sites.get(state_info.name)
+            if state_info.error is not None or state_info.value != "started" or site is None:
+                self._check_done(state_info.name)
+            if state_info.error is not None:
+                logging.error("Could not fetch the state of {} due to {}".format(state_info.name, state_info.error))
+                continue
+            data_to_send.append(state_info)
+            if state_info.value == "started" and site is not None:
+                sites_started.append(site)
+        if data_to_send:
+            self._put_results(data_to_send)
+        if not self._stopping:
+            due = list()
+            for name in self._scheduler.pop_due():
+                if name in self._in_progress:
+                    self._scheduler.overruns += 1
+                    logging.warning("{} is still being checked. Skipping its check".format(name))
+                else:
+                    due.append(self._sites[name])
+            if due:
+                logging.info("Fetching states of {} site(s) due".format(len(due)))
+                now = time.monotonic()
+                self._in_progress.update((site.get_name(), now) for site in due)
+                self._fetch_states(due)
+        return sites_started, not (self._stopping and not self._discovery_pending and not self._in_progress)
+
+    def _on_probes_done(self, results):
+        for result in results:
+            self._check_done(result.name)
+        self._put_results(results)
+
+    def _check_done(self, name):
+        """
+        :param name: IIS site name whose check is over (it might have been reported already)
+        """
+        started = self._in_progress.pop(name, None)
+        if started is not None:
+            self._metrics.observe("check.time", time.monotonic() - started)
+
+    def _put_results(self, results):
+        """
+        Passes the results over to Sender
+        :param results: a list of Result's instances
+        """
+        self._put_message(Message.process_data(results))
+
+    def _put_message(self, msg):
+        """
+        Puts a message into Sender's queue. In the asyncio runtime, the queue belongs to the event loop,
+        so the message is handed over to it
+        """
+        if self._loop is None:
+            self._sq.put_nowait(msg)
+        else:
+            self._loop.call_soon_threadsafe(self._sq.put_nowait, msg)
+
+    def _get_curl(self, plan, used_keys):
+        """
+        :param plan: an instance of Checker._Plan
+        :param used_keys: keys of the handles taken from the pool during the current probe cycle
+        :return: a tuple: (pooled Curl handle or a new one, whether the handle has the plan's options set).
+        A pooled handle last used by another plan has its options reset
+        """
+        pooled = self._curl_pool.pop(plan.curl_key, None) if plan.curl_key not in used_keys else None
+        if pooled is None:
+            c = pycurl.Curl()
+            c.setopt(pycurl.SHARE, self._curl_share)
+            return c, False
+        c, last_plan = pooled
+        if last_plan is plan:
+            return c, True
+        c.reset()  # Keeps the share, live connections, DNS and TLS session caches
+        return c, False
+
+    def _put_curl(self, probe, used_keys):
+        """
+        Returns the probe's Curl handle to the pool
+        :param probe: an instance of Checker._Probe
+        :param used_keys: keys of the handles taken from the pool during the current probe cycle
+        """
+        key = probe.plan.curl_key
+        used_keys.discard(key)
+        if key in self._curl_pool:
+            self._curl_pool[key][0].close()
+        self._curl_pool[key] = (probe.curl, probe.plan)
+
+    def _evict_curls(self, keys):
+        """
+        Closes pooled Curl handles which are not needed anymore
+        :param keys: keys of the handles to keep
+        """
+        for key in set(self._curl_pool.keys()) - keys:
+            logging.debug("Evicting Curl handle {}".format(key))
+            self._curl_pool.pop(key)[0].close()
+
+    def _close_curls(self):
+        self._evict_curls(set())
+        self._curl_multi.close()
+        self._curl_share.close()
+
+    _allowed_methods = {"wmi", "ps", "psbatch"}
+    _FEED_POLL_INTERVAL = 0.05  # how often to check for new started sites while probing (seconds)
+    _STATE_KEY_PREFIX = "iis.site.state"
+    _PROBE_KEY_PREFIX = "iis.site.probe"
+    _TIMING_KEY_PREFIX = "iis.site.probe.timing"
+    _TIMINGS = ("namelookup_time", "connect_time", "appconnect_time", "starttransfer_time", "total_time",
+                "size_download", "speed_download")  # Curl infos (lower-cased names) sent as the timing items
+    _STATE_NOTFOUND = "notfound"
+    _PS_STATE_CMD = "Get-Website -Name \"{}\"|Select State|ConvertTo-Json -compress"
+    _PS_STATES_CMD = "Get-Website|Select Name,State|ConvertTo-Json -compress"
+    _PULSE_DATA_NAME = "_iis_checker_pulse"
+    _PULSE_KEY_NAME = "iis.site.pulse"
+    _PULSE_DATA = 1
+
+    def __init__(self, q, sq, dq, evt_discovery_done, IIS_sites, iniobj, circs, method="ps", max_workers=10,
+                 max_probes=100, ps_host=None, interval=300, metrics=None):
         """
         :param q: command queue
         :param sq: Sender's command queue
@@ -686,8 +2430,13 @@ class Checker(Utils):
         :param IIS_sites: a WrappedList's instance holding a list of IIS sites filled by Discoverer
         :param iniobj: a parsed ini-file object
         :param circs: a dict of "circumstances" - vars such as the app's file name (aka argv[0]) etc.
-        :param method: a method of fetching data about IIS, may be "wmi" or "ps"
+        :param method: a method of fetching data about IIS, may be "wmi", "ps" or "psbatch"
         :param max_workers: max number of workers in a pool. High values may cause check timeouts due to the cost of fork
+        :param max_probes: max number of HTTP probes running concurrently
+        :param ps_host: a PSHost's or PSHostPool's instance running PowerShell commands (might be shared with Discoverer).
+        Up to max_workers "ps" states are fetched concurrently only if the pool has as many hosts
+        :param interval: interval (seconds) of the checks of the sites which don't have their own one
+        :param metrics: a Metrics' instance to be updated with Checker's metrics and published along with the pulse
         """
         self.validate_value(method, type(self)._allowed_methods, "getting state method")
         self._q = q
@@ -698,56 +2447,108 @@ class Checker(Utils):
         self._cfg = self._Config(iniobj, circs, {"_appglobal"})
         self._method = method
         self._max_workers = max_workers
+        self._max_probes = max_probes
+        self._curl_pool = dict()  # key -> (Curl handle, plan it was last used by). Handles are kept to reuse connections
+        self._plans = dict()  # IIS_site_info instance -> Checker._Plan
+        self._curl_multi = pycurl.CurlMulti()
+        self._curl_share = pycurl.CurlShare()
+        for lock_data in (pycurl.LOCK_DATA_DNS, pycurl.LOCK_DATA_SSL_SESSION):
+            self._curl_share.setopt(pycurl.SH_SHARE, lock_data)
+        if hasattr(pycurl, "LOCK_DATA_CONNECT"):  # Since libcurl 7.57.0
+            self._curl_share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_CONNECT)
+        self._ps_host = ps_host if ps_host is not None else PSHost()
+        self._loop = None  # the event loop of the asyncio runtime (see attach_loop)
+        self._discoverer = None
+        self._async_ps_host = None
+        self._executor = None  # the pool fetching sites states
+        self._abort = threading.Event()
+        self._interval = interval
+        self._sites = dict()  # IIS site name -> IIS_site_info instance of the sites scheduled
+        self._scheduler = Scheduler()
+        self._in_progress = dict()  # names of the sites being checked -> when their checks have started
+        self._discovery_pending = False
+        self._stopping = False
+        self._metrics = metrics if metrics is not None else Metrics()
+        self._metrics.declare(counters=("workers.pending", "workers.saturated"), histograms=("check.time",))
+
+    def configure(self, config, interval=300, method="ps", max_workers=10, max_probes=100):
+        """
+        Sets the parameters which may be changed while running (see __init__ for their description).
+        It's called by the run loop on RECONFIGURE message, so the new parameters are applied between the checks.
+        Curl handles and connections of the sites whose URLs have not changed are kept
+        :param config: a Checker._Config instance
+        """
+        self.validate_value(method, type(self)._allowed_methods, "getting state method")
+        self._cfg = config
+        self._interval = interval
+        self._method = method
+        if self._executor is not None and max_workers != self._max_workers:
+            self._executor.shutdown(wait=False)  # The states being fetched are put into the command queue anyway
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="StateFetcher")
+        self._max_workers = max_workers
+        self._max_probes = max_probes
+        if self._sites:
+            self._schedule_sites()
+
+    def attach_loop(self, loop, discoverer, ps_host):
+        """
+        Makes the Checker run in the asyncio runtime: discovery, sites states fetching and sending are performed
+        by the event loop, while run (the probing loop) is running in a thread of its own
+        :param loop: the event loop
+        :param discoverer: a Discoverer's instance
+        :param ps_host: an AsyncPSHost's instance
+        """
+        self._loop = loop
+        self._discoverer = discoverer
+        self._async_ps_host = ps_host
+
+    def _schedule_sites(self):
+        """
+        Syncs the schedule with the sites discovered. The sites keep their schedule unless their settings change.
+        Probe plans and Curl handles of the sites which are gone are dropped
+        """
+        self._sites = {site.get_name(): site for site in self._IIS_sites.get()}
+        self._plans = {site: self._plans[site] for site in self._sites.values() if site in self._plans}
+        jobs = dict()
+        for name, site in self._sites.items():
+            settings = self._get_plan(site).settings
+            interval = settings.interval if settings.interval is not None else self._interval
+            jobs[name] = (interval, self._scheduler.jitter(name, min(settings.delay, interval)))
+        self._scheduler.sync(jobs)
+        self._evict_curls(set(plan.curl_key for plan in self._plans.values()))
+        logging.debug("{} site(s) scheduled".format(len(self._scheduler)))
+
+    def _send_pulse(self):
+        """
+        Sends the pulse along with the checker's metrics
+        """
+        logging.info("Sending a pulse")
+        self._metrics.set("interval", self._interval)
+        self._metrics.set("sites", len(self._scheduler))
+        self._metrics.set("overruns", self._scheduler.overruns)
+        self._metrics.set("checks.in_progress", len(self._in_progress))
+        self._put_results([Result.make(type(self)._PULSE_DATA_NAME, type(self)._PULSE_KEY_NAME, type(self)._PULSE_DATA)]
+                          + self._metrics.collect(type(self)._PULSE_DATA_NAME))
 
     def run(self):
-        ZBX_PULSE_DATA_NAME = "_iis_checker_pulse"
-        ZBX_PULSE_KEY_NAME = "iis.site.pulse"
-        ZBX_PULSE_DATA = 1
+        """
+        The run loop is the probing loop (see get_sites_probes) fed by _feed, so the sites are probed
+        as soon as they are found started, regardless of the checks of the other sites
+        """
         try:
-            self._sq.put_nowait(Message().send_register_client(threading.current_thread().name))
-            while True:
-                msg = self._q.get()
-                if msg.process_data[0]:
-                    self._evt_discovery_done.clear()
-                    self._dq.put_nowait(Message().send_process_data(None))
-                    self._evt_discovery_done.wait()
-                    if len(self._IIS_sites.get()) > 0:
-                        logging.info("Fetching sites states")
-                        data_to_send = list()
-                        sites_started = set()
-                        num_workers = min(self._max_workers, len(self._IIS_sites.get()))
-                        logging.debug("Fetching sites states using no more than {} worker(s)".format(num_workers))
-                        with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
-                            for state_info in executor.map(self.get_site_state,
-                                                           ((site.get_name(), site.get_orig_obj()) for site in self._IIS_sites.get()),
-                                                           itertools.repeat(self._method, len(self._IIS_sites.get()))):
-                                if isinstance(state_info[2], Exception):
-                                    logging.error("Could not fetch the state of {} due to {}".format(state_info[0], state_info[2]))
-                                    continue
-                                data_to_send.append(state_info)
-                                if state_info[2] == "started":
-                                    sites_started.add(state_info[0])
-                        self._sq.put_nowait(Message().send_process_data(data_to_send))
-                        if len(sites_started) > 0:
-                            logging.info("Probing sites")
-                            time.sleep(5)  # give some time for dust to settle
-                            data_to_send = list()
-                            num_workers = min(self._max_workers, len(sites_started))
-                            logging.debug("Probing sites using no more than {} worker(s)".format(num_workers))
-                            with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
-                                for probe_info in executor.map(self.get_site_probe, (site for site in self._IIS_sites.get() if site.get_name() in sites_started)):
-                                    data_to_send.append(probe_info)
-                            self._sq.put_nowait(Message().send_process_data(data_to_send))
-                    time.sleep(5)  # give some time for dust to settle
-                    logging.info("Sending a pulse")
-                    self._sq.put_nowait(Message().send_process_data((ZBX_PULSE_DATA_NAME, ZBX_PULSE_KEY_NAME, ZBX_PULSE_DATA)))
-                elif msg.stop_execution[0]:
-                    self._sq.put_nowait(Message().send_deregister_client(threading.current_thread().name))
-                    break
-                elif msg.force_stop_execution[0]:
-                    break
+            self._put_message(Message.register_client(threading.current_thread().name))
+            if self._loop is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._max_workers,
+                                                                       thread_name_prefix="StateFetcher")
+            logging.debug("Probing sites using no more than {} concurrent probe(s)".format(self._max_probes))
+            self.get_sites_probes([], feed=self._feed, on_results=self._on_probes_done, abort=self._abort)
+            self._put_message(Message.deregister_client(threading.current_thread().name))
         except:
             logging.exception("Unexpected exception in the run loop")
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+            self._close_curls()
 
 
 class CheckerService(win32serviceutil.ServiceFramework, Utils):
@@ -760,8 +2561,11 @@ class CheckerService(win32serviceutil.ServiceFramework, Utils):
     _MODE_STANDALONE = "standalone"
     _MODE_SERVICE = "service"
     _MODE_DISCOVERY = "discovery"
+    _ALLOWED_RUNTIMES = {"threads", "asyncio"}
+    _RUNTIME_THREADS = "threads"
+    _RUNTIME_ASYNCIO = "asyncio"
     _DEFAULT_INTERVAL = 300
-    _THREADSET_CHECK_INTERVAL = 15
+    _THREADSET_CHECK_INTERVAL = 15  # it's also the interval of checking the config file for changes
     _REG_KEY = win32con.HKEY_LOCAL_MACHINE
     _REG_KEY_NAME = "HKEY_LOCAL_MACHINE"
     _REG_SUBKEY = "SOFTWARE\\Zabbix User Tools\\IIS Checker"
@@ -793,14 +2597,13 @@ class CheckerService(win32serviceutil.ServiceFramework, Utils):
         else:
             self.argv_0 = sys.argv[0]
 
-        self.cfg = configparser.ConfigParser()
-        try:  # find config file if possible. if not found, the defaults will be used
-            if configfile is None:
-                configfile = ".".join([os.path.basename(self.argv_0).rsplit(".", 1)[0], "ini"])
-            configfile = self.make_filename(configfile, self.argv_0)
-            self.cfg.read_file(open(configfile))
-        except FileNotFoundError:
-            pass
+        if configfile is None:  # find config file if possible. if not found, the defaults will be used
+            configfile = ".".join([os.path.basename(self.argv_0).rsplit(".", 1)[0], "ini"])
+        self.configfile = self.make_filename(configfile, self.argv_0)
+        self._config_fingerprint = self._get_config_fingerprint()
+        self._config_new_fingerprint = self._config_fingerprint  # the config file is reloaded when it stops changing
+        try:
+            self.cfg, self._config_hash = self._read_config()
         except OSError:
             logging.critical("Could not read config file", exc_info=True)
             exit(1)
@@ -808,8 +2611,6 @@ class CheckerService(win32serviceutil.ServiceFramework, Utils):
             logging.critical("Could not parse config file", exc_info=True)
             exit(1)
 
-        self.interval = self.cfg.getint(section="_appglobal", option="interval", fallback=type(self)._DEFAULT_INTERVAL)  # IIS checking interval
-
         log_params = dict()  # logging module parameters
         if self.cfg.has_option(section="_appglobal", option="logfile"):
             log_params["filename"] = self.make_filename(self.cfg.get(section="_appglobal", option="logfile"), self.argv_0)
@@ -823,29 +2624,9 @@ class CheckerService(win32serviceutil.ServiceFramework, Utils):
 
         logging.info("Initializing")
 
-        self.discoverer_params = dict()
-        if self.cfg.has_option("_appglobal", "discovery_method"):
-            self.discoverer_params["method"] = self.cfg.get("_appglobal", "discovery_method")
-        if self.cfg.has_option("_appglobal", "discovery_prefproto"):
-            self.discoverer_params["prefproto"] = self.cfg.get("_appglobal", "discovery_prefproto")
-        if self.cfg.has_option("_appglobal", "discovery_prefhost"):
-            self.discoverer_params["prefhost"] = self.cfg.get("_appglobal", "discovery_prefhost")
-
-        self.sender_params = dict()
-        if self.cfg.has_option("_appglobal", "sender_type"):
-            self.sender_params["sender_type"] = self.cfg.get("_appglobal", "sender_type")
-        if self.cfg.has_option("_appglobal", "zbx_srv"):
-            self.sender_params["zbx_srv"] = self.cfg.get("_appglobal", "zbx_srv")
-        if self.cfg.has_option("_appglobal", "zbx_port"):
-            self.sender_params["zbx_port"] = self.cfg.getint("_appglobal", "zbx_port")
-        if self.cfg.has_option("_appglobal", "zbx_host"):
-            self.sender_params["zbx_host"] = self.cfg.get("_appglobal", "zbx_host")
-
-        self.checker_params = dict()
-        if self.cfg.has_option("_appglobal", "check_method"):
-            self.checker_params["method"] = self.cfg.get("_appglobal", "check_method")
-        if self.cfg.has_option("_appglobal", "max_workers"):
-            self.checker_params["max_workers"] = self.cfg.getint("_appglobal", "max_workers")
+        for name, value in vars(self._parse_config(self.cfg)).items():
+            setattr(self, name, value)
+        self.ps_host = PSHostPool(**self.ps_host_params)  # PowerShell hosts shared by Discoverer and Checker
 
         self.qsender = queue.Queue()  # Sender's queue
         self.qdiscoverer = queue.Queue()  # Discoverer's queue
@@ -853,9 +2634,159 @@ class CheckerService(win32serviceutil.ServiceFramework, Utils):
         self.ediscovery = threading.Event()  # "Discovery done" event
         self.estop = threading.Event() # "Application stop" event
         self.sites = WrappedList()  # IIS sites discovered
+        self.metrics = Metrics()  # self-instrumentation shared by the threads
         threading.Thread(target=self._shutdown, name="Shutdowner").start()  # Control is sent to this thread from SvcStop to ensure fast response to service manager
         self.shutdown_init = False  # Whether the shutdown process has been initiated
         self.init_threadset = set(t.name for t in threading.enumerate())  # Set of threads at the begginnig. We are not supposed to kill them
+        self.loop = None  # Event loop of the asyncio runtime
+        self.astop = None  # "Application stop" asyncio event of the asyncio runtime
+
+    def _get_config_fingerprint(self):
+        """
+        :return: a fingerprint of the config file or None if it can't be got
+        """
+        try:
+            st = os.stat(self.configfile)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _read_config(self, missing_ok=True):
+        """
+        :param missing_ok: whether the defaults are used if the config file is not found
+        :return: a tuple: (parsed ini-file object, hash of the config file or None if the file is not found)
+        """
+        cfg = configparser.ConfigParser()
+        try:
+            with open(self.configfile, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            if not missing_ok:
+                raise
+            return cfg, None
+        cfg.read_file(io.TextIOWrapper(io.BytesIO(data)), self.configfile)
+        return cfg, hashlib.sha1(data).digest()
+
+    def _parse_config(self, cfg):
+        """
+        :param cfg: a parsed ini-file object
+        :return: a namespace with the app's parameters (interval, runtime and the parameters of the app's parts)
+        """
+        params = types.SimpleNamespace()
+        params.interval = cfg.getint(section="_appglobal", option="interval", fallback=type(self)._DEFAULT_INTERVAL)  # IIS checking interval
+        params.runtime = cfg.get(section="_appglobal", option="runtime", fallback=type(self)._RUNTIME_THREADS)
+        self.validate_value(params.runtime, type(self)._ALLOWED_RUNTIMES, "runtime")
+
+        params.discoverer_params = dict()
+        if cfg.has_option("_appglobal", "discovery_method"):
+            params.discoverer_params["method"] = cfg.get("_appglobal", "discovery_method")
+        if cfg.has_option("_appglobal", "discovery_prefproto"):
+            params.discoverer_params["prefproto"] = cfg.get("_appglobal", "discovery_prefproto")
+        if cfg.has_option("_appglobal", "discovery_prefhost"):
+            params.discoverer_params["prefhost"] = cfg.get("_appglobal", "discovery_prefhost")
+        if cfg.has_option("_appglobal", "discovery_iisconfig"):
+            params.discoverer_params["iis_config"] = self.make_filename(cfg.get("_appglobal", "discovery_iisconfig"), self.argv_0)
+
+        params.sender_params = dict()
+        if cfg.has_option("_appglobal", "sender_type"):
+            params.sender_params["sender_type"] = cfg.get("_appglobal", "sender_type")
+        if cfg.has_option("_appglobal", "zbx_srv"):
+            params.sender_params["zbx_srv"] = cfg.get("_appglobal", "zbx_srv")
+        if cfg.has_option("_appglobal", "zbx_port"):
+            params.sender_params["zbx_port"] = cfg.getint("_appglobal", "zbx_port")
+        if cfg.has_option("_appglobal", "zbx_host"):
+            params.sender_params["zbx_host"] = cfg.get("_appglobal", "zbx_host")
+        if cfg.has_option("_appglobal", "sender_batch_size"):
+            params.sender_params["batch_size"] = cfg.getint("_appglobal", "sender_batch_size")
+        if cfg.has_option("_appglobal", "sender_linger"):
+            params.sender_params["linger"] = cfg.getfloat("_appglobal", "sender_linger")
+        if cfg.has_option("_appglobal", "zbx_compress_threshold"):
+            params.sender_params["compress_threshold"] = cfg.getint("_appglobal", "zbx_compress_threshold")
+        if params.sender_params.get("batch_size", 1) < 1:
+            raise ValueError("_appglobal.sender_batch_size should be a positive integer")
+        if params.sender_params.get("linger", 0) < 0:
+            raise ValueError("_appglobal.sender_linger should not be negative")
+
+        params.spool_params = dict()
+        params.spool_params["filename"] = cfg.get("_appglobal", "spool_file",
+                                                 fallback=".".join([os.path.basename(self.argv_0).rsplit(".", 1)[0], "spool"]))
+        if params.spool_params["filename"]:
+            params.spool_params["filename"] = self.make_filename(params.spool_params["filename"], self.argv_0)
+        if cfg.has_option("_appglobal", "spool_max_size"):
+            params.spool_params["max_size"] = cfg.getint("_appglobal", "spool_max_size")
+        if cfg.has_option("_appglobal", "spool_max_age"):
+            params.spool_params["max_age"] = cfg.getint("_appglobal", "spool_max_age")
+
+        params.checker_params = dict()
+        if cfg.has_option("_appglobal", "check_method"):
+            params.checker_params["method"] = cfg.get("_appglobal", "check_method")
+        if cfg.has_option("_appglobal", "max_workers"):
+            params.checker_params["max_workers"] = cfg.getint("_appglobal", "max_workers")
+        if cfg.has_option("_appglobal", "max_probes"):
+            params.checker_params["max_probes"] = cfg.getint("_appglobal", "max_probes")
+
+        params.ps_host_params = dict()
+        if cfg.has_option("_appglobal", "ps_exe"):
+            params.ps_host_params["ps_exe"] = cfg.get("_appglobal", "ps_exe")
+        if cfg.has_option("_appglobal", "ps_timeout"):
+            params.ps_host_params["timeout"] = cfg.getint("_appglobal", "ps_timeout")
+        if cfg.has_option("_appglobal", "ps_hosts"):
+            params.ps_host_params["size"] = cfg.getint("_appglobal", "ps_hosts")
+        else:
+            params.ps_host_params["size"] = params.checker_params.get("max_workers", 10)
+        return params
+
+    def _reload_config(self):
+        """
+        Checks if the config file has changed. The config file is reloaded when it is found unchanged since the previous check,
+        so a file being written is not read. A changed config file is parsed and validated as a whole,
+        the current config is kept if the new one is invalid. The parameters which can't be changed while running
+        (runtime, spool, PowerShell, discovery method and sender type) are kept as they are until restart
+        :return: a dict of RECONFIGURE messages for the app's parts ("discoverer", "sender", "checker")
+        or None if the config has not changed or is invalid
+        """
+        config_fingerprint = self._get_config_fingerprint()
+        if config_fingerprint == self._config_fingerprint:
+            return None
+        if config_fingerprint != self._config_new_fingerprint:
+            self._config_new_fingerprint = config_fingerprint
+            return None
+        self._config_fingerprint = config_fingerprint
+        try:
+            cfg, config_hash = self._read_config(missing_ok=False)
+            if config_hash == self._config_hash:
+                return None
+            params = self._parse_config(cfg)
+            config = Checker._Config(cfg, {"argv_0": self.argv_0}, {"_appglobal"})
+            if params.interval <= 0:
+                raise ValueError("_appglobal.interval should be a positive integer")
+            self.validate_value(params.checker_params.get("method", "ps"), Checker._allowed_methods, "getting state method")
+            if self.runtime == type(self)._RUNTIME_ASYNCIO:
+                self.validate_value(params.checker_params.get("method", "ps"), {"ps", "psbatch"}, "check method of asyncio runtime")
+        except (OSError, configparser.Error, ValueError) as exc:
+            logging.error("Config file has changed, but it is invalid: {}. Keeping the current config".format(exc))
+            return None
+        self._config_hash = config_hash
+        restart_required = list()
+        for name in ("runtime", "spool_params", "ps_host_params"):
+            if getattr(params, name) != getattr(self, name):
+                restart_required.append(name)
+                setattr(params, name, getattr(self, name))
+        for name, key in (("discoverer_params", "method"), ("sender_params", "sender_type")):
+            if getattr(params, name).get(key) != getattr(self, name).get(key):
+                restart_required.append("{}.{}".format(name, key))
+                getattr(params, name).pop(key, None)
+                if key in getattr(self, name):
+                    getattr(params, name)[key] = getattr(self, name)[key]
+        if restart_required:
+            logging.warning("Changes of {} take effect after restart".format(", ".join(restart_required)))
+        logging.warning("Config file has changed. Applying the new config")
+        self.cfg = cfg
+        for name, value in vars(params).items():
+            setattr(self, name, value)
+        return {"discoverer": Message.reconfigure({k: v for k, v in self.discoverer_params.items() if k != "method"}),
+                "sender": Message.reconfigure({k: v for k, v in self.sender_params.items() if k != "sender_type"}),
+                "checker": Message.reconfigure(dict(self.checker_params, config=config, interval=self.interval))}
 
     def _get_died_threadset(self):
         logging.debug("Init threadset: {}".format(self.init_threadset))
@@ -866,15 +2797,21 @@ class CheckerService(win32serviceutil.ServiceFramework, Utils):
     def _shutdown(self):
         self.estop.wait()
         logging.warning("Shutting down")
+        if self.loop is not None:
+            try:
+                self.loop.call_soon_threadsafe(self.astop.set)
+            except RuntimeError:  # The loop is closed already
+                pass
         died_threadset = self._get_died_threadset()
         for q in self.shutdown_sequence:
             if q[1].name not in died_threadset:
                 if len(died_threadset) > 0:
-                    q[0].put_nowait(Message().send_force_stop_execution())
+                    q[0].put_nowait(Message.FORCE_STOP_EXECUTION)
                 else:
-                    q[0].put_nowait(Message().send_stop_execution())
+                    q[0].put_nowait(Message.STOP_EXECUTION)
                 logging.info("Waiting for {} to shut down".format(q[1].name))
                 q[1].join()
+        self.ps_host.close()
 
     def _startup(self):
         logging.warning("Starting up in {} mode".format(self.mode))
@@ -882,14 +2819,23 @@ class CheckerService(win32serviceutil.ServiceFramework, Utils):
         self.expected_threadset = self.init_threadset | set()
         self.shutdown_sequence = list()
 
+        if self.runtime == type(self)._RUNTIME_ASYNCIO and self.mode in {type(self)._MODE_STANDALONE, type(self)._MODE_SERVICE}:
+            self.validate_value(self.discoverer_params.get("method", "ps"), {"ps"}, "discovery method of asyncio runtime")
+            self.validate_value(self.checker_params.get("method", "ps"), {"ps", "psbatch"}, "check method of asyncio runtime")
+            logging.info("Using asyncio runtime")
+            return  # Everything runs in the event loop started by _run_checker
+
         self.tdiscoverer = threading.Thread(target=Discoverer(q=self.qdiscoverer, evt_discovery_done=self.ediscovery, IIS_sites=self.sites,
+                                                              ps_host=self.ps_host, metrics=self.metrics,
                                                               **self.discoverer_params).run, name="Discoverer")
         self.tdiscoverer.start()
         self.expected_threadset = self.expected_threadset | {self.tdiscoverer.name}
         self.shutdown_sequence.append((self.qdiscoverer, self.tdiscoverer))
 
         if (self.mode in {type(self)._MODE_STANDALONE, type(self)._MODE_SERVICE}):
-            self.tsender = threading.Thread(target=Sender(q=self.qsender, **self.sender_params).run, name="Sender")
+            spool = Spool(**self.spool_params) if self.spool_params["filename"] else None
+            self.tsender = threading.Thread(target=Sender(q=self.qsender, spool=spool, metrics=self.metrics,
+                                                      **self.sender_params).run, name="Sender")
             self.tsender.start()
             self.tchecker = threading.Thread(target=Checker(q=self.qchecker,
                                                             sq=self.qsender,
@@ -898,6 +2844,9 @@ class CheckerService(win32serviceutil.ServiceFramework, Utils):
                                                             IIS_sites=self.sites,
                                                             iniobj=self.cfg,
                                                             circs={"argv_0":self.argv_0},
+                                                            ps_host=self.ps_host,
+                                                            interval=self.interval,
+                                                            metrics=self.metrics,
                                                             **self.checker_params).run, name="Checker")
             self.tchecker.start()
             self.expected_threadset = self.expected_threadset | {t.name for t in (self.tsender, self.tchecker)}
@@ -905,7 +2854,77 @@ class CheckerService(win32serviceutil.ServiceFramework, Utils):
 
         self.shutdown_sequence.reverse()
 
+    async def _run_async(self):
+        """
+        asyncio runtime: discovery, states fetching, probing and sending run in a single event loop.
+        The loop stops as soon as shutdown is initiated or the Checker or the Sender dies
+        """
+        self.loop = asyncio.get_running_loop()
+        self.astop = asyncio.Event()
+        if self.estop.is_set():  # Shutdown has been initiated before the loop was started
+            return
+        ps_host = AsyncPSHostPool(**self.ps_host_params)
+        spool = Spool(**self.spool_params) if self.spool_params["filename"] else None
+        sender = Sender(q=asyncio.Queue(), spool=spool, metrics=self.metrics, **self.sender_params)
+        discoverer = Discoverer(q=None, evt_discovery_done=None, IIS_sites=self.sites, ps_host=self.ps_host,
+                                metrics=self.metrics, **self.discoverer_params)
+        checker = Checker(q=queue.Queue(),
+                          sq=sender.q,
+                          dq=None,
+                          evt_discovery_done=threading.Event(),
+                          IIS_sites=self.sites,
+                          iniobj=self.cfg,
+                          circs={"argv_0": self.argv_0},
+                          ps_host=self.ps_host,
+                          interval=self.interval,
+                          metrics=self.metrics,
+                          **self.checker_params)
+        checker.attach_loop(self.loop, discoverer, ps_host)
+        checker_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="Checker")
+        tsender = asyncio.ensure_future(sender.run_async())
+        tstop = asyncio.ensure_future(self.astop.wait())
+        tcheck = self.loop.run_in_executor(checker_executor, checker.run)
+        next_request = time.monotonic()
+        try:
+            while True:
+                if next_request <= time.monotonic():
+                    logging.info("Requesting check")
+                    checker._q.put_nowait(Message.REQUEST)
+                    next_request += self.interval
+                    if next_request <= time.monotonic():  # Don't try to catch up with the missed requests
+                        next_request = time.monotonic() + self.interval
+                await asyncio.wait([tcheck, tstop, tsender], return_when=asyncio.FIRST_COMPLETED,
+                                   timeout=min(next_request - time.monotonic(), type(self)._THREADSET_CHECK_INTERVAL))
+                if tcheck.done() or tstop.done() or tsender.done():
+                    break
+                messages = self._reload_config()
+                if messages is not None:
+                    discoverer.configure(**messages["discoverer"].data)
+                    sender.q.put_nowait(messages["sender"])
+                    checker._q.put_nowait(messages["checker"])
+            for name, task in (("Checker", tcheck), ("Sender", tsender)):
+                if task.done():
+                    exc = None if task.cancelled() else task.exception()
+                    logging.critical("{} has died{}. Shutting down".format(name, "" if exc is None else " due to {}".format(exc)),
+                                     exc_info=exc)
+                    break
+            else:
+                logging.debug("Shutdown initiated. Breaking the checker loop")
+        finally:
+            checker._q.put_nowait(Message.FORCE_STOP_EXECUTION)  # Aborts the probes in progress
+            await asyncio.wait([tcheck])
+            checker_executor.shutdown(wait=False)
+            for task in (tstop, tsender):  # Sender sends the data it has got so far when cancelled
+                if not task.done():
+                    task.cancel()
+                    await asyncio.wait([task])
+            await ps_host.close()
+            self.estop.set()
+
     def _run_checker(self):
+        if self.runtime == type(self)._RUNTIME_ASYNCIO:
+            asyncio.run(self._run_async())
+            return
         time_slept = max(self.interval - type(self)._THREADSET_CHECK_INTERVAL, type(self)._THREADSET_CHECK_INTERVAL)
         stop = False
         while True:
@@ -921,6 +2940,11 @@ class CheckerService(win32serviceutil.ServiceFramework, Utils):
                     self.estop.set()
                     stop = True
                     break
+                messages = self._reload_config()
+                if messages is not None:
+                    self.qdiscoverer.put_nowait(messages["discoverer"])
+                    self.qsender.put_nowait(messages["sender"])
+                    self.qchecker.put_nowait(messages["checker"])
                 time_slept += type(self)._THREADSET_CHECK_INTERVAL
                 if time_slept <= self.interval:
                     time.sleep(type(self)._THREADSET_CHECK_INTERVAL)
@@ -930,7 +2954,7 @@ class CheckerService(win32serviceutil.ServiceFramework, Utils):
             if not stop:
                 time_slept = 0
                 logging.info("Requesting check")
-                self.qchecker.put_nowait(Message().send_process_data(None))
+                self.qchecker.put_nowait(Message.REQUEST)
             else:
                 break
 
@@ -963,13 +2987,34 @@ class CheckerService(win32serviceutil.ServiceFramework, Utils):
             raise Exception("Checker can not run if the instance mode is not \"{}\"".format(type(self)._MODE_STANDALONE))
         self._run_checker()
 
-    def DoDiscovery(self):
+    def DoDiscovery(self, subject="sites"):
+        """
+        :param subject: "sites" or "paths". The latter are the paths probed (see "path" setting) of the sites
+        with the timing items (see "timing" setting)
+        :return: LLD JSON
+        """
         if self.mode != type(self)._MODE_DISCOVERY:
             raise Exception("Discovery can not be performed if the instance mode is not \"{}\"".format(type(self)._MODE_DISCOVERY))
+        self.validate_value(subject, {"sites", "paths"}, "discovery subject")
         logging.info("Performing discovery only")
-        self.qdiscoverer.put_nowait(Message().send_process_data(None))
+        self.qdiscoverer.put_nowait(Message.REQUEST)
         self.ediscovery.wait()
-        zabbix_data = {"data": [{
+        if subject == "sites":
+            return json.dumps({"data": [self._get_site_macros(site) for site in self.sites.get()]})
+        config = Checker._Config(self.cfg, {"argv_0": self.argv_0}, {"_appglobal"})
+        zabbix_data = list()
+        for site in self.sites.get():
+            settings = config.get(site.get_hostnames())
+            if settings.timing:
+                zabbix_data.extend(dict(self._get_site_macros(site), **{"{#SITE_PATH}": p.path}) for p in settings.path)
+        return json.dumps({"data": zabbix_data})
+
+    def _get_site_macros(self, site):
+        """
+        :param site: an instance of IIS_site_info
+        :return: a dict of the site's LLD macros
+        """
+        return {
             "{#SITE_NAME}": site.get_name(),
             "{#SITE_START}": site.get_startuptype(),
             "{#SITE_PROTO}": site.get_pref_binding()["proto"],
@@ -977,18 +3022,49 @@ class CheckerService(win32serviceutil.ServiceFramework, Utils):
             "{#SITE_ALL_HOSTS}": self._hostlist_separator.join(site.get_normalised_hostnames()),
             "{#SITE_PORT}": site.get_pref_binding()["port"],
             "{#SITE_ADDR}": site.get_pref_binding()["addr"]}
-            for site in self.sites.get()]}
-        return json.dumps(zabbix_data)
+
+
+def benchmark(messages_num, results_num):
+    """
+    Measures throughput of the messages passed through Sender's queue and dispatched by its run loop.
+    The batches are dropped instead of being sent
+    :param messages_num: number of messages
+    :param results_num: number of results in a message
+    :return: a list of report lines
+    """
+    q = queue.Queue()
+    sender = Sender(q, batch_size=1000, linger=2)
+    sender._send = lambda batch: None
+    results = [Result.make("site{}".format(i), "iis.site.state[site{}]".format(i), "started") for i in range(results_num)]
+    tsender = threading.Thread(target=sender.run, name="Sender")
+    started = time.perf_counter()
+    tsender.start()
+    q.put_nowait(Message.register_client("benchmark"))
+    for i in range(messages_num):
+        q.put_nowait(Message.process_data(results))
+    q.put_nowait(Message.deregister_client("benchmark"))
+    q.put_nowait(Message.STOP_EXECUTION)
+    tsender.join()
+    elapsed = time.perf_counter() - started
+    return ["{:20} {:12.0f} messages/s".format("Sender queue", messages_num / elapsed),
+            "{:20} {:12.0f} results/s".format("Sender queue", messages_num * results_num / elapsed)]
 
 
 if __name__ == "__main__":
 
     cmd = argparse.ArgumentParser(description="IIS sites checker")
     group = cmd.add_mutually_exclusive_group()
-    group.add_argument("-discover", help="perform sites discovery, print them in JSON format to STDOUT and exit",
-                     action="store_true", default=False)
+    group.add_argument("-discover", help="perform discovery of the sites (default) or of the probed paths of the sites, "
+                                         "print them in JSON format to STDOUT and exit",
+                       nargs="?", const="sites", choices=["sites", "paths"], default=None)
     group.add_argument("-register", help="write registry values required when the app is running in service mode",
                        action="store_true", default=False)
+    group.add_argument("-benchmark", help="measure throughput of the messages passed to Sender and exit",
+                       action="store_true", default=False)
+    cmd.add_argument("-messages", help="number of messages to pass when benchmarking (200000)", metavar="number",
+                     type=int, default=200000)
+    cmd.add_argument("-results", help="number of results in a message when benchmarking (1)", metavar="number",
+                     type=int, default=1)
     cmd.add_argument("-configfile", help="path to config file")
     cmd.add_argument("-version", action="version", version=_FILE_VER)
     cmd.add_argument("mode", help="usage mode (*standalone)", choices=["standalone", "service"], nargs="?", default="standalone")
@@ -999,10 +3075,13 @@ if __name__ == "__main__":
         print("Registering {}".format(os.path.abspath(sys.argv[0])), file=sys.stderr)
         hk = win32api.RegCreateKeyEx(CheckerService._REG_KEY, CheckerService._REG_SUBKEY, win32con.KEY_WRITE)[0]
         win32api.RegSetValueEx(hk, CheckerService._REG_VALUE_NAME, 0, win32con.REG_SZ, os.path.abspath(sys.argv[0]))
+    elif cmdargs.benchmark:
+        for line in benchmark(cmdargs.messages, cmdargs.results):
+            print(line)
     elif cmdargs.discover:
         checker = CheckerService(args=None, mode=CheckerService._MODE_DISCOVERY, configfile=cmdargs.configfile)
         checker.DoStartup()
-        print(checker.DoDiscovery(), end="")
+        print(checker.DoDiscovery(cmdargs.discover), end="")
         logging.debug("Calling DoShutdown")
         checker.DoShutdown()
     elif cmdargs.mode == "standalone":
@@ -2,13 +2,21 @@
 
 import redis
 import argparse
-import re
-import pyzabbix
+import bisect
+import configparser
+import concurrent.futures
+import math
+import json
+import socket
+import threading
+import zabbix_trapper
+import zabbix_utils
 import time
 import logging
 import logging.handlers
 import os
 import os.path
+import random
 import sys
 import daemon
 import pidfile
@@ -30,10 +38,665 @@ def tr_vars(all_vars, target_vars, spec_vars):
                 tv[sv[var]] = getattr(all_vars, var)
 
 
+class LatencyHistogram:
+    """
+    Thread-safe histogram of latencies with logarithmic buckets. It's reset every time it's collected
+    """
+
+    _BOUNDS = tuple(0.0001 * 2 ** i for i in range(18))  # Buckets upper bounds (seconds): 100us .. 13s
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._buckets = [0] * (len(type(self)._BOUNDS) + 1)
+        self._count = 0
+        self._sum = 0.0
+        self._max = 0.0
+        self._errors = 0
+
+    def observe(self, value):
+        """
+        :param value: latency (seconds)
+        """
+        i = bisect.bisect_left(type(self)._BOUNDS, value)
+        with self._lock:
+            self._buckets[i] += 1
+            self._count += 1
+            self._sum += value
+            if value > self._max:
+                self._max = value
+
+    def error(self):
+        """
+        Counts a request which has failed and hence has no latency
+        """
+        with self._lock:
+            self._errors += 1
+
+    def collect(self):
+        """
+        :return: a dict of the stats since the previous collection: count, errors, avg, max, p50, p95, p99.
+        The percentiles are the upper bounds of the buckets they fall in (but no more than max)
+        """
+        with self._lock:
+            buckets, count, total, max_, errors = self._buckets, self._count, self._sum, self._max, self._errors
+            self._reset()
+        rv = {"count": count, "errors": errors}
+        if not count:
+            return rv
+        rv["avg"] = total / count
+        rv["max"] = max_
+        for q in (50, 95, 99):
+            rank = count * q / 100
+            seen = 0
+            for bound, n in zip(type(self)._BOUNDS + (max_,), buckets):
+                seen += n
+                if seen >= rank:
+                    rv["p{}".format(q)] = min(bound, max_)
+                    break
+        return rv
+
+
+class SpaceSaving:
+    """
+    Bounded summary of the heaviest entries (Space-Saving algorithm). When it's full, a new entry replaces the lightest
+    one and inherits its weight, which is the upper bound of the new entry's weight overestimation
+    """
+
+    def __init__(self, capacity):
+        """
+        :param capacity: max number of the entries kept
+        """
+        self.capacity = capacity
+        self.entries = dict()  # Name -> [weight, error, count, {kind: count}]
+
+    def add(self, name, weight, kind=None):
+        """
+        :param name: entry name
+        :param weight: weight added to the entry
+        :param kind: entry's item kind to count, if known
+        """
+        entry = self.entries.get(name)
+        if entry is None:
+            floor = 0
+            if len(self.entries) >= self.capacity:
+                floor = self.entries.pop(min(self.entries, key=lambda x: self.entries[x][0]))[0]
+            entry = self.entries[name] = [floor, floor, 0, dict()]
+        entry[0] += weight
+        entry[2] += 1
+        if kind is not None:
+            entry[3][kind] = entry[3].get(kind, 0) + 1
+
+    def top(self, n):
+        """
+        :return: a list of n heaviest entries: (name, weight, error, count, the most frequent kind or None)
+        """
+        return [(k, v[0], v[1], v[2], max(v[3], key=v[3].get) if v[3] else None)
+                for k, v in sorted(self.entries.items(), key=lambda x: x[1][0], reverse=True)[:n]]
+
+
+class KeyspaceProfiler:
+    """
+    Walks the keyspace of a Redis database with SCAN in background and samples the keys memory usage and types.
+    Memory and keys are aggregated by the keys prefixes. Redis commands rate is limited by the budget. The walk
+    resumes from the cursor it has stopped at, so a pass over the keyspace may span many polls. The results
+    of the last completed pass are reported
+    """
+
+    _ERROR_PAUSE = 30  # Pause after a failed step (seconds)
+
+    def __init__(self, client, name, budget=100, sample_rate=0.1, depth=1, delimiter=":", top=20, scan_count=100):
+        """
+        :param client: Redis client
+        :param name: Redis instance name
+        :param budget: max number of Redis commands per second. SCAN counts as a single command
+        :param sample_rate: share of the keys scanned which memory usage and type are sampled
+        :param depth: number of the key's segments its prefix consists of
+        :param delimiter: key segments delimiter
+        :param top: number of the heaviest prefixes reported
+        :param scan_count: COUNT hint of SCAN
+        """
+        if budget <= 0 or not 0 < sample_rate <= 1 or depth < 1 or top < 1 or not delimiter:
+            raise ValueError("Keyspace profiler settings are invalid")
+        self.client = client
+        self.name = name
+        self.budget = budget
+        self.sample_rate = sample_rate
+        self.depth = depth
+        self.delimiter = delimiter
+        self.top = top
+        self.scan_count = scan_count
+        self.cursor = 0
+        self.scanned = 0  # Keys scanned by the current pass
+        self.result = None  # (top prefixes, keys, memory, duration) of the last completed pass
+        self._prefixes = SpaceSaving(top * 10)
+        self._memory = 0.0
+        self._pass_started = time.monotonic()
+        self._closed = threading.Event()
+        threading.Thread(target=self._run, name="Profiler {}".format(name), daemon=True).start()
+
+    def get_prefix(self, key):
+        """
+        :param key: Redis key (bytes)
+        :return: the key's prefix pattern, e.g. "tenant1:*". The keys having less segments get "(other)"
+        """
+        segments = key.decode("utf-8", "backslashreplace").split(self.delimiter, self.depth)
+        if len(segments) <= self.depth:
+            return "(other)"
+        return self.delimiter.join(segments[:self.depth]) + self.delimiter + "*"
+
+    def _run(self):
+        while not self._closed.is_set():
+            started = time.monotonic()
+            try:
+                commands = self._step()
+            except Exception as exc:
+                logging.warning("Problem profiling keyspace of Redis instance \"{}\": {}".format(self.name, exc))
+                self._closed.wait(type(self)._ERROR_PAUSE)
+                continue
+            self._closed.wait(commands / self.budget - (time.monotonic() - started))
+
+    def _step(self):
+        """
+        Scans the next batch of the keys and samples some of them
+        :return: number of Redis commands used
+        """
+        cursor, keys = self.client.scan(self.cursor, count=self.scan_count)
+        sampled = [x for x in keys if random.random() < self.sample_rate]
+        replies = list()
+        if sampled:
+            pipe = self.client.pipeline(transaction=False)
+            for key in sampled:
+                pipe.memory_usage(key)
+                pipe.type(key)
+            replies = pipe.execute(raise_on_error=False)
+        usage = dict()
+        for key, memory, key_type in zip(sampled, replies[::2], replies[1::2]):
+            if isinstance(memory, int):  # The key may be gone already
+                usage[key] = (memory / self.sample_rate,
+                              key_type.decode("ascii", "replace") if isinstance(key_type, bytes) else key_type)
+        for key in keys:
+            memory, key_type = usage.get(key, (0, None))
+            self._prefixes.add(self.get_prefix(key), memory, key_type)
+            self._memory += memory
+        self.scanned += len(keys)
+        self.cursor = int(cursor)
+        if self.cursor == 0:
+            self.result = (self._prefixes.top(self.top), self.scanned, self._memory,
+                           time.monotonic() - self._pass_started)
+            self._prefixes = SpaceSaving(self.top * 10)
+            self._memory = 0.0
+            self.scanned = 0
+            self._pass_started = time.monotonic()
+        return 1 + len(sampled) * 2
+
+    def collect(self):
+        """
+        :return: a list of Zabbix items: (Zabbix key, Zabbix value). Prefixes items are there
+        once the first pass is completed
+        """
+        rv = [("redis.keyspace.profile[scanned]", self.scanned)]
+        result = self.result
+        if result is None:
+            return rv
+        prefixes, keys, memory, duration = result
+        rv.extend([("redis.keyspace.profile[keys]", keys), ("redis.keyspace.profile[memory]", int(memory)),
+                   ("redis.keyspace.profile[duration]", duration)])
+        for prefix, weight, error, count, key_type in prefixes:
+            prefix = zabbix_utils.quote_key_param(prefix)
+            rv.extend([("redis.keyspace.prefix[{},memory]".format(prefix), int(weight)),
+                       ("redis.keyspace.prefix[{},keys]".format(prefix), count),
+                       ("redis.keyspace.prefix[{},type]".format(prefix), key_type or "unknown")])
+        return rv
+
+    def get_prefixes(self):
+        """
+        :return: the prefixes reported or None if no pass is completed yet
+        """
+        return [x[0] for x in self.result[0]] if self.result is not None else None
+
+    def close(self):
+        self._closed.set()
+
+
+class RedisInstance:
+    """
+    A Redis instance polled by the script. Its connections are pooled and kept between the polls
+    """
+
+    _SECTIONS = ("server", "clients", "memory", "stats", "keyspace")
+    _WANTED_PROPS = {"used_memory", "used_memory_rss", "used_memory_peak", "maxmemory",
+                     "mem_fragmentation_ratio", "expired_keys", "evicted_keys", "keyspace_hits",
+                     "keyspace_misses", "connected_clients", "total_connections_received",
+                     "rejected_connections", "instantaneous_ops_per_sec", "instantaneous_input_kbps",
+                     "instantaneous_output_kbps", "redis_version"}
+    # Cumulative counters sent as per second rates too
+    _COUNTERS = ("expired_keys", "evicted_keys", "keyspace_hits", "keyspace_misses", "total_connections_received",
+                 "rejected_connections")
+    # INFO fields the values sent are computed from. They are parsed even if they aren't wanted themselves
+    _REQUIRED_PROPS = {"run_id", "uptime_in_seconds", "used_memory", "maxmemory", "mem_fragmentation_ratio"} | \
+        set(_COUNTERS)
+    _REQUIRED_SECTIONS = {"server", "memory", "stats"}
+    _SLOWLOG_BATCH = 32  # Slowlog entries fetched every poll. If they all are new, up to _SLOWLOG_MAX are re-fetched
+    _SLOWLOG_MAX = 1024
+    _SLOWLOG_COMMAND_MAX = 256  # Command line of a slowlog entry is truncated to this length
+    _DISCOVERY_RESEND = 3600  # Unchanged discovery data is re-sent this often (seconds)
+
+    def __init__(self, name, zhost, host="localhost", port=6379, socket_path=None, password=None, db=0, timeout=10,
+                 ewma_windows=(900, 3600), sections=None, wanted_props=None, latency=False, ping_interval=1,
+                 profile=None):
+        """
+        :param name: instance name
+        :param zhost: Zabbix monitored host ID the instance's items belong to
+        :param host: Redis host
+        :param port: Redis port
+        :param socket_path: Redis unix socket. If set, host and port are ignored
+        :param password: Redis password
+        :param db: Redis database number
+        :param timeout: Redis connect and command timeout (seconds)
+        :param ewma_windows: time windows (seconds) of the exponentially weighted moving averages of keyspace hit ratio
+        :param sections: INFO sections requested. Default ones are used if not set
+        :param wanted_props: INFO fields sent. Default ones are used if not set
+        :param latency: whether to collect latency stats: PING round-trip times, latency events, new slowlog entries
+        and commands execution times
+        :param ping_interval: how frequently to measure PING round-trip time if latency is collected (seconds)
+        :param profile: a dict of KeyspaceProfiler's args to profile the keyspace with, or None to not profile it
+        """
+        self.name = name
+        self.zhost = zhost
+        self.ewma_windows = ewma_windows
+        self.sections = tuple(sections or type(self)._SECTIONS)
+        missing_sections = type(self)._REQUIRED_SECTIONS.difference(self.sections)
+        if missing_sections:
+            raise ValueError("INFO sections {} are required".format(", ".join(sorted(missing_sections))))
+        self.wanted_props = frozenset(wanted_props or type(self)._WANTED_PROPS)
+        self._parsed_props = self.wanted_props | type(self)._REQUIRED_PROPS
+        self._prev_sample = None
+        self._ewma = dict()  # EWMA window -> [keyspace hits rate, keyspace misses rate]
+        conn_vars = {"password": password, "db": db, "socket_timeout": timeout, "socket_connect_timeout": timeout}
+        if socket_path is not None:
+            conn_vars["path"] = socket_path
+            conn_vars["connection_class"] = redis.UnixDomainSocketConnection
+            del conn_vars["socket_connect_timeout"]
+        else:
+            conn_vars["host"] = host
+            conn_vars["port"] = port
+        self.pool = redis.ConnectionPool(**conn_vars)
+        self.client = redis.StrictRedis(connection_pool=self.pool)
+        self.client.set_response_callback("INFO", lambda response, **options: response)  # Parsed by _parse_info
+        self.latency = latency
+        self._slowlog_id = None  # ID of the newest slowlog entry seen
+        self._events = None  # Latency event -> time of its latest spike seen
+        self._prev_commandstats = None
+        self._discovered = dict()  # Discovery key -> (time.monotonic() it was sent at, names sent)
+        self._closed = threading.Event()
+        if latency:
+            if "commandstats" not in self.sections:
+                self.sections += ("commandstats",)
+            self.ping_histogram = LatencyHistogram()
+            threading.Thread(target=self._ping, args=(ping_interval,), name="Pinger {}".format(name),
+                             daemon=True).start()
+        self.profiler = KeyspaceProfiler(self.client, name, **profile) if profile is not None else None
+
+    def poll(self):
+        """
+        :return: a list of Zabbix items: (Zabbix host, Zabbix key, Zabbix value, clock, ns)
+        """
+        pipe = self.client.pipeline(transaction=False)  # A section per command, Redis before 7.0 can't take more
+        for section in self.sections:
+            pipe.execute_command("INFO", section)
+        if self.latency:
+            pipe.latency_latest()
+            pipe.slowlog_get(type(self)._SLOWLOG_BATCH)
+        replies = pipe.execute(raise_on_error=False)
+        for reply in replies[:len(self.sections)]:
+            if isinstance(reply, Exception):
+                raise reply
+        parsed_info = self._parse_info(replies[:len(self.sections)])
+        clock, ns = divmod(time.time_ns(), 1000000000)
+        sample = (parsed_info.get("run_id"), parsed_info.get("uptime_in_seconds", 0), time.monotonic(),
+                  {k: parsed_info[k] for k in type(self)._COUNTERS})
+        redis_info = {k: v for k, v in parsed_info.items() if k in self.wanted_props or k == "_total_keys"}
+        redis_info["_mem_fragmentation_ratio_dev"] = abs(1 - parsed_info["mem_fragmentation_ratio"])
+        hits_and_misses = parsed_info["keyspace_hits"] + parsed_info["keyspace_misses"]
+        redis_info["_keyspace_hit_ratio"] = parsed_info["keyspace_hits"] / hits_and_misses if \
+            hits_and_misses > 0 else 1
+        redis_info["_mem_usage_ratio"] = parsed_info["used_memory"] / parsed_info["maxmemory"] if \
+            parsed_info["maxmemory"] > 0 else 0
+        redis_info.update(self._get_rates(sample))
+        zbx_packet = [(self.zhost, "redis.info." + k, v, clock, ns) for k, v in redis_info.items()]
+        if self.latency:
+            zbx_packet.extend((self.zhost, k, v, clock, ns)
+                              for k, v in self._get_latency(sample, parsed_info.get("_commandstats", dict()),
+                                                            *replies[-2:]))
+        if self.profiler is not None:
+            prefixes = self.profiler.get_prefixes()
+            profile = self._get_discovery("redis.keyspace.prefix.discovery", "{#PREFIX}", prefixes) if \
+                prefixes is not None else list()  # Empty discovery would make the prefixes discovered before lost
+            zbx_packet.extend((self.zhost, k, v, clock, ns) for k, v in profile + self.profiler.collect())
+        zbx_packet.append((self.zhost, "redis.info._getting_stats_done", "1", clock, ns))
+        return zbx_packet
+
+    def _ping(self, interval):
+        """
+        Measures PING round-trip time every interval till the instance is closed
+        """
+        while not self._closed.wait(interval):
+            started = time.perf_counter()
+            try:
+                self.client.ping()
+            except Exception:
+                self.ping_histogram.error()
+            else:
+                self.ping_histogram.observe(time.perf_counter() - started)
+
+    def _get_latency(self, sample, commandstats, events, slowlog):
+        """
+        :param sample: the sample the counters rates are computed from, see _get_rates
+        :param commandstats: {command: (calls, usec)} parsed from INFO commandstats
+        :param events: LATENCY LATEST reply or the exception it has failed with
+        :param slowlog: SLOWLOG GET reply or the exception it has failed with
+        :return: a list of Zabbix items: (Zabbix key, Zabbix value)
+        """
+        rv = [("redis.latency.ping[{}]".format(k), v) for k, v in self.ping_histogram.collect().items()]
+        run_id, uptime, taken, counters = sample
+        commandstats = (run_id, taken, commandstats)
+        rv.extend(self._get_commands_latency(self._prev_commandstats, commandstats))
+        self._prev_commandstats = commandstats
+        if isinstance(events, Exception):
+            logging.warning("Could not get latency events of Redis instance \"{}\": {}".format(self.name, events))
+        else:
+            rv.extend(self._get_events_latency(events))
+        if isinstance(slowlog, Exception):
+            logging.warning("Could not get slowlog of Redis instance \"{}\": {}".format(self.name, slowlog))
+        else:
+            rv.extend(self._get_slowlog(run_id, slowlog))
+        return rv
+
+    def _get_commands_latency(self, prev, current):
+        """
+        :param prev: (run_id, time.monotonic(), {command: (calls, usec)}) of the previous poll or None
+        :param current: (run_id, time.monotonic(), {command: (calls, usec)}) of this poll
+        :return: a list of Zabbix items: discovery of the commands, their calls rates and average execution times
+        since the previous poll. The rates and times are skipped after a Redis restart or a stats reset
+        """
+        run_id, taken, stats = current
+        rv = self._get_discovery("redis.latency.command.discovery", "{#COMMAND}", stats)
+        if prev is None:
+            return rv
+        prev_run_id, prev_taken, prev_stats = prev
+        elapsed = taken - prev_taken
+        if run_id != prev_run_id or elapsed <= 0 or \
+                any(calls < prev_stats.get(k, (0, 0))[0] for k, (calls, usec) in stats.items()):
+            return rv
+        for command, (calls, usec) in stats.items():
+            prev_calls, prev_usec = prev_stats.get(command, (0, 0))
+            rv.append(("redis.latency.command[{},calls]".format(command), (calls - prev_calls) / elapsed))
+            if calls > prev_calls:
+                rv.append(("redis.latency.command[{},time]".format(command),
+                           (usec - prev_usec) / (calls - prev_calls) / 1000000))
+        return rv
+
+    def _get_events_latency(self, events):
+        """
+        :param events: LATENCY LATEST reply: [event, time of the latest spike, latest spike (ms), max spike (ms)], ...
+        :return: a list of Zabbix items: discovery of the events, their max spikes and the latest spikes which
+        have happened since the previous poll
+        """
+        events = {(x[0].decode("utf-8", "replace") if isinstance(x[0], bytes) else x[0]): x[1:4] for x in events}
+        rv = self._get_discovery("redis.latency.event.discovery", "{#EVENT}", events)
+        seen, self._events = self._events, {k: v[0] for k, v in events.items()}
+        for event, (spiked, latest, max_) in events.items():
+            rv.append(("redis.latency.event[{},max]".format(event), max_ / 1000))
+            if seen is not None and spiked > seen.get(event, 0):
+                rv.append(("redis.latency.event[{},latest]".format(event), latest / 1000))
+        return rv
+
+    def _get_slowlog(self, run_id, entries):
+        """
+        :param run_id: Redis run_id. Slowlog IDs start over when it changes
+        :param entries: SLOWLOG GET reply parsed by redis-py, the newest entry first
+        :return: a list of Zabbix items: the number of the slowlog entries added since the previous poll,
+        the longest duration of them and their text. The entries of the first poll are taken as already seen
+        """
+        last_id = self._slowlog_id
+        if last_id is not None and (run_id != last_id[0] or (entries and entries[0]["id"] < last_id[1])):
+            last_id = (run_id, -1)  # Redis has been restarted
+        new_entries = [x for x in entries if last_id is None or x["id"] > last_id[1]]
+        if last_id is not None and len(new_entries) == type(self)._SLOWLOG_BATCH:  # Some new entries may be missing
+            entries = self.client.slowlog_get(type(self)._SLOWLOG_MAX)
+            new_entries = [x for x in entries if x["id"] > last_id[1]]
+        if entries:
+            self._slowlog_id = (run_id, entries[0]["id"])
+        elif last_id is None:
+            self._slowlog_id = (run_id, -1)
+        if last_id is None:
+            return list()
+        rv = [("redis.latency.slowlog[count]", len(new_entries)),
+              ("redis.latency.slowlog[max]", max((x["duration"] for x in new_entries), default=0) / 1000000)]
+        if new_entries:
+            limit = type(self)._SLOWLOG_COMMAND_MAX
+            rv.append(("redis.latency.slowlog[entries]", "\n".join(
+                "{} {} {:.6f}s {}".format(x["id"], time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(x["start_time"])),
+                                          x["duration"] / 1000000,
+                                          x["command"].decode("utf-8", "replace")[:limit]
+                                          if isinstance(x["command"], bytes) else x["command"][:limit])
+                for x in reversed(new_entries))))
+        return rv
+
+    def _get_discovery(self, key, macro, names):
+        """
+        :return: a list with LLD Zabbix item if the names have changed since they were sent or it's time to re-send
+        them, otherwise an empty list
+        """
+        names = sorted(names)
+        sent = self._discovered.get(key)
+        now = time.monotonic()
+        if sent is not None and sent[1] == names and now - sent[0] < type(self)._DISCOVERY_RESEND:
+            return list()
+        self._discovered[key] = (now, names)
+        return [(key, json.dumps({"data": [{macro: x} for x in names]}))]
+
+    def _parse_info(self, replies):
+        """
+        Parses INFO replies in a single pass. Only the wanted and required fields are converted, keys numbers
+        of the databases are summed up. The rest of a section is skipped as soon as all the fields are found
+        :param replies: INFO replies (bytes), a section per reply
+        :return: a dict of the fields found. "_total_keys" is there if keyspace section is requested,
+        "_commandstats" ({command: (calls, usec)}) is there if commandstats section is requested
+        """
+        rv = dict()
+        props = self._parsed_props
+        left = len(props)
+        for reply in replies:
+            lines = reply.decode("utf-8", "replace").splitlines()
+            if lines and lines[0] == "# Keyspace":
+                total_keys = 0
+                for line in lines[1:]:  # db0:keys=1,expires=0,avg_ttl=0
+                    start = line.find(":keys=")
+                    if start > 0:
+                        total_keys += int(line[start + 6:line.index(",", start)])
+                rv["_total_keys"] = total_keys
+                continue
+            if lines and lines[0] == "# Commandstats":
+                commandstats = dict()
+                for line in lines[1:]:  # cmdstat_get:calls=2,usec=5,usec_per_call=2.50,rejected_calls=0,failed_calls=0
+                    name, sep, value = line.partition(":")
+                    if sep and name.startswith("cmdstat_"):
+                        stats = dict(x.partition("=")[::2] for x in value.split(","))
+                        commandstats[name[8:]] = (int(stats["calls"]), int(stats["usec"]))
+                rv["_commandstats"] = commandstats
+                continue
+            for line in lines:
+                if not left:
+                    break
+                name, sep, value = line.partition(":")
+                if sep and name in props and name not in rv:
+                    rv[name] = _info_value(value)
+                    left -= 1
+        missing = type(self)._REQUIRED_PROPS.difference(rv)
+        if missing:
+            raise RuntimeError("INFO fields {} are missing".format(", ".join(sorted(missing))))
+        return rv
+
+    def _get_rates(self, sample):
+        """
+        Computes the counters rates and keyspace hit ratios since the previous sample and updates the hit ratio EWMAs.
+        The sample is remembered as the previous one
+        :param sample: (run_id, uptime_in_seconds, time.monotonic() of the sample, dict of the counters values)
+        :return: a dict of the values computed. It's empty for the first sample and the one following a Redis restart
+        or a stats reset, since the counters deltas are meaningless then
+        """
+        prev, self._prev_sample = self._prev_sample, sample
+        if prev is None:
+            return dict()
+        run_id, uptime, taken, counters = sample
+        prev_run_id, prev_uptime, prev_taken, prev_counters = prev
+        if run_id != prev_run_id or uptime < prev_uptime or any(v < prev_counters[k] for k, v in counters.items()):
+            logging.info("Redis instance \"{}\" has been restarted or its stats have been reset. "
+                         "Rates are skipped till the next poll".format(self.name))
+            return dict()
+        elapsed = taken - prev_taken
+        if elapsed <= 0:
+            return dict()
+        rv = {"_{}_rate".format(k): (v - prev_counters[k]) / elapsed for k, v in counters.items()}
+        hits, misses = rv["_keyspace_hits_rate"], rv["_keyspace_misses_rate"]
+        rv["_keyspace_hit_ratio_interval"] = hits / (hits + misses) if hits + misses > 0 else 1
+        for window in self.ewma_windows:
+            ewma = self._ewma.get(window)
+            if ewma is None:
+                ewma = self._ewma[window] = [hits, misses]
+            else:
+                alpha = 1 - math.exp(-elapsed / window)  # Polls aren't necessarily evenly spaced
+                ewma[0] += alpha * (hits - ewma[0])
+                ewma[1] += alpha * (misses - ewma[1])
+            rv["_keyspace_hit_ratio_ewma[{}]".format(window)] = ewma[0] / (ewma[0] + ewma[1]) if \
+                ewma[0] + ewma[1] > 0 else 1
+        return rv
+
+    def close(self):
+        self._closed.set()
+        if self.profiler is not None:
+            self.profiler.close()
+        self.pool.disconnect()
+
+
+def _info_value(value):
+    """
+    :param value: INFO field value
+    :return: the value converted to int or float if it looks like one
+    """
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+
+def parse_list(text):
+    """
+    :param text: comma separated list
+    :return: a tuple of the list items
+    """
+    return tuple(x.strip() for x in text.split(",") if x.strip())
+
+
+_PROFILE_OPTIONS = {"profile_budget": ("budget", float), "profile_sample": ("sample_rate", float),
+                    "profile_depth": ("depth", int), "profile_delimiter": ("delimiter", str),
+                    "profile_top": ("top", int)}  # Option -> (KeyspaceProfiler's arg, type)
+
+
+def get_profile(cmdargs, section=None):
+    """
+    :param cmdargs: parsed command line args
+    :param section: config file section of the instance. Its options override the command line args
+    :return: a dict of KeyspaceProfiler's args or None if the keyspace isn't profiled
+    """
+    if not (section.getboolean("profile", fallback=cmdargs.profile) if section is not None else cmdargs.profile):
+        return None
+    return {arg: conv(section[option]) if section is not None and option in section else getattr(cmdargs, option)
+            for option, (arg, conv) in _PROFILE_OPTIONS.items()}
+
+
+def parse_windows(text):
+    """
+    :param text: comma separated EWMA windows (seconds)
+    :return: a tuple of the windows
+    """
+    windows = tuple(int(x) for x in text.split(",") if x.strip())
+    if any(x <= 0 for x in windows):
+        raise ValueError("EWMA windows must be positive")
+    return windows
+
+
+def load_instances(cmdargs):
+    """
+    :param cmdargs: parsed command line args
+    :return: a list of RedisInstance's instances. They are read from the config file if it's set
+    (every section is an instance, see zabbix_redis_stats.ini.txt), otherwise it's the one set by the command line args
+    """
+    if cmdargs.config is None:
+        rconn_vars = dict()
+        tr_vars(cmdargs, [rconn_vars], [{"rhost": "host", "rport": "port", "rtimeout": "timeout",
+                                         "ewma": "ewma_windows", "sections": "sections", "props": "wanted_props",
+                                         "latency": "latency", "ping_interval": "ping_interval"}])
+        return [RedisInstance(cmdargs.zhost, cmdargs.zhost, profile=get_profile(cmdargs), **rconn_vars)]
+    cfg = configparser.ConfigParser()
+    if not cfg.read(cmdargs.config):
+        raise RuntimeError("Could not read config file \"{}\"".format(cmdargs.config))
+    instances = list()
+    for section in cfg.sections():
+        try:
+            instances.append(RedisInstance(section,
+                                           cfg.get(section, "zhost", fallback=section),
+                                           host=cfg.get(section, "host", fallback="localhost"),
+                                           port=cfg.getint(section, "port", fallback=6379),
+                                           socket_path=cfg.get(section, "socket", fallback=None),
+                                           password=cfg.get(section, "password", fallback=None),
+                                           db=cfg.getint(section, "db", fallback=0),
+                                           timeout=cfg.getfloat(section, "timeout", fallback=cmdargs.rtimeout),
+                                           ewma_windows=parse_windows(cfg.get(section, "ewma"))
+                                           if cfg.has_option(section, "ewma") else cmdargs.ewma,
+                                           sections=parse_list(cfg.get(section, "sections"))
+                                           if cfg.has_option(section, "sections") else cmdargs.sections,
+                                           wanted_props=parse_list(cfg.get(section, "props"))
+                                           if cfg.has_option(section, "props") else cmdargs.props,
+                                           latency=cfg.getboolean(section, "latency", fallback=cmdargs.latency),
+                                           ping_interval=cfg.getfloat(section, "ping_interval",
+                                                                      fallback=cmdargs.ping_interval),
+                                           profile=get_profile(cmdargs, cfg[section])))
+        except ValueError as exc:
+            raise RuntimeError("Instance \"{}\" is misconfigured: {}".format(section, exc))
+    if not instances:
+        raise RuntimeError("No Redis instances found in config file \"{}\"".format(cmdargs.config))
+    return instances
+
+
+def poll_instances(instances, executor):
+    """
+    Polls the instances concurrently
+    :param instances: a list of RedisInstance's instances
+    :param executor: an executor the polls are run by
+    :return: a list of Zabbix items of all the instances polled successfully
+    """
+    futures = [(instance, executor.submit(instance.poll)) for instance in instances]
+    zbx_packet = list()
+    for instance, future in futures:
+        try:
+            zbx_packet.extend(future.result())
+        except Exception:
+            logging.exception("Problem getting data from Redis instance \"{}\"".format(instance.name))
+    return zbx_packet
+
+
 def do_main_program(cmdargs):
     prog_info = {"prog_name": os.path.basename(sys.argv[0]).rsplit(".", 1)[0],
                  "prog_pid": os.getpid(),
-                 "zabbix_host": cmdargs.zhost}
+                 "zabbix_host": cmdargs.zhost if cmdargs.config is None else os.path.basename(cmdargs.config)}
     log_handler = logging.handlers.SysLogHandler(address=cmdargs.l,
                                                  facility=logging.handlers.SysLogHandler.LOG_USER)
     log_formatter = logging.Formatter(style="{",
@@ -43,53 +706,276 @@ def do_main_program(cmdargs):
     log = logging.getLogger()
     log.addHandler(log_handler)
     log.setLevel(getattr(logging, cmdargs.ll))
-    rconn_vars = dict()
-    rconn_vars_tr = {"rhost": "host", "rport": "port"}
     zconn_vars = dict()
-    zconn_vars_tr = {"zsrv": "zabbix_server", "zport": "zabbix_port"}
-    tr_vars(cmdargs, [rconn_vars, zconn_vars], [rconn_vars_tr, zconn_vars_tr])
-    redis_wanted_props = {"used_memory", "used_memory_rss", "used_memory_peak", "maxmemory",
-                          "mem_fragmentation_ratio", "expired_keys", "evicted_keys", "keyspace_hits",
-                          "keyspace_misses", "connected_clients", "total_connections_received",
-                          "rejected_connections", "instantaneous_ops_per_sec", "instantaneous_input_kbps",
-                          "instantaneous_output_kbps", "redis_version"}
+    zconn_vars_tr = {"zsrv": "server", "zport": "port", "zcompress": "compress_threshold"}
+    tr_vars(cmdargs, [zconn_vars], [zconn_vars_tr])
+    instances = load_instances(cmdargs)
+    zbx_client = zabbix_trapper.TrapperClient(**zconn_vars)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=min(cmdargs.workers, len(instances)),
+                                                     thread_name_prefix="Poller")
     send_dest = {"print": "console", "send": "zabbix server"}
-    while True:
-        log.info("Performing poll/send (to {})".format(send_dest.get(cmdargs.action, "unknown")))
-        try:
-            redis_info = redis.StrictRedis(**rconn_vars).info()
-        except Exception:
-            log.exception("Problem getting data from Redis server")
-        else:
-            zbx_packet = list()
-            redis_total_keys = 0
-            for p in list(redis_info.keys()):
-                if re.fullmatch("db\d+", p):
-                    redis_total_keys += redis_info[p]['keys']
-                if p not in redis_wanted_props:
-                    del redis_info[p]
-            redis_info["_total_keys"] = redis_total_keys
-            redis_info["_mem_fragmentation_ratio_dev"] = abs(1 - redis_info["mem_fragmentation_ratio"])
-            hits_and_misses = redis_info["keyspace_hits"] + redis_info["keyspace_misses"]
-            redis_info["_keyspace_hit_ratio"] = redis_info["keyspace_hits"] / hits_and_misses if \
-                hits_and_misses > 0 else 1
-            redis_info["_mem_usage_ratio"] = redis_info["used_memory"] / redis_info["maxmemory"] if \
-                redis_info["maxmemory"] > 0 else 0
-            for kv in redis_info.items():
-                zbx_packet.append(pyzabbix.ZabbixMetric(cmdargs.zhost, "redis.info." + kv[0], kv[1]))
-            zbx_packet.append(pyzabbix.ZabbixMetric(cmdargs.zhost, "redis.info._getting_stats_done", "1"))
-            if cmdargs.action == "send":
+    next_poll = time.monotonic()
+    try:
+        while True:
+            log.info("Performing poll/send of {} instance(s) (to {})".format(len(instances),
+                                                                           send_dest.get(cmdargs.action, "unknown")))
+            zbx_packet = poll_instances(instances, executor)
+            if not zbx_packet:
+                pass
+            elif cmdargs.action == "send":
                 try:
-                    pyzabbix.ZabbixSender(**zconn_vars).send(zbx_packet)
+                    zbx_result = zbx_client.send(zbx_packet)
                 except Exception:
                     log.exception("Problem sending data to Zabbix server")
+                else:
+                    if zbx_result.failed:
+                        log.warning("Zabbix server has failed to process {} of {} item(s)".format(zbx_result.failed,
+                                                                                                zbx_result.total))
             elif cmdargs.action == "print":
                 print(zbx_packet)
             else:
                 log.error("Unknown action \"{}\"".format(cmdargs.action))
-        if cmdargs.oneshot:
-            break
-        time.sleep(cmdargs.interval)
+            if cmdargs.oneshot:
+                break
+            next_poll += cmdargs.interval  # The polls don't drift no matter how long they take
+            if next_poll <= time.monotonic():
+                log.warning("Poll/send took longer than the interval. Skipping the missed poll(s)")
+                next_poll = time.monotonic() + cmdargs.interval
+            time.sleep(max(0.0, next_poll - time.monotonic()))  # The deadline may pass since it has been checked
+    finally:
+        executor.shutdown(wait=False)
+        for instance in instances:
+            instance.close()
+
+
+class FakeRedis:
+    """
+    Local server speaking enough of Redis protocol (RESP) to be polled by the script. INFO counters grow on every call.
+    Every slow_every-th command is logged to the slowlog and reported as a latency event. Used for benchmarking and testing
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, dbs=16, slow_every=50, keys=1000):
+        """
+        :param dbs: number of the databases with keys reported by INFO
+        :param slow_every: how frequently the commands are logged as slow ones
+        :param keys: number of the keys which can be scanned. Their prefixes are "tenant0:" .. "tenant6:",
+        a key of tenantN takes (N + 1) * 100 bytes. Every 10th key has no prefix
+        """
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(128)
+        self.address = self.sock.getsockname()
+        self.dbs = dbs
+        self._keyspace = "\r\n".join("db{}:keys={},expires=0,avg_ttl=0".format(i, 1000 + i) for i in range(dbs))
+        self.connections = 0
+        self.commands = 0
+        self.run_id = os.urandom(20).hex()
+        self.started = time.time()
+        self.slow_every = slow_every
+        self.keys = ["key{}".format(i) if i % 10 == 0 else "tenant{}:obj:{}".format(i % 7, i) for i in range(keys)]
+        self.command_stats = dict()  # Command -> [calls, usec]
+        self.slowlog = list()  # [id, start time, duration (usec), command args], the newest entry first
+        self.slowlog_id = 0
+        self.latency_events = dict()  # Event -> [time of the latest spike, latest spike (ms), max spike (ms)]
+        self._lock = threading.Lock()
+        threading.Thread(target=self._serve, name="FakeRedis", daemon=True).start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn = self.sock.accept()[0]
+            except OSError:
+                break
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # As Redis does. Pipelined replies aren't delayed
+            with self._lock:
+                self.connections += 1
+            threading.Thread(target=self._handle, args=(conn,), name="FakeRedisConnection", daemon=True).start()
+
+    def _handle(self, conn):
+        with conn, conn.makefile("rb") as reader:
+            while True:
+                try:
+                    command = self._read_command(reader)
+                    if command is None:
+                        break
+                    conn.sendall(self.execute([x.decode("utf-8") for x in command]))
+                except (OSError, ValueError):
+                    break
+
+    @staticmethod
+    def _read_command(reader):
+        """
+        :return: a list of the command's arguments (bytes) or None if the connection is closed
+        """
+        line = reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):  # Inline command
+            return line.split()
+        args = list()
+        for i in range(int(line[1:])):
+            size = int(reader.readline()[1:])
+            args.append(reader.read(size + 2)[:-2])
+        return args
+
+    @staticmethod
+    def _int(value):
+        return ":{}\r\n".format(value).encode("ascii")
+
+    @staticmethod
+    def _bulk(text):
+        data = text.encode("utf-8")
+        return b"$" + str(len(data)).encode("ascii") + b"\r\n" + data + b"\r\n"
+
+    @staticmethod
+    def _array(items):
+        """
+        :param items: a list of RESP replies
+        """
+        return "*{}\r\n".format(len(items)).encode("ascii") + b"".join(items)
+
+    def execute(self, command):
+        """
+        :param command: a list of the command's arguments
+        :return: RESP reply
+        """
+        name = command[0].upper()
+        with self._lock:
+            self.commands += 1
+            stats = self.command_stats.setdefault(name.lower(), [0, 0])
+            stats[0] += 1
+            stats[1] += 2 + len(command)
+            if self.commands % self.slow_every == 0:
+                now = int(time.time())
+                duration = 10000 + self.commands % 7 * 1000
+                self.slowlog.insert(0, [self.slowlog_id, now, duration, command])
+                del self.slowlog[128:]
+                self.slowlog_id += 1
+                event = self.latency_events.setdefault("command", [0, 0, 0])
+                event[:] = [now, duration // 1000, max(event[2], duration // 1000)]
+        if name == "PING":
+            return b"+PONG\r\n"
+        elif name in {"AUTH", "SELECT"}:
+            return b"+OK\r\n"
+        elif name == "HELLO":  # Sent by the recent redis-py versions on connect
+            proto = int(command[1]) if len(command) > 1 else 2
+            fields = [("server", "redis"), ("version", "7.2.4"), ("proto", proto), ("mode", "standalone")]
+            reply = "%{}\r\n".format(len(fields)) if proto == 3 else "*{}\r\n".format(len(fields) * 2)
+            return reply.encode("ascii") + b"".join(self._bulk(k) + (self._int(v) if isinstance(v, int) else self._bulk(v))
+                                                    for k, v in fields)
+        elif name == "INFO":
+            return self._bulk(self.info([x.lower() for x in command[1:]]))
+        elif name == "SLOWLOG" and len(command) > 1 and command[1].upper() == "GET":
+            with self._lock:
+                entries = self.slowlog[:int(command[2]) if len(command) > 2 else 10]
+            return self._array([self._array([self._int(x[0]), self._int(x[1]), self._int(x[2]),
+                                              self._array([self._bulk(arg) for arg in x[3]]),
+                                              self._bulk("127.0.0.1:50000"), self._bulk("")]) for x in entries])
+        elif name == "SCAN":
+            cursor = int(command[1])
+            options = {command[i].upper(): command[i + 1] for i in range(2, len(command) - 1, 2)}
+            end = cursor + int(options.get("COUNT", 10))
+            return self._array([self._bulk(str(end if end < len(self.keys) else 0)),
+                                self._array([self._bulk(x) for x in self.keys[cursor:end]])])
+        elif name == "MEMORY" and len(command) > 2 and command[1].upper() == "USAGE":
+            if not command[2].startswith("tenant"):
+                return self._int(50)
+            return self._int((int(command[2].split(":", 1)[0][6:]) + 1) * 100)
+        elif name == "TYPE":
+            return b"+hash\r\n" if command[1].startswith("tenant0:") else b"+string\r\n"
+        elif name == "LATENCY" and len(command) > 1 and command[1].upper() == "LATEST":
+            with self._lock:
+                events = [[k] + v for k, v in self.latency_events.items()]
+            return self._array([self._array([self._bulk(x[0])] + [self._int(v) for v in x[1:]]) for x in events])
+        return "-ERR unknown command '{}'\r\n".format(command[0]).encode("utf-8")
+
+    def restart(self):
+        """
+        Makes the server look restarted: run_id is changed, uptime and counters start over
+        """
+        with self._lock:
+            self.run_id = os.urandom(20).hex()
+            self.started = time.time()
+            self.commands = 0
+            self.connections = 0
+            self.command_stats = dict()
+            self.slowlog = list()
+            self.slowlog_id = 0
+            self.latency_events = dict()
+
+    def info(self, sections):
+        """
+        :param sections: a list of the sections requested. Empty list means the default ones
+        :return: INFO reply text
+        """
+        n = self.commands
+        all_sections = {
+            "server": ["redis_version:7.2.4", "run_id:{}".format(self.run_id),
+                       "uptime_in_seconds:{}".format(int(time.time() - self.started))],
+            "clients": ["connected_clients:{}".format(10 + n % 5), "blocked_clients:0"],
+            "memory": ["used_memory:{}".format(100000000 + n * 1000), "used_memory_rss:{}".format(120000000 + n * 1000),
+                       "used_memory_peak:{}".format(100000000 + n * 1000), "maxmemory:1073741824",
+                       "mem_fragmentation_ratio:1.20"],
+            "stats": ["total_connections_received:{}".format(self.connections), "total_commands_processed:{}".format(n),
+                      "instantaneous_ops_per_sec:100", "instantaneous_input_kbps:1.50",
+                      "instantaneous_output_kbps:3.20", "rejected_connections:0", "expired_keys:{}".format(n * 10),
+                      "evicted_keys:{}".format(n), "keyspace_hits:{}".format(n * 90),
+                      "keyspace_misses:{}".format(n * 10)],
+            "keyspace": [self._keyspace],
+            "commandstats": ["cmdstat_{}:calls={},usec={},usec_per_call={:.2f},rejected_calls=0,failed_calls=0".format(
+                k, calls, usec, usec / calls) for k, (calls, usec) in list(self.command_stats.items())],
+        }
+        if not sections or sections[0] == "default":
+            sections = [x for x in all_sections if x != "commandstats"]
+        elif sections[0] in {"all", "everything"}:
+            sections = list(all_sections)
+        return "\r\n".join("# {}\r\n{}\r\n".format(x.capitalize(), "\r\n".join(all_sections[x]))
+                           for x in sections if x in all_sections)
+
+    def close(self):
+        self.sock.close()
+
+
+def benchmark(instances_num, rounds):
+    """
+    Compares polling of a set of FakeRedis instances with the connections pooled and with a new connection per poll
+    """
+    servers = [FakeRedis() for i in range(instances_num)]
+    trapper = zabbix_trapper.FakeTrapper()
+    rv = list()
+    try:
+        instances = [RedisInstance("redis{}".format(i), "redis{}".format(i), *server.address)
+                     for i, server in enumerate(servers)]
+        client = zabbix_trapper.TrapperClient(*trapper.address)
+
+        def poll_reconnecting():  # The way it was done before the connections were pooled
+            fresh = [RedisInstance(x.name, x.zhost, *server.address) for x, server in zip(instances, servers)]
+            try:
+                return client.send(poll_instances(fresh, executor))
+            finally:
+                for x in fresh:
+                    x.close()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=instances_num) as executor:
+            cases = [("pooled connections", lambda: client.send(poll_instances(instances, executor))),
+                     ("new connection per poll", poll_reconnecting)]
+            for name, case in cases:
+                connections = sum(server.connections for server in servers)
+                started = time.perf_counter()
+                for r in range(rounds):
+                    case()
+                elapsed = time.perf_counter() - started
+                rv.append("{:30} {:12.1f} polls/s {:8.1f} ms/interval {:6d} connections".format(
+                    name, instances_num * rounds / elapsed, elapsed / rounds * 1000,
+                    sum(server.connections for server in servers) - connections))
+        for instance in instances:
+            instance.close()
+    finally:
+        trapper.close()
+        for server in servers:
+            server.close()
+    return rv
 
 
 if __name__ == "__main__":
@@ -99,16 +985,67 @@ if __name__ == "__main__":
                 "syslog_address": "/dev/log",
                 "severity": "WARNING",
                 "severities": ["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG", "NOTSET"],
-                "oneshot": False}
+                "oneshot": False,
+                "rtimeout": 10,
+                "ewma": "900,3600",
+                "latency": False,
+                "ping_interval": 1,
+                "profile": False,
+                "profile_budget": 100,
+                "profile_sample": 0.1,
+                "profile_depth": 1,
+                "profile_delimiter": ":",
+                "profile_top": 20,
+                "workers": 16,
+                "instances": 20,
+                "rounds": 20}
     cmd = argparse.ArgumentParser(description="Redis statistics poller/sender")
     cmd.add_argument("-version", action="version", version=_FILE_VER)
+    cmd.add_argument("-config", help="Config file with the Redis instances to poll (see zabbix_redis_stats.ini.txt). "
+                                     "If set, -rhost, -rport and -zhost are ignored", metavar="path")
     cmd.add_argument("-rhost", help="Redis host", metavar="name_or_addr")
     cmd.add_argument("-rport", help="Redis port", metavar="number", type=int)
+    cmd.add_argument("-rtimeout", help="Redis connect and command timeout ({rtimeout})".format(**defaults),
+                     metavar="sec", type=float, default=defaults["rtimeout"])
+    cmd.add_argument("-ewma", help="Comma separated time windows of the keyspace hit ratio moving averages "
+                                   "({ewma})".format(**defaults), metavar="sec,...", type=parse_windows,
+                     default=parse_windows(defaults["ewma"]))
+    cmd.add_argument("-sections", help="Comma separated INFO sections to request. server, memory and stats are required "
+                                       "({})".format(",".join(RedisInstance._SECTIONS)), metavar="name,...",
+                     type=parse_list)
+    cmd.add_argument("-props", help="Comma separated INFO fields to send (the ones the template has)",
+                     metavar="name,...", type=parse_list)
+    cmd.add_argument("-latency", help="Collect latency stats: PING round-trip times, latency events, new slowlog entries "
+                                      "and commands execution times ({latency})".format(**defaults),
+                     action="store_true", default=defaults["latency"])
+    cmd.add_argument("-ping_interval", help="How frequently to measure PING round-trip time when collecting latency "
+                                            "stats ({ping_interval})".format(**defaults), metavar="sec", type=float,
+                     default=defaults["ping_interval"])
+    cmd.add_argument("-profile", help="Profile the keyspace memory usage by the keys prefixes with SCAN in background "
+                                      "({profile})".format(**defaults), action="store_true", default=defaults["profile"])
+    cmd.add_argument("-profile_budget", help="Max number of Redis commands per second the keyspace profiling may use "
+                                             "({profile_budget})".format(**defaults), metavar="number", type=float,
+                     default=defaults["profile_budget"])
+    cmd.add_argument("-profile_sample", help="Share of the keys scanned which memory usage and type are sampled "
+                                             "({profile_sample})".format(**defaults), metavar="ratio", type=float,
+                     default=defaults["profile_sample"])
+    cmd.add_argument("-profile_depth", help="Number of the key's segments its prefix consists of "
+                                            "({profile_depth})".format(**defaults), metavar="number", type=int,
+                     default=defaults["profile_depth"])
+    cmd.add_argument("-profile_delimiter", help="Key segments delimiter ({profile_delimiter})".format(**defaults),
+                     metavar="text", default=defaults["profile_delimiter"])
+    cmd.add_argument("-profile_top", help="Number of the heaviest keys prefixes reported "
+                                          "({profile_top})".format(**defaults), metavar="number", type=int,
+                     default=defaults["profile_top"])
     cmd.add_argument("-zsrv", help="Zabbix server host", metavar="name_or_addr")
     cmd.add_argument("-zport", help="Zabbix server port", metavar="number", type=int)
-    cmd.add_argument("-zhost", help="Zabbix monitored host ID", metavar="name", required=True)
+    cmd.add_argument("-zcompress", help="Compress data sent to Zabbix server if its size exceeds the value",
+                     metavar="bytes", type=int)
+    cmd.add_argument("-zhost", help="Zabbix monitored host ID (required unless -config is set)", metavar="name")
     cmd.add_argument("-interval", help="How frequently to poll/send ({interval})".format(**defaults), metavar="sec",
                      type=int, default=defaults["interval"])
+    cmd.add_argument("-workers", help="Max number of Redis instances polled concurrently ({workers})".format(**defaults),
+                     metavar="number", type=int, default=defaults["workers"])
     cmd.add_argument("-action", help="Action to perform on successful data retrieval ({action})".format(**defaults),
                      choices=defaults["actions"], default=defaults["action"])
     cmd.add_argument("-l", metavar="address_or_path",
@@ -122,7 +1059,20 @@ if __name__ == "__main__":
                                             '"oneshot" and "action" will be set to False and "send". '
                                             'For correct operation, please specify an absolute path to the file',
                      metavar="full_path_to_file")
+    cmd.add_argument("-benchmark", help="Compare polling of local fake Redis instances with the connections pooled "
+                                        "and with a new connection per poll, and exit",
+                     action="store_true", default=False)
+    cmd.add_argument("-instances", help="Number of fake Redis instances when benchmarking ({instances})".format(
+                     **defaults), metavar="number", type=int, default=defaults["instances"])
+    cmd.add_argument("-rounds", help="Number of polls of every instance when benchmarking ({rounds})".format(
+                     **defaults), metavar="number", type=int, default=defaults["rounds"])
     cmdargs = cmd.parse_args()
+    if cmdargs.benchmark:
+        for line in benchmark(cmdargs.instances, cmdargs.rounds):
+            print(line)
+        sys.exit()
+    if cmdargs.config is None and cmdargs.zhost is None:
+        cmd.error("-zhost is required unless -config is set")
     if cmdargs.daemonpidfile is not None:
         if not os.path.isabs(cmdargs.daemonpidfile):
             raise RuntimeError("The path \"{}\" is not absolute".format(cmdargs.daemonpidfile))
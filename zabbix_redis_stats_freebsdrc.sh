@@ -14,6 +14,11 @@
 #                                      #  Each profile is a set of command args which substitutes command_args
 #                                      #  on each run_rc_command call.
 #                                      #  Plese do not specify -pidfile arg. This will be set automatically.
+#
+# A single profile may poll many Redis instances listed in a config file (see zabbix_redis_stats.ini.txt):
+#
+#zabbix_redis_stats_profiles="all"
+#zabbix_redis_stats_args_all="-config /usr/local/etc/zabbix_redis_stats.ini -zsrv zabbix.example.com"
 
 . /etc/rc.subr
 
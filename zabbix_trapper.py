@@ -0,0 +1,317 @@
+
+import socket
+import struct
+import json
+import zlib
+import re
+import time
+import threading
+import asyncio
+import argparse
+
+_FILE_VER = "to_be_filled_by_CI"
+
+_ZBX_HEADER_MAGIC = b"ZBXD"
+_ZBX_FLAG_PROTOCOL = 0x01
+_ZBX_FLAG_COMPRESSED = 0x02
+_ZBX_HEADER = struct.Struct("<4sBII")  # magic, flags, data length, reserved (uncompressed length if compressed)
+
+
+class TrapperError(Exception):
+    pass
+
+
+class TrapperPartialError(TrapperError):
+    """
+    Raised when sending has failed after some chunks of the items have been accepted by the server
+    """
+
+    def __init__(self, exc, result, sent):
+        """
+        :param exc: the exception sending has failed due to
+        :param result: a TrapperResult's instance for the chunks accepted
+        :param sent: number of the items sent, they are the first ones of the items passed
+        """
+        super().__init__("{} (after {} item(s) have been sent)".format(str(exc) or type(exc).__name__, sent))
+        self.result = result
+        self.sent = sent
+
+
+class TrapperResult:
+    """
+    Counters parsed from Zabbix server's responses
+    """
+
+    _INFO_RE = re.compile(r"processed:\s*(\d+);\s*failed:\s*(\d+);\s*total:\s*(\d+);\s*seconds spent:\s*([\d.]+)")
+
+    def __init__(self):
+        self.processed = 0
+        self.failed = 0
+        self.total = 0
+        self.seconds_spent = 0.0
+        self.chunks = 0
+
+    def parse(self, info):
+        """
+        :param info: "info" string of the server's response
+        """
+        m = type(self)._INFO_RE.search(info)
+        if m is None:
+            raise TrapperError("Unexpected response info: {}".format(info))
+        self.processed += int(m.group(1))
+        self.failed += int(m.group(2))
+        self.total += int(m.group(3))
+        self.seconds_spent += float(m.group(4))
+        self.chunks += 1
+
+    def __repr__(self):
+        return "processed: {}; failed: {}; total: {}; seconds spent: {:.6f}; chunks: {}".format(
+            self.processed, self.failed, self.total, self.seconds_spent, self.chunks)
+
+
+class TrapperClient:
+    """
+    Zabbix sender protocol client. Zabbix server closes the connection after every response,
+    so every chunk of items is sent over its own connection
+    """
+
+    def __init__(self, server="127.0.0.1", port=10051, timeout=10, chunk_size=1000, compress_threshold=None):
+        """
+        :param server: Zabbix server (or proxy) name or address
+        :param port: Zabbix server port
+        :param timeout: socket timeout (seconds)
+        :param chunk_size: max number of items sent over a single connection
+        :param compress_threshold: payload size (bytes) starting from which the payload is compressed.
+        None means never, as Zabbix versions before 4.0 don't support compression
+        """
+        self.server = server
+        self.port = port
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.compress_threshold = compress_threshold
+
+    @staticmethod
+    def encode(items, compress_threshold=None):
+        """
+        :param items: a list of tuples: (Zabbix host, Zabbix key, Zabbix value[, clock[, ns]])
+        :param compress_threshold: see __init__
+        :return: the packet ready to be sent
+        """
+        data = list()
+        for item in items:
+            metric = {"host": item[0], "key": item[1], "value": str(item[2])}
+            if len(item) > 3 and item[3] is not None:
+                metric["clock"] = int(item[3])
+                if len(item) > 4 and item[4] is not None:
+                    metric["ns"] = int(item[4])
+            data.append(metric)
+        now = time.time()
+        payload = json.dumps({"request": "sender data", "data": data, "clock": int(now),
+                              "ns": int(now % 1 * 1000000000)}, separators=(",", ":")).encode("utf-8")
+        if compress_threshold is not None and len(payload) >= compress_threshold:
+            compressed = zlib.compress(payload)
+            return _ZBX_HEADER.pack(_ZBX_HEADER_MAGIC, _ZBX_FLAG_PROTOCOL | _ZBX_FLAG_COMPRESSED,
+                                    len(compressed), len(payload)) + compressed
+        return _ZBX_HEADER.pack(_ZBX_HEADER_MAGIC, _ZBX_FLAG_PROTOCOL, len(payload), 0) + payload
+
+    @staticmethod
+    def _recv_exactly(conn, size):
+        buf = bytearray()
+        while len(buf) < size:
+            chunk = conn.recv(size - len(buf))
+            if not chunk:
+                raise TrapperError("Connection closed by the server after {} of {} bytes".format(len(buf), size))
+            buf += chunk
+        return bytes(buf)
+
+    @classmethod
+    def decode(cls, conn):
+        """
+        :param conn: a socket to read the server's response from
+        :return: the response (dict)
+        """
+        magic, flags, length, reserved = _ZBX_HEADER.unpack(cls._recv_exactly(conn, _ZBX_HEADER.size))
+        if magic != _ZBX_HEADER_MAGIC:
+            raise TrapperError("Got a response with bad header")
+        return cls._decode_payload(flags, cls._recv_exactly(conn, length))
+
+    @classmethod
+    async def decode_async(cls, reader):
+        """
+        :param reader: an asyncio.StreamReader to read the server's response from
+        :return: the response (dict)
+        """
+        try:
+            magic, flags, length, reserved = _ZBX_HEADER.unpack(await reader.readexactly(_ZBX_HEADER.size))
+            if magic != _ZBX_HEADER_MAGIC:
+                raise TrapperError("Got a response with bad header")
+            return cls._decode_payload(flags, await reader.readexactly(length))
+        except asyncio.IncompleteReadError as exc:
+            raise TrapperError("Connection closed by the server after {} of {} bytes".format(
+                len(exc.partial), len(exc.partial) + exc.expected))
+
+    @staticmethod
+    def _decode_payload(flags, payload):
+        if flags & _ZBX_FLAG_COMPRESSED:
+            payload = zlib.decompress(payload)
+        return json.loads(payload.decode("utf-8"))
+
+    @staticmethod
+    def _check_response(response, result):
+        if response.get("response") != "success":
+            raise TrapperError("Zabbix server has not accepted the data: {}".format(response))
+        result.parse(response.get("info", ""))
+
+    def _send_chunk(self, packet, result):
+        with socket.create_connection((self.server, self.port), timeout=self.timeout) as conn:
+            conn.sendall(packet)
+            response = self.decode(conn)
+        self._check_response(response, result)
+
+    async def _send_chunk_async(self, packet, result):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.server, self.port), self.timeout)
+        try:
+            writer.write(packet)
+            await asyncio.wait_for(writer.drain(), self.timeout)
+            response = await asyncio.wait_for(self.decode_async(reader), self.timeout)
+        finally:
+            writer.close()
+        self._check_response(response, result)
+
+    def send(self, items):
+        """
+        :param items: a list of tuples: (Zabbix host, Zabbix key, Zabbix value[, clock[, ns]])
+        :return: a TrapperResult's instance. TrapperPartialError is raised if sending has failed after some
+        of the chunks have been sent, so only the rest has to be re-sent
+        """
+        result = TrapperResult()
+        for offset in range(0, len(items), self.chunk_size):
+            try:
+                self._send_chunk(self.encode(items[offset:offset + self.chunk_size], self.compress_threshold), result)
+            except (OSError, TrapperError, ValueError) as exc:
+                if offset == 0:
+                    raise
+                raise TrapperPartialError(exc, result, offset) from exc
+        return result
+
+    async def send_async(self, items):
+        """
+        Coroutine counterpart of send. Raises asyncio.TimeoutError (besides OSError and TrapperError) on timeout
+        :param items: a list of tuples: (Zabbix host, Zabbix key, Zabbix value[, clock[, ns]])
+        :return: a TrapperResult's instance (see send)
+        """
+        result = TrapperResult()
+        for offset in range(0, len(items), self.chunk_size):
+            try:
+                await self._send_chunk_async(self.encode(items[offset:offset + self.chunk_size], self.compress_threshold),
+                                             result)
+            except (OSError, asyncio.TimeoutError, TrapperError, ValueError) as exc:
+                if offset == 0:
+                    raise
+                raise TrapperPartialError(exc, result, offset) from exc
+        return result
+
+
+class FakeTrapper:
+    """
+    Local server accepting Zabbix sender protocol requests. Used for benchmarking and testing
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, max_requests=None, keep_data=False):
+        """
+        :param max_requests: number of requests served before the server starts closing the connections
+        without a response. None means no limit. It may be changed while serving
+        :param keep_data: whether to keep the data of the requests served in the data list
+        """
+        self.max_requests = max_requests
+        self.requests = 0
+        self.data = list() if keep_data else None
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(128)
+        self.address = self.sock.getsockname()
+        self.items = 0
+        threading.Thread(target=self._serve, name="FakeTrapper", daemon=True).start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn = self.sock.accept()[0]
+            except OSError:
+                break
+            with conn:
+                try:
+                    request = TrapperClient.decode(conn)
+                except (TrapperError, ValueError, OSError):
+                    continue
+                if self.max_requests is not None and self.requests >= self.max_requests:
+                    continue
+                self.requests += 1
+                if self.data is not None:
+                    self.data.append(request.get("data", []))
+                processed = len(request.get("data", []))
+                self.items += processed
+                payload = json.dumps({"response": "success",
+                                      "info": "processed: {0}; failed: 0; total: {0}; seconds spent: 0.000010"
+                                      .format(processed)}).encode("utf-8")
+                conn.sendall(_ZBX_HEADER.pack(_ZBX_HEADER_MAGIC, _ZBX_FLAG_PROTOCOL, len(payload), 0) + payload)
+
+    def close(self):
+        self.sock.close()
+
+
+def benchmark(items_num, rounds, chunk_size):
+    """
+    Compares encoding and sending throughput of TrapperClient and pyzabbix against a FakeTrapper
+    """
+    items = [("benchmark.host", "benchmark.item[{}]".format(i), i * 1.5, int(time.time())) for i in range(items_num)]
+    trapper = FakeTrapper()
+    rv = list()
+    try:
+        client = TrapperClient(*trapper.address, chunk_size=chunk_size)
+        client_z = TrapperClient(*trapper.address, chunk_size=chunk_size, compress_threshold=0)
+        cases = [("zabbix_trapper encode", lambda: TrapperClient.encode(items)),
+                 ("zabbix_trapper encode (compressed)", lambda: TrapperClient.encode(items, 0)),
+                 ("zabbix_trapper send", lambda: client.send(items)),
+                 ("zabbix_trapper send (compressed)", lambda: client_z.send(items))]
+        try:
+            import pyzabbix
+        except ImportError:
+            rv.append("pyzabbix is not installed, skipping it")
+        else:
+            sender = pyzabbix.ZabbixSender(*trapper.address, chunk_size=chunk_size)
+            cases.extend([("pyzabbix encode", lambda: sender._create_packet(sender._create_request(
+                              sender._create_messages([pyzabbix.ZabbixMetric(*x) for x in items])))),
+                          ("pyzabbix send", lambda: sender.send([pyzabbix.ZabbixMetric(*x) for x in items]))])
+        for name, case in cases:
+            started = time.perf_counter()
+            for r in range(rounds):
+                case()
+            elapsed = time.perf_counter() - started
+            rv.append("{:40} {:12.0f} items/s".format(name, items_num * rounds / elapsed))
+    finally:
+        trapper.close()
+    return rv
+
+
+if __name__ == "__main__":
+    defaults = {"items": 1000,
+                "rounds": 20,
+                "chunk_size": 1000}
+    cmd = argparse.ArgumentParser(description="Zabbix sender protocol client")
+    cmd.add_argument("-version", action="version", version=_FILE_VER)
+    cmd.add_argument("-benchmark", help="Compare the client's throughput with pyzabbix against a local fake server",
+                     action="store_true", default=False)
+    cmd.add_argument("-items", help="Number of items in a batch ({items})".format(**defaults), metavar="number",
+                     type=int, default=defaults["items"])
+    cmd.add_argument("-rounds", help="Number of batches ({rounds})".format(**defaults), metavar="number",
+                     type=int, default=defaults["rounds"])
+    cmd.add_argument("-chunk_size", help="Max number of items sent over a connection ({chunk_size})".format(**defaults),
+                     metavar="number", type=int, default=defaults["chunk_size"])
+    cmdargs = cmd.parse_args()
+    if cmdargs.benchmark:
+        for line in benchmark(cmdargs.items, cmdargs.rounds, cmdargs.chunk_size):
+            print(line)
+    else:
+        cmd.print_usage()
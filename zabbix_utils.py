@@ -0,0 +1,13 @@
+
+_FILE_VER = "to_be_filled_by_CI"
+
+
+def quote_key_param(value):
+    """
+    Quotes Zabbix item key parameter the way Zabbix does it when it substitutes LLD macros in the keys
+    :param value: a parameter value
+    :return: the value quoted if needed
+    """
+    if value.startswith(("\"", " ")) or "," in value or "]" in value:
+        return "\"{}\"".format(value.replace("\"", "\\\""))
+    return value